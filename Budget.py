@@ -4,6 +4,8 @@ import views_dashboard
 import views_input
 import views_bot
 import views_admin  # <--- [新增] 必须导入这个新文件！
+import snapshots
+import backend
 
 # 1. 页面配置
 st.set_page_config(page_title="FCO Cloud ERP", layout="wide", initial_sidebar_state="expanded")
@@ -22,21 +24,43 @@ st.markdown("""
 # 3. 侧边栏导航
 st.sidebar.title("🌲 FCO Cloud ERP")
 
+# 新会话：后台唤醒数据库 (免费版会休眠)，熔断时提示正在使用缓存 / 快照
+if "db_warmed" not in st.session_state:
+    backend.warm_up()
+    st.session_state["db_warmed"] = True
+if backend.db_health()["circuit"] in ("open", "half-open"):
+    st.sidebar.warning("⚠️ Database unreachable — showing cached / snapshot data.")
+
+# 修改日志里记录的操作人
+st.sidebar.text_input("👤 Your name", key="user_name", help="Recorded in the change log for every save")
+
 # 4. 定义页面映射
 # [新增] 在字典最后加入 "⚙️ Admin Settings"
 pages = {
     "Dashboard": views_dashboard.view_dashboard,
+    "Dashboard: Trends": views_dashboard.view_trends,
+    "Dashboard: Unit Economics": views_dashboard.view_unit_economics,
+    "Dashboard: Compartments": views_dashboard.view_compartments,
     "1. Log Sales Data": views_input.view_log_sales,
     "2. Budget Planning": lambda: views_input.view_monthly_input("Budget"),
+    "2b. Budget Scenarios": views_input.view_budget_scenarios,
     "3. Actuals Entry": lambda: views_input.view_monthly_input("Actual"),
     "4. Analysis & Invoice": views_dashboard.view_analysis_invoice,
     "5. 3rd Party Invoice Check": views_bot.view_invoice_bot,
     "6. 🛠️ DEBUG MODELS": views_bot.view_debug_models,
-    "⚙️ Admin Settings": views_admin.view_admin_upload  # <--- [新增] 这一行让菜单显示出来
+    "⚙️ Admin Settings": views_admin.view_admin_upload,  # <--- [新增] 这一行让菜单显示出来
+    "⚙️ Admin: Snapshots": views_admin.view_admin_snapshots,
+    "⚙️ Admin: Compartments": views_admin.view_admin_compartments,
+    "⚙️ Admin: Price Book": views_admin.view_admin_price_book,
+    "⚙️ Admin: Change Log": views_admin.view_admin_change_log
 }
 
 # 5. 渲染导航栏
 selection = st.sidebar.radio("Navigate", list(pages.keys()))
 
+# 离线模式：分析页面改读本地 Parquet 快照 (数据库休眠时也能用)
+if snapshots.available("dim_forests"):
+    st.sidebar.toggle("📦 Offline snapshot", key="use_snapshot", help="Read analytics from the local snapshot instead of the live database")
+
 # 6. 执行选中的页面
 pages[selection]()
\ No newline at end of file
@@ -84,7 +84,7 @@ with col_review:
         
         for item in results:
             # 1. 尝试去数据库找匹配的费用
-            # 这里简单匹配: 找 2025-01-01 的 Actual Cost，且 Activity Name 包含识别出的 Vendor
+            # 这里简单匹配: 找发票所在月份的 Actual Cost，且 Activity Name 包含识别出的 Vendor
             match_status = "❌ Not Found"
             db_amount = 0
             diff = 0
@@ -97,7 +97,7 @@ with col_review:
                     # 查询 fact_operational_costs
                     costs = supabase.table("fact_operational_costs").select("total_amount")\
                         .eq("activity_id", act_id)\
-                        .eq("month", "2025-01-01")\
+                        .eq("month", f"{item['date_detected'][:7]}-01")\
                         .eq("record_type", "Actual").execute().data
                     
                     if costs:
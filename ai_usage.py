@@ -0,0 +1,96 @@
+import time
+import pandas as pd
+import local_store
+
+# --- AI 调用统计 ---
+# 每次识别 (Gemini 或本地快速通道) 记一行：耗时、token 数、PDF 大小、重试次数、模型。
+# 存本地 SQLite，按批次汇总，用于评估并发数 / 缓存 / 快速通道阈值和月底处理成本。
+
+# 每百万 token 的美元单价 (input, output)，只用于估算
+PRICES = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-1.5-flash": (0.075, 0.30),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ai_calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id TEXT,
+    job_id INTEGER,
+    filename TEXT,
+    source TEXT,
+    model TEXT,
+    status TEXT,
+    started_at REAL,
+    latency_ms REAL,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    pdf_bytes INTEGER,
+    retries INTEGER,
+    invoices INTEGER,
+    error_msg TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_ai_calls_batch ON ai_calls(batch_id);
+CREATE INDEX IF NOT EXISTS idx_ai_calls_started ON ai_calls(started_at);
+"""
+
+COLS = ["batch_id", "job_id", "filename", "source", "model", "status", "started_at", "latency_ms",
+        "input_tokens", "output_tokens", "pdf_bytes", "retries", "invoices", "error_msg"]
+
+def new_stats():
+    """传给 backend.real_extract_invoice_data(stats=...) 的记录，调用过程中原地填写"""
+    return {"source": "gemini", "model": None, "started_at": time.time(), "latency_ms": 0.0,
+            "input_tokens": 0, "output_tokens": 0, "pdf_bytes": 0, "retries": 0}
+
+def estimate_cost(model, input_tokens, output_tokens):
+    p_in, p_out = PRICES.get(str(model or "").replace("models/", ""), (0.0, 0.0))
+    return (input_tokens or 0) / 1e6 * p_in + (output_tokens or 0) / 1e6 * p_out
+
+def record(stats, batch_id=None, job_id=None, filename=None, status="done", invoices=0, error_msg=None):
+    local_store.ensure_schema(_SCHEMA)
+    row = dict(stats, batch_id=batch_id, job_id=job_id, filename=filename, status=status, invoices=invoices, error_msg=error_msg)
+    conn = local_store.connect()
+    try:
+        conn.execute(f"INSERT INTO ai_calls ({','.join(COLS)}) VALUES ({','.join('?' * len(COLS))})",
+                     [row.get(c) for c in COLS])
+        conn.commit()
+    finally:
+        conn.close()
+
+def history(batch_id=None, since=None):
+    """明细 DataFrame (可按批次 / 起始时间筛选)，附带估算成本"""
+    local_store.ensure_schema(_SCHEMA)
+    sql, params = f"SELECT id, {','.join(COLS)} FROM ai_calls WHERE 1=1", []
+    if batch_id:
+        sql += " AND batch_id = ?"; params.append(batch_id)
+    if since:
+        sql += " AND started_at >= ?"; params.append(since)
+    conn = local_store.connect()
+    try: df = pd.DataFrame([dict(r) for r in conn.execute(sql + " ORDER BY id", params).fetchall()], columns=["id"] + COLS)
+    finally: conn.close()
+    if df.empty: return df.assign(est_cost=pd.Series(dtype=float))
+    df['started_at'] = pd.to_datetime(df['started_at'], unit='s')
+    df['est_cost'] = [estimate_cost(m, i, o) for m, i, o in zip(df['model'], df['input_tokens'], df['output_tokens'])]
+    return df
+
+def batch_summary(batch_id):
+    """单个批次的汇总；没有记录时返回 None"""
+    df = history(batch_id)
+    if df.empty: return None
+    ai = df[df['source'] == "gemini"]
+    end = df['started_at'] + pd.to_timedelta(df['latency_ms'].fillna(0), unit='ms')
+    span = (end.max() - df['started_at'].min()).total_seconds()
+    return {
+        "files": len(df),
+        "ai_calls": len(ai),
+        "fast_path": int((df['source'] == "text-layer").sum()),
+        "errors": int((df['status'] == "error").sum()),
+        "retries": int(df['retries'].fillna(0).sum()),
+        "p50_ms": float(ai['latency_ms'].median()) if len(ai) else 0.0,
+        "p95_ms": float(ai['latency_ms'].quantile(0.95)) if len(ai) else 0.0,
+        "wall_s": max(float(span), 0.0),
+        "input_tokens": int(df['input_tokens'].fillna(0).sum()),
+        "output_tokens": int(df['output_tokens'].fillna(0).sum()),
+        "pdf_mb": float(df['pdf_bytes'].fillna(0).sum()) / 1e6,
+        "est_cost": float(df['est_cost'].sum()),
+    }
@@ -0,0 +1,133 @@
+import re
+import time
+import threading
+import pandas as pd
+import local_store
+import backend
+import frames
+
+# --- 发票归档搜索 (本地 SQLite FTS5 索引) ---
+# invoice_archive 按 id 增量同步到本地，全文索引覆盖 vendor / invoice_no / description，
+# 日期、金额范围走普通索引，结果分页返回，不再每次拉全表。
+
+SYNC_INTERVAL = 60      # 秒，两次增量同步的最小间隔
+SYNC_PAGE = 1000
+PAGE_SIZE = 50
+
+ARCHIVE_COLS = ["id", "invoice_no", "vendor", "invoice_date", "description", "amount", "file_name", "file_url", "status", "created_at"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_rows (
+    id INTEGER PRIMARY KEY,
+    invoice_no TEXT,
+    vendor TEXT,
+    invoice_date TEXT,
+    description TEXT,
+    amount REAL,
+    file_name TEXT,
+    file_url TEXT,
+    status TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_archive_date ON archive_rows(invoice_date);
+CREATE INDEX IF NOT EXISTS idx_archive_amount ON archive_rows(amount);
+CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(
+    vendor, invoice_no, description, content='archive_rows', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS archive_rows_ai AFTER INSERT ON archive_rows BEGIN
+    INSERT INTO archive_fts(rowid, vendor, invoice_no, description) VALUES (new.id, new.vendor, new.invoice_no, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS archive_rows_ad AFTER DELETE ON archive_rows BEGIN
+    INSERT INTO archive_fts(archive_fts, rowid, vendor, invoice_no, description) VALUES ('delete', old.id, old.vendor, old.invoice_no, old.description);
+END;
+"""
+
+_sync_lock = threading.Lock()
+_last_sync = 0.0
+
+# --- A. 同步 ---
+def _pull():
+    """调用方需持有 _sync_lock"""
+    global _last_sync
+    local_store.ensure_schema(_SCHEMA)
+    conn = local_store.connect()
+    try:
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM archive_rows").fetchone()[0]
+        added = 0
+        while True:
+            rows = backend.supabase.table("invoice_archive").select(",".join(ARCHIVE_COLS))\
+                .gt("id", max_id).order("id").limit(SYNC_PAGE).execute().data
+            if not rows: break
+            conn.executemany(
+                f"INSERT OR REPLACE INTO archive_rows ({','.join(ARCHIVE_COLS)}) VALUES ({','.join('?' * len(ARCHIVE_COLS))})",
+                [tuple(r.get(c) for c in ARCHIVE_COLS) for r in rows]
+            )
+            conn.commit()
+            added += len(rows)
+            max_id = rows[-1]['id']
+            if len(rows) < SYNC_PAGE: break
+        _last_sync = time.time()
+        return added
+    finally:
+        conn.close()
+
+def sync(force=False):
+    """从 Supabase 增量拉取新的归档记录 (id > 本地最大 id)，返回新增行数"""
+    if not backend.supabase: return 0
+    with _sync_lock:
+        if not force and time.time() - _last_sync < SYNC_INTERVAL: return 0
+        return _pull()
+
+def rebuild():
+    """远端有修改 / 删除时使用：清空本地索引后全量同步 (整个过程持锁，避免和并发的 sync 交错)"""
+    if not backend.supabase: return 0
+    with _sync_lock:
+        local_store.ensure_schema(_SCHEMA)
+        conn = local_store.connect()
+        try:
+            conn.execute("DELETE FROM archive_rows")
+            conn.execute("INSERT INTO archive_fts(archive_fts) VALUES ('rebuild')")
+            conn.commit()
+        finally:
+            conn.close()
+        return _pull()
+
+# --- B. 查询 ---
+def _fts_query(text):
+    # 每个词做前缀匹配，词之间 AND；去掉引号等 FTS 语法字符
+    tokens = [t for t in re.split(r"\s+", text.strip()) if t]
+    tokens = [t.replace('"', '') for t in tokens]
+    return " ".join(f'"{t}"*' for t in tokens if t)
+
+def search(text="", date_from=None, date_to=None, amount_min=None, amount_max=None, page=1, page_size=PAGE_SIZE):
+    """
+    返回 (当前页 DataFrame, 总行数)。
+    date_from / date_to: date 或 'YYYY-MM-DD'；amount_min / amount_max: 数字或 None
+    """
+    local_store.ensure_schema(_SCHEMA)
+    where, params = [], []
+    q = _fts_query(text or "")
+    if q:
+        where.append("r.id IN (SELECT rowid FROM archive_fts WHERE archive_fts MATCH ?)")
+        params.append(q)
+    if date_from:
+        where.append("r.invoice_date >= ?"); params.append(str(date_from))
+    if date_to:
+        where.append("r.invoice_date <= ?"); params.append(str(date_to))
+    if amount_min is not None:
+        where.append("r.amount >= ?"); params.append(float(amount_min))
+    if amount_max is not None:
+        where.append("r.amount <= ?"); params.append(float(amount_max))
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    conn = local_store.connect()
+    try:
+        total = conn.execute(f"SELECT COUNT(*) FROM archive_rows r {where_sql}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {','.join('r.' + c for c in ARCHIVE_COLS)} FROM archive_rows r {where_sql} ORDER BY r.created_at DESC, r.id DESC LIMIT ? OFFSET ?",
+            params + [page_size, max(page - 1, 0) * page_size]
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows: return pd.DataFrame(columns=ARCHIVE_COLS), total
+    return frames.load_frame("invoice_archive", [dict(r) for r in rows]), total
@@ -1,66 +1,201 @@
 import streamlit as st
 import pandas as pd
-from supabase import create_client
+import db_client
 import google.generativeai as genai
 import json
 import time
 import re
 from datetime import date
+import local_store
+import snapshots
+import period_close
+import change_log
+import row_versions
 
 # --- A. 数据库连接 ---
+# 进程级单例：共用连接池，读请求自动重试，连续失败时熔断 (见 db_client)
 @st.cache_resource
 def init_connection():
     try:
         if "supabase" in st.secrets:
-            return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
-    except: return None
+            return db_client.ResilientClient(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
+    except Exception as e:
+        print(f"Supabase init error: {e}")
+        return None
     return None
 
 supabase = init_connection()
 
+def warm_up():
+    """会话开始时调用：后台 ping 唤醒休眠的数据库"""
+    if supabase is not None: supabase.warm_up()
+
+def db_health():
+    return supabase.health() if supabase is not None else {"circuit": "disconnected"}
+
 # --- B. Google AI 检查 ---
 def check_google_key():
     return "google" in st.secrets and "api_key" in st.secrets["google"]
 
+# --- B2. 数据版本 (按 表 + forest_id + month 分区) ---
+# 每次写入给受影响的分区打上一个全局递增的版本号 (类似 etag)，存本地 SQLite。
+# month / forest_id 为 '*' 表示整片失效 (例如 GL 映射、维度表)。
+_VERSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_versions (
+    table_name TEXT NOT NULL,
+    forest_id TEXT NOT NULL,
+    month TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    updated_at REAL,
+    PRIMARY KEY (table_name, forest_id, month)
+);
+CREATE INDEX IF NOT EXISTS idx_data_versions_version ON data_versions(version);
+"""
+
+@st.cache_resource
+def _init_version_store():
+    local_store.ensure_schema(_VERSION_SCHEMA)
+    return True
+
+def _month_key(month):
+    if month is None: return '*'
+    return f"{str(month)[:7]}-01"
+
+def bump_data_version(table_name, forest_id=None, months=None):
+    """写入路径调用：months 可以是单个月份、月份列表或 None (整个 forest)"""
+    _init_version_store()
+    if months is None or isinstance(months, str): months = [months]
+    keys = {(table_name, '*' if forest_id is None else str(forest_id), _month_key(m)) for m in months}
+    conn = local_store.connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM data_versions").fetchone()[0]
+        conn.executemany(
+            "INSERT OR REPLACE INTO data_versions (table_name, forest_id, month, version, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [k + (version, time.time()) for k in keys]
+        )
+        conn.commit()
+        return version
+    finally:
+        conn.close()
+
+def get_data_version(table_name, forest_id=None, month=None):
+    """分区当前版本；forest_id / month 为 None 时取更大范围内的最大版本"""
+    _init_version_store()
+    sql, params = "SELECT COALESCE(MAX(version), 0) FROM data_versions WHERE table_name = ?", [table_name]
+    if forest_id is not None:
+        sql += " AND forest_id IN (?, '*')"; params.append(str(forest_id))
+    if month is not None:
+        sql += " AND month IN (?, '*')"; params.append(_month_key(month))
+    conn = local_store.connect()
+    try: return conn.execute(sql, params).fetchone()[0]
+    finally: conn.close()
+
+def get_current_version():
+    _init_version_store()
+    conn = local_store.connect()
+    try: return conn.execute("SELECT COALESCE(MAX(version), 0) FROM data_versions").fetchone()[0]
+    finally: conn.close()
+
+def changes_since(version, table_name=None):
+    """返回版本号 > version 的分区列表 [{table_name, forest_id, month, version}]"""
+    _init_version_store()
+    sql, params = "SELECT table_name, forest_id, month, version FROM data_versions WHERE version > ?", [version]
+    if table_name:
+        sql += " AND table_name = ?"; params.append(table_name)
+    conn = local_store.connect()
+    try: return [dict(r) for r in conn.execute(sql + " ORDER BY version", params).fetchall()]
+    finally: conn.close()
+
+# --- B3. 查询结果缓存 ---
+# 以 (表, 过滤条件, 分区版本) 为 key，所有 session 共享，条目数有上限。
+# 分区没有新写入时直接复用，不再重新请求。
+# PostgREST 单次最多返回 1000 行：按 id 排序分页拉取，直到不满一页，避免多林地 / 整年查询被截断。
+PAGE = 1000
+
+@st.cache_data(max_entries=256, ttl=3600, show_spinner=False)
+def _cached_select(table_name, columns, filters, versions):
+    out, offset = [], 0
+    while True:
+        q = supabase.table(table_name).select(columns)
+        for op, col, val in filters: q = getattr(q, op)(col, val)
+        rows = q.order("id").range(offset, offset + PAGE - 1).execute().data
+        out.extend(rows)
+        if len(rows) < PAGE: return out
+        offset += PAGE
+
+def cached_select(table_name, columns="*", filters=(), depends_on=(), forest_id=None, month=None):
+    """
+    filters: [("eq", "forest_id", 1), ("gte", "date", "2025-01-01"), ...]
+    depends_on: 额外依赖的表 (例如 join 的维度表)，它们的版本变化也会让缓存失效
+    forest_id / month: 查询覆盖的分区，用于取版本号 (None = 整个范围)
+    """
+    # 离线模式 / 数据库不可用：读本地 Parquet 快照
+    if snapshots.active() or not supabase:
+        return snapshots.select(table_name, columns, filters) if snapshots.available(table_name) else []
+    versions = (get_data_version(table_name, forest_id, month),) + tuple(get_data_version(t) for t in depends_on)
+    try:
+        return _cached_select(table_name, columns, tuple(tuple(f) for f in filters), versions)
+    except Exception as e:
+        if not snapshots.available(table_name): raise
+        print(f"Live query failed, using snapshot ({table_name}): {e}")
+        return snapshots.select(table_name, columns, filters)
+
 # --- C. 核心数据函数 ---
 def get_forest_list():
-    if not supabase: return []
+    if snapshots.active() or not supabase:
+        return snapshots.select("dim_forests") if snapshots.available("dim_forests") else []
     try: return supabase.table("dim_forests").select("*").execute().data
-    except: return []
+    except:
+        return snapshots.select("dim_forests") if snapshots.available("dim_forests") else []
+
+MARKETS = ['Export', 'Domestic']
+
+@st.cache_data(max_entries=32, ttl=600, show_spinner=False)
+def _enriched_dims(dim_table, dim_id_col, dim_name_col, version):
+    """
+    维度表预处理 (每个维度表 / 版本只做一次)：
+    统一 id 列名、补 market / customer 默认值，文本列转 category。
+    """
+    df_dims = pd.DataFrame(supabase.table(dim_table).select("*").execute().data)
+    if df_dims.empty: return df_dims
+
+    if dim_name_col not in df_dims.columns and 'activity_name' in df_dims.columns:
+        df_dims[dim_name_col] = df_dims['activity_name']
+
+    cols = ['id', dim_name_col] + (['grade_code'] if 'grade_code' in df_dims.columns and dim_name_col != 'grade_code' else [])
+    out = df_dims[cols + [c for c in ('market', 'customer') if c in df_dims.columns]].rename(columns={'id': dim_id_col})
+
+    if 'market' not in out.columns and 'grade_code' in out.columns:
+        is_dom = out['grade_code'].astype(str).str.contains('Domestic', regex=False)
+        out['market'] = pd.Categorical(is_dom.map({True: 'Domestic', False: 'Export'}), categories=MARKETS)
+    if 'customer' not in out.columns: out['customer'] = 'FCO'
+    out['customer'] = out['customer'].astype('category')
+    return out.reset_index(drop=True)
 
 def get_monthly_data(table_name, dim_table, dim_id_col, dim_name_col, forest_id, target_date, record_type, value_cols):
     if not supabase: return pd.DataFrame()
-    dims = supabase.table(dim_table).select("*").execute().data
-    df_dims = pd.DataFrame(dims)
+    df_dims = _enriched_dims(dim_table, dim_id_col, dim_name_col, get_data_version(dim_table))
     if df_dims.empty: return pd.DataFrame()
-    
-    if dim_name_col not in df_dims.columns and 'activity_name' in df_dims.columns:
-        df_dims[dim_name_col] = df_dims['activity_name']
 
+    # 只取需要的列 (不再 select *)
     try:
-        res = supabase.table(table_name).select("*").eq("forest_id", forest_id).eq("record_type", record_type).eq("month", target_date).execute()
-        df_facts = pd.DataFrame(res.data)
-    except: df_facts = pd.DataFrame()
-    
-    if df_facts.empty:
-        cols_to_keep = ['id', dim_name_col]
-        if 'grade_code' in df_dims.columns: cols_to_keep.append('grade_code')
-        df_merged = df_dims[cols_to_keep].rename(columns={'id': dim_id_col})
-        for c in value_cols: df_merged[c] = 0.0
-    else:
-        df_merged = pd.merge(df_dims, df_facts, left_on='id', right_on=dim_id_col, how='left')
-        for c in value_cols: df_merged[c] = df_merged[c].fillna(0.0)
-    
-    df_merged = df_merged.loc[:, ~df_merged.columns.duplicated()]
-    df_merged = df_merged.reset_index(drop=True)
+        res = supabase.table(table_name).select(f"{dim_id_col}, {', '.join(value_cols)}, row_version")\
+            .eq("forest_id", forest_id).eq("record_type", record_type).eq("month", target_date).execute()
+        df_facts = pd.DataFrame(res.data, columns=[dim_id_col] + value_cols + ['row_version'])
+    except: df_facts = pd.DataFrame(columns=[dim_id_col] + value_cols + ['row_version'])
 
-    if 'market' not in df_merged.columns and 'grade_code' in df_merged.columns:
-        df_merged['market'] = df_merged['grade_code'].apply(lambda x: 'Domestic' if 'Domestic' in str(x) else 'Export')
-    if 'customer' not in df_merged.columns: df_merged['customer'] = 'FCO' 
+    df_merged = df_dims.merge(df_facts, on=dim_id_col, how='left')
+    df_merged[value_cols] = df_merged[value_cols].apply(pd.to_numeric, errors='coerce').fillna(0.0)
     return df_merged
 
-def save_monthly_data(edited_df, table_name, dim_id_col, forest_id, target_date, record_type):
+def save_monthly_data(edited_df, table_name, dim_id_col, forest_id, target_date, record_type, base=None):
+    """
+    base: 打开表格时读到的 DataFrame (get_monthly_data 的结果，含 row_version)。
+    给了 base 时按行版本条件写入，返回 row_versions.SaveResult (冲突逐行返回，不覆盖)；否则整页 upsert，返回 True / False。
+    """
     if not supabase or edited_df.empty: return False
+    if period_close.locks(record_type): period_close.assert_open(forest_id, target_date)    # 已关账的月份直接拒绝 (抛 PeriodLockedError)
     records = []
     for _, row in edited_df.iterrows():
         # 安全处理：确保 ID 存在
@@ -83,13 +218,83 @@ def save_monthly_data(edited_df, table_name, dim_id_col, forest_id, target_date,
                     val = 0.0
                 rec[col] = val
         records.append(rec)
+    if base is not None:
+        base = base.assign(forest_id=forest_id, month=target_date, record_type=record_type)
+        return row_versions.save(table_name, forest_id, records, base, target_date)
     try:
+        # 修改日志需要旧值：同一 林地-月-类型 一次读取
+        fields = [c for c in change_log.TRACKED[table_name][1] if any(c in r for r in records)] if table_name in change_log.TRACKED else []
+        old = supabase.table(table_name).select(", ".join([dim_id_col, "record_type"] + fields))\
+            .eq("forest_id", forest_id).eq("month", target_date).eq("record_type", record_type).execute().data if fields else []
         supabase.table(table_name).upsert(records, on_conflict=f"forest_id,{dim_id_col},month,record_type").execute()
+        bump_data_version(table_name, forest_id, target_date)
+        if fields: change_log.log_changes(table_name, forest_id, old, records, target_date)
         return True
     except Exception as e:
         print(f"Save Error: {e}")
         return False
 
+def get_yearly_data(table_name, dim_table, dim_id_col, dim_name_col, forest_id, year, record_type, value_cols):
+    """
+    一次读取整年 (12 个月) -> 长表: dim_id_col, dim_name_col, month (1-12), value_cols
+    每个项目 × 月份都有一行，没有数据的填 0。
+    """
+    if not supabase: return pd.DataFrame()
+    df_dims = pd.DataFrame(cached_select(dim_table, f"id, {dim_name_col}"))
+    if df_dims.empty: return pd.DataFrame()
+    df_dims = df_dims.rename(columns={'id': dim_id_col})
+
+    res = supabase.table(table_name).select(f"{dim_id_col}, month, {', '.join(value_cols)}")\
+        .eq("forest_id", forest_id).eq("record_type", record_type)\
+        .gte("month", f"{year}-01-01").lt("month", f"{year + 1}-01-01").execute()
+    df_facts = pd.DataFrame(res.data, columns=[dim_id_col, 'month'] + value_cols)
+
+    df_grid = df_dims.merge(pd.DataFrame({'month': range(1, 13)}), how='cross')
+    if not df_facts.empty:
+        df_facts['month'] = pd.to_datetime(df_facts['month']).dt.month
+        df_facts[value_cols] = df_facts[value_cols].apply(pd.to_numeric, errors='coerce')
+        df_facts = df_facts.groupby([dim_id_col, 'month'], as_index=False)[value_cols].sum()
+        df_grid = df_grid.merge(df_facts, on=[dim_id_col, 'month'], how='left')
+    else:
+        for c in value_cols: df_grid[c] = 0.0
+    df_grid[value_cols] = df_grid[value_cols].fillna(0.0).astype(float)
+    return df_grid
+
+def save_yearly_delta(df_original, df_edited, table_name, dim_id_col, forest_id, year, record_type, value_cols):
+    """
+    只写入有变化的 (项目, 月份) 行：一次 upsert。返回写入行数。
+    df_original / df_edited: get_yearly_data 格式的长表
+    """
+    if not supabase or df_edited.empty: return 0
+    keys = [dim_id_col, 'month']
+    merged = df_edited[keys + value_cols].merge(df_original[keys + value_cols], on=keys, how='left', suffixes=('', '_old'))
+    new_vals = merged[value_cols].apply(pd.to_numeric, errors='coerce').fillna(0.0).to_numpy()
+    old_vals = merged[[f"{c}_old" for c in value_cols]].fillna(0.0).to_numpy()
+    changed = merged[(abs(new_vals - old_vals) > 1e-9).any(axis=1)]
+    if changed.empty: return 0
+    if period_close.locks(record_type):
+        period_close.assert_open(forest_id, [f"{year}-{int(m):02d}-01" for m in changed['month'].unique()])
+
+    records = [
+        dict({"forest_id": forest_id, dim_id_col: int(r[dim_id_col]), "month": f"{year}-{int(r['month']):02d}-01",
+              "record_type": record_type}, **{c: float(r[c] or 0) for c in value_cols})
+        for r in changed.to_dict('records')
+    ]
+    n = upsert_chunked(table_name, records, on_conflict=f"forest_id,{dim_id_col},month,record_type")
+    bump_data_version(table_name, forest_id, sorted({r['month'] for r in records}))
+    if table_name in change_log.TRACKED:
+        old = [dict({k: r[k] for k in ("forest_id", dim_id_col, "month", "record_type")}, **{c: float(o[f"{c}_old"] or 0) for c in value_cols})
+               for r, o in zip(records, changed.to_dict('records'))]
+        change_log.log_changes(table_name, forest_id, old, records)
+    return n
+
+def upsert_chunked(table_name, records, on_conflict, chunk_size=500):
+    """大批量写入：分块 upsert，返回写入行数 (出错直接抛出)"""
+    if not supabase or not records: return 0
+    for i in range(0, len(records), chunk_size):
+        supabase.table(table_name).upsert(records[i:i + chunk_size], on_conflict=on_conflict).execute()
+    return len(records)
+
 # --- D. 发票 HTML 生成 ---
 def generate_invoice_html(invoice_no, invoice_date, bill_to, month_str, year, items, subtotal, gst_val, total_due):
     rows_html = ""
@@ -101,7 +306,26 @@ def generate_invoice_html(invoice_no, invoice_date, bill_to, month_str, year, it
     """
 
 # --- E. AI 识别核心逻辑 ---
-def real_extract_invoice_data(file_obj):
+AI_MAX_RETRIES = 2
+_TRANSIENT_ERRORS = ("429", "500", "503", "deadline", "timeout", "unavailable", "resource exhausted")
+
+def _generate_with_retry(model, parts, stats):
+    # 限流 / 服务端临时错误：指数退避重试，重试次数记入 stats
+    for attempt in range(AI_MAX_RETRIES + 1):
+        try:
+            return model.generate_content(parts)
+        except Exception as e:
+            if attempt == AI_MAX_RETRIES or not any(k in str(e).lower() for k in _TRANSIENT_ERRORS): raise
+            stats['retries'] = attempt + 1
+            time.sleep(2 ** attempt)
+
+def real_extract_invoice_data(file_obj, stats=None):
+    """
+    stats: 可选 dict (见 ai_usage.new_stats)，原地填写
+    模型 / 耗时 / token 数 / PDF 字节数 / 重试次数
+    """
+    stats = stats if stats is not None else {}
+    t0 = time.perf_counter()
     try:
         if not check_google_key():
             return [{"vendor_detected": "Error", "error_msg": "API Key missing", "amount_detected": 0, "filename": file_obj.name}]
@@ -114,6 +338,8 @@ def real_extract_invoice_data(file_obj):
         
         file_obj.seek(0)
         file_bytes = file_obj.read()
+        stats['model'] = getattr(model, 'model_name', None)
+        stats['pdf_bytes'] = len(file_bytes)
         
         prompt_text = """
         Analyze this PDF file. It contains MULTIPLE distinct invoices.
@@ -131,10 +357,14 @@ def real_extract_invoice_data(file_obj):
         ]
         """
         
-        response = model.generate_content([
+        response = _generate_with_retry(model, [
             {'mime_type': 'application/pdf', 'data': file_bytes},
             prompt_text
-        ])
+        ], stats)
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            stats['input_tokens'] = getattr(usage, 'prompt_token_count', 0) or 0
+            stats['output_tokens'] = getattr(usage, 'candidates_token_count', 0) or 0
         
         raw_text = response.text
         match = re.search(r'\[.*\]', raw_text, re.DOTALL)
@@ -170,6 +400,8 @@ def real_extract_invoice_data(file_obj):
 
     except Exception as e:
         return [{"filename": file_obj.name, "vendor_detected": "Error", "error_msg": str(e), "amount_detected": 0}]
+    finally:
+        stats['latency_ms'] = (time.perf_counter() - t0) * 1000
 
 # --- F. 调试函数 ---
 def list_available_models():
@@ -186,7 +418,7 @@ def get_gl_mapping(forest_id):
     if not supabase: return {}, {}
     
     try:
-        data = supabase.table("dim_gl_mappings").select("*").eq("forest_id", forest_id).execute().data
+        data = cached_select("dim_gl_mappings", filters=[("eq", "forest_id", forest_id)], forest_id=forest_id)
         
         cost_map = {}
         rev_map = {}
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+import backend
+import period_close
+import change_log
+
+# --- 预算情景 (Budget Scenarios) ---
+# 情景和正式预算存在同一张事实表里，只是 record_type 不同 ("Scenario:<名称>")，
+# 只存该情景自己的行，不复制整张表。生成过程全部在内存数组里完成，最后一次分块 upsert。
+
+SCENARIO_PREFIX = "Scenario:"
+
+# kind -> (事实表, 项目 id 列, 维度表, 名称列, 可加总列, 单价列, 用于季节分布的列)
+SOURCES = {
+    "Revenue": ("fact_production_volume", "grade_id", "dim_products", "grade_code",
+                ['vol_tonnes', 'vol_jas', 'amount'], ['price_jas'], 'amount'),
+    "Cost": ("fact_operational_costs", "activity_id", "dim_cost_activities", "activity_name",
+             ['quantity', 'total_amount'], ['unit_rate'], 'total_amount'),
+}
+# uplift 作用在金额 / 单价上，数量列保持不变
+UPLIFT_COLS = {'amount', 'price_jas', 'total_amount', 'unit_rate'}
+# 单价列 -> 对应的数量列 (加权平均单价用)
+RATE_WEIGHT = {'price_jas': 'vol_jas', 'unit_rate': 'quantity'}
+
+PROFILES = ["Prior-year seasonality", "Flat (1/12)"]
+
+def scenario_record_type(name):
+    return name if name == "Budget" else f"{SCENARIO_PREFIX}{name}"
+
+def list_scenarios(year=None):
+    """情景登记表 budget_scenarios (name, year, source, created_at)"""
+    if not backend.supabase: return []
+    try:
+        q = backend.supabase.table("budget_scenarios").select("*").order("created_at", desc=True)
+        if year: q = q.eq("year", year)
+        return q.execute().data
+    except Exception as e:
+        print(f"Scenario list error: {e}")
+        return []
+
+def _load_cube(kind, year, record_type, forests):
+    table, item_col, dim_table, name_col, add_cols, rate_cols, _ = SOURCES[kind]
+    cols = add_cols + rate_cols
+    dims = backend.cached_select(dim_table, f"id, {name_col}")
+    items = [d['id'] for d in dims]
+    rows = backend.cached_select(
+        table, f"forest_id, {item_col}, month, {', '.join(cols)}",
+        filters=[("gte", "month", f"{year}-01-01"), ("lt", "month", f"{year + 1}-01-01"), ("eq", "record_type", record_type)])
+    cube = {c: np.zeros((len(forests), len(items), 12)) for c in cols}
+    if rows:
+        df = pd.DataFrame(rows)
+        f_idx = df['forest_id'].map({f: i for i, f in enumerate(forests)})
+        i_idx = df[item_col].map({it: i for i, it in enumerate(items)})
+        ok = f_idx.notna() & i_idx.notna()
+        idx = (f_idx[ok].astype(int).to_numpy(), i_idx[ok].astype(int).to_numpy(),
+               (pd.to_datetime(df.loc[ok, 'month']).dt.month - 1).to_numpy())
+        for c in cols:
+            if c in df.columns:
+                np.add.at(cube[c], idx, pd.to_numeric(df.loc[ok, c], errors='coerce').fillna(0.0).to_numpy())
+    return items, dims, cube
+
+def generate(kind, year, source_year, source_type, uplifts=None, default_uplift=0.0, profile=PROFILES[0]):
+    """
+    在内存中生成一个情景，返回 (forests, items, dims, cube)；cube 每列形状 [forest, item, 12]。
+    uplifts: {item_id: pct}，未列出的项目用 default_uplift (百分比，例如 5 表示 +5%)
+    """
+    forests = [f['id'] for f in backend.get_forest_list()]
+    items, dims, src = _load_cube(kind, source_year, source_type, forests)
+    add_cols, rate_cols, shape_col = SOURCES[kind][4:]
+
+    pct = np.full(len(items), float(default_uplift))
+    for it, p in (uplifts or {}).items():
+        if it in items and p is not None: pct[items.index(it)] = float(p)
+    factor = (1 + pct / 100.0)[None, :, None]                      # [1, I, 1]
+
+    # 季节分布：按上一年该项目金额的月度占比；全年为 0 的项目退化为平均分布
+    if profile == PROFILES[0]:
+        base = src[shape_col]
+        total = base.sum(axis=2, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shape = np.where(total > 0, base / total, 1.0 / 12)
+    else:
+        shape = np.full(src[shape_col].shape, 1.0 / 12)
+
+    out = {}
+    for c in add_cols:
+        annual = src[c].sum(axis=2, keepdims=True)
+        out[c] = annual * shape * (factor if c in UPLIFT_COLS else 1.0)
+    for c in rate_cols:
+        # 单价不分摊：取全年平均单价 (按数量加权) × uplift
+        qty = src[RATE_WEIGHT[c]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg = np.where(qty.sum(axis=2, keepdims=True) > 0,
+                           (src[c] * qty).sum(axis=2, keepdims=True) / qty.sum(axis=2, keepdims=True),
+                           src[c].max(axis=2, keepdims=True))
+        rate = src[c] if profile == PROFILES[0] else np.broadcast_to(avg, src[c].shape)
+        out[c] = np.where(out[RATE_WEIGHT[c]] != 0, np.where(rate != 0, rate, avg), 0.0) * factor
+    return forests, items, dims, out
+
+def to_records(kind, year, record_type, forests, items, cube):
+    """数组 -> upsert 记录 (只保留有值的行)"""
+    item_col = SOURCES[kind][1]
+    cols = list(cube.keys())
+    stacked = np.stack([cube[c] for c in cols], axis=-1)           # [F, I, 12, C]
+    f_i, i_i, m_i = np.nonzero(np.abs(stacked).sum(axis=-1) > 0)
+    vals = np.round(stacked[f_i, i_i, m_i], 2)
+    return [
+        dict({"forest_id": forests[f], item_col: items[i], "month": f"{year}-{m + 1:02d}-01", "record_type": record_type},
+             **{c: float(v) for c, v in zip(cols, row)})
+        for f, i, m, row in zip(f_i, i_i, m_i, vals)
+    ]
+
+def summarize(kind, forests, cube):
+    """每个林地的全年金额汇总，用于写入前预览"""
+    shape_col = SOURCES[kind][6]
+    return pd.DataFrame({"forest_id": forests, "annual": cube[shape_col].sum(axis=(1, 2)) if forests else []})
+
+def delete_scenario(name, year):
+    record_type = scenario_record_type(name)
+    if record_type == "Budget": return
+    for table, *_ in SOURCES.values():
+        backend.supabase.table(table).delete().eq("record_type", record_type)\
+            .gte("month", f"{year}-01-01").lt("month", f"{year + 1}-01-01").execute()
+        backend.bump_data_version(table)
+    backend.supabase.table("budget_scenarios").delete().eq("name", name).eq("year", year).execute()
+
+def _budget_rows(table, item_col, year, forests):
+    """覆盖前的正式 Budget (修改日志的旧值)"""
+    fields = change_log.TRACKED[table][1]
+    out, offset = [], 0
+    while True:
+        page = backend.supabase.table(table).select(", ".join(["forest_id", item_col, "month", "record_type"] + fields))\
+            .eq("record_type", "Budget").in_("forest_id", list(forests))\
+            .gte("month", f"{year}-01-01").lt("month", f"{year + 1}-01-01")\
+            .order("id").range(offset, offset + 999).execute().data
+        out.extend(page)
+        if len(page) < 1000: return out
+        offset += 1000
+
+def _log_budget(table, old, records):
+    """按 林地-月 记修改日志 (行键里没有月份，必须分组)"""
+    groups = {}
+    for r in old: groups.setdefault((r['forest_id'], str(r['month'])[:10]), ([], []))[0].append(r)
+    for r in records: groups.setdefault((r['forest_id'], r['month']), ([], []))[1].append(r)
+    for (fid, month), (o, n) in groups.items():
+        if n: change_log.log_changes(table, fid, o, n, month)
+
+def _leftover_ids(table, item_col, year, record_type, records):
+    """同名情景里这次没有再写到的旧行 id (新结果里没有值的 林地 × 项目 × 月)"""
+    keep = {(r['forest_id'], r[item_col], r['month']) for r in records}
+    out, offset = [], 0
+    while True:
+        page = backend.supabase.table(table).select(f"id, forest_id, {item_col}, month").eq("record_type", record_type)\
+            .gte("month", f"{year}-01-01").lt("month", f"{year + 1}-01-01")\
+            .order("id").range(offset, offset + 999).execute().data
+        out.extend(r['id'] for r in page if (r['forest_id'], r[item_col], str(r['month'])[:10]) not in keep)
+        if len(page) < 1000: return out
+        offset += 1000
+
+def save_scenario(name, year, source_label, results):
+    """
+    results: {kind: (forests, items, cube)}，一次分块 upsert 写入所有林地 / 月份。
+    同名情景先写新结果，成功后再删掉这次没写到的旧行 (写入失败时旧情景保持完整)；
+    正式 Budget 只覆盖有值的行。返回写入行数。
+    """
+    record_type = scenario_record_type(name)
+    if record_type == "Budget":
+        # 覆盖正式 Budget 时，已关账的月份不允许改
+        for fid in {f for forests, _, _ in results.values() for f in forests}:
+            period_close.assert_open(fid, [f"{year}-{m:02d}-01" for m in range(1, 13)])
+    total = 0
+    for kind, (forests, items, cube) in results.items():
+        table, item_col = SOURCES[kind][0], SOURCES[kind][1]
+        records = to_records(kind, year, record_type, forests, items, cube)
+        old = _budget_rows(table, item_col, year, forests) if record_type == "Budget" else []
+        total += backend.upsert_chunked(table, records, on_conflict=f"forest_id,{item_col},month,record_type")
+        if record_type != "Budget":
+            stale = _leftover_ids(table, item_col, year, record_type, records)
+            for i in range(0, len(stale), 500):
+                backend.supabase.table(table).delete().in_("id", stale[i:i + 500]).execute()
+            if stale: backend.bump_data_version(table)
+        for fid in forests:
+            backend.bump_data_version(table, fid, [f"{year}-{m:02d}-01" for m in range(1, 13)])
+        if record_type == "Budget": _log_budget(table, old, records)
+    if record_type != "Budget":
+        backend.supabase.table("budget_scenarios").upsert(
+            {"name": name, "year": year, "source": source_label, "created_at": datetime.now().isoformat()},
+            on_conflict="name,year").execute()
+    return total
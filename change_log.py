@@ -0,0 +1,303 @@
+import streamlit as st
+import io
+import os
+import time
+import uuid
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import local_store
+import backend
+import frames
+
+# --- 修改日志 (Append-only Change Log) ---
+# 每次保存只记录真正变了的单元格：谁、什么时候、哪张表 / 哪一行 / 哪个字段、旧值 → 新值。
+# 写入路径：保存时先批量写进本地 SQLite 发件箱 (一次本地事务，几毫秒)，
+#   后台线程再按批 insert 到 Supabase change_log 表，不拖慢保存；进程重启后发件箱里的会继续推送。
+# 旧记录定期归档成 Parquet (按 表 / 林地 / 数据月份 一个文件) 放到 Storage，再从表里删除。
+# as_of() 用 当前值 + 之后的修改 (取每个单元格在该时间点之后第一次修改的旧值) 还原任意 林地-月 在某个时间点的数据。
+#
+# change_log: id, changed_at, changed_by, batch_id, table_name, forest_id, month, row_key, field, old_value, new_value
+#   索引 (table_name, forest_id, month, changed_at)；值统一存文本，field = '*' 表示新增整行
+
+BUCKET = "change-log"
+ARCHIVE_DIR = os.path.join(local_store.DATA_DIR, "change_log")
+BATCH = 500
+FLUSH_INTERVAL = 5
+ARCHIVE_AFTER_DAYS = 180
+
+# 每张表的行键和需要跟踪的字段
+TRACKED = {
+    "fact_operational_costs": (["activity_id", "record_type"], ["quantity", "unit_rate", "total_amount"]),
+    "fact_production_volume": (["grade_id", "record_type"], ["vol_tonnes", "vol_jas", "price_jas", "amount"]),
+    "actual_sales_transactions": (["id"], ["date", "ticket_number", "compartment", "sale_type", "grade_id", "customer", "market",
+                                           "net_tonnes", "jas", "price", "levy_deduction", "total_value", "price_book_id"]),
+}
+COLS = ["changed_at", "changed_by", "batch_id", "table_name", "forest_id", "month", "row_key", "field", "old_value", "new_value"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS change_log_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    changed_at TEXT NOT NULL,
+    changed_by TEXT,
+    batch_id TEXT,
+    table_name TEXT NOT NULL,
+    forest_id INTEGER,
+    month TEXT,
+    row_key TEXT NOT NULL,
+    field TEXT NOT NULL,
+    old_value TEXT,
+    new_value TEXT
+);
+"""
+
+def current_user():
+    try: return st.session_state.get("user_name") or "unknown"
+    except Exception: return "unknown"
+
+def row_key(table_name, row):
+    keys, _ = TRACKED[table_name]
+    return "|".join(f"{k}={row.get(k)}" for k in keys)
+
+def _text(v):
+    if v is None or (isinstance(v, float) and np.isnan(v)): return None
+    if isinstance(v, (float, np.floating)): return repr(float(v))
+    if isinstance(v, (int, np.integer)): return str(int(v))
+    return str(v)
+
+def _same(a, b):
+    if a is None or b is None: return a is None and b is None
+    try: return abs(float(a) - float(b)) < 1e-9
+    except (TypeError, ValueError): return a == b
+
+# --- A. 生成修改记录 ---
+def diff(table_name, forest_id, old_rows, new_rows, month=None):
+    """
+    old_rows / new_rows: list of dict (或 DataFrame)，按 TRACKED 的行键对齐。
+    month: 固定的数据月份；为 None 时取每行的 month / date 列。
+    返回只包含变化单元格的记录 list；old_rows 里没有的行记一条 field='*' 的新增。
+    """
+    keys, fields = TRACKED[table_name]
+    if isinstance(old_rows, pd.DataFrame): old_rows = old_rows.to_dict('records')
+    if isinstance(new_rows, pd.DataFrame): new_rows = new_rows.to_dict('records')
+    old = {row_key(table_name, r): r for r in old_rows or []}
+    now, user = datetime.now().isoformat(), current_user()
+    out = []
+    for r in new_rows or []:
+        k = row_key(table_name, r)
+        m = month or r.get('month') or r.get('date')
+        m = f"{str(m)[:7]}-01" if m else None
+        base = {"changed_at": now, "changed_by": user, "table_name": table_name, "forest_id": forest_id, "month": m, "row_key": k}
+        o = old.get(k)
+        if o is None:
+            out.append(dict(base, field="*", old_value=None, new_value="insert"))
+            o = {}
+        for f in fields:
+            if f not in r: continue
+            a, b = _text(o.get(f)), _text(r.get(f))
+            if not _same(a, b): out.append(dict(base, field=f, old_value=a, new_value=b))
+    return out
+
+def record(entries):
+    """写入本地发件箱 (一个批次共用 batch_id)，由后台线程推送；返回记录条数"""
+    if not entries: return 0
+    local_store.ensure_schema(_SCHEMA)
+    batch_id = uuid.uuid4().hex[:12]
+    conn = local_store.connect()
+    try:
+        conn.executemany(f"INSERT INTO change_log_outbox ({','.join(COLS)}) VALUES ({','.join('?' * len(COLS))})",
+                         [[dict(e, batch_id=batch_id).get(c) for c in COLS] for e in entries])
+        conn.commit()
+    finally:
+        conn.close()
+    try: get_flusher().notify()
+    except Exception as e: print(f"Change log flusher error: {e}")
+    return len(entries)
+
+def log_changes(table_name, forest_id, old_rows, new_rows, month=None):
+    """保存成功后调用：diff + record，日志出错不影响保存"""
+    try: return record(diff(table_name, forest_id, old_rows, new_rows, month))
+    except Exception as e:
+        print(f"Change log error ({table_name}): {e}")
+        return 0
+
+# --- B. 后台推送 ---
+_flush_lock = threading.Lock()      # 后台线程和手动 flush 不能同时推同一批
+
+def flush(limit=BATCH):
+    """把发件箱里最早的一批推送到 change_log，返回推送条数 (失败抛出，记录保留)"""
+    if not backend.supabase: return 0
+    local_store.ensure_schema(_SCHEMA)
+    with _flush_lock:
+        return _push(limit)
+
+def _push(limit):
+    conn = local_store.connect()
+    try:
+        rows = [dict(r) for r in conn.execute(f"SELECT id, {','.join(COLS)} FROM change_log_outbox ORDER BY id LIMIT ?", (limit,))]
+        if not rows: return 0
+        backend.supabase.table("change_log").insert([{c: r[c] for c in COLS} for r in rows]).execute()
+        conn.execute("DELETE FROM change_log_outbox WHERE id <= ?", (rows[-1]['id'],))
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+def flush_all():
+    n = 0
+    while True:
+        k = flush()
+        n += k
+        if k < BATCH: return n
+
+class _Flusher:
+    def __init__(self):
+        self._wake = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="change-log-flusher", daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(timeout=FLUSH_INTERVAL)
+            self._wake.clear()
+            try: flush_all()
+            except Exception as e:
+                print(f"Change log push failed (will retry): {e}")
+                time.sleep(FLUSH_INTERVAL)
+
+@st.cache_resource
+def get_flusher():
+    # 进程级单例
+    return _Flusher()
+
+def pending():
+    local_store.ensure_schema(_SCHEMA)
+    conn = local_store.connect()
+    try: return conn.execute("SELECT COUNT(*) FROM change_log_outbox").fetchone()[0]
+    finally: conn.close()
+
+# --- C. 归档 (Parquet) ---
+def _archive_path(table_name, forest_id, month):
+    return f"{table_name}/{forest_id}/{str(month)[:7]}.parquet"
+
+def _is_missing(e):
+    """Storage 里还没有这个文件 (404)；其它错误 (网络 / 5xx) 不能当成空文件"""
+    status = getattr(e, "status", None) or getattr(e, "status_code", None) or getattr(e, "statusCode", None)
+    msg = str(e).lower()
+    return str(status) == "404" or "not found" in msg or "not_found" in msg or "does not exist" in msg
+
+def _download(path):
+    try: data = backend.supabase.storage.from_(BUCKET).download(path)
+    except Exception as e:
+        if _is_missing(e): return pd.DataFrame(columns=COLS)
+        raise
+    return pq.read_table(io.BytesIO(data)).to_pandas()
+
+def archive(older_than_days=ARCHIVE_AFTER_DAYS, log=print):
+    """
+    把早于 N 天的记录按 表 / 林地 / 月份 追加进 Parquet 文件，返回归档条数。
+    每个文件 读取 -> 合并 -> 上传 都成功后才删除表里对应的记录；下载 / 上传出错直接抛出，
+    已完成的文件保持已删除，剩下的记录留在表里下次再归档。
+    """
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+    rows, offset = [], 0
+    while True:
+        page = backend.supabase.table("change_log").select("*").lt("changed_at", cutoff)\
+            .order("id").range(offset, offset + 999).execute().data
+        rows.extend(page)
+        if len(page) < 1000: break
+        offset += 1000
+    if not rows: return 0
+    df = pd.DataFrame(rows)
+    bucket = backend.supabase.storage.from_(BUCKET)
+    done = 0
+    for (t, f, m), g in df.groupby(['table_name', 'forest_id', 'month'], dropna=False):
+        path = _archive_path(t, f, m)
+        merged = pd.concat([_download(path), g], ignore_index=True).drop_duplicates('id').sort_values('changed_at')
+        buf = io.BytesIO()
+        pq.write_table(pa.Table.from_pandas(merged.astype({c: "string" for c in COLS if c != "forest_id"}), preserve_index=False), buf, compression="zstd")
+        bucket.upload(path, buf.getvalue(), {"content-type": "application/octet-stream", "upsert": "true"})
+        backend.bump_data_version("change_log_archive", f, m)
+        ids = sorted(g['id'])
+        for i in range(0, len(ids), 500):
+            backend.supabase.table("change_log").delete().in_("id", ids[i:i + 500]).execute()
+        done += len(ids)
+        log(f"{path}: +{len(g)} rows")
+    return done
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _archived(table_name, forest_id, month, version):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    local = os.path.join(ARCHIVE_DIR, _archive_path(table_name, forest_id, month).replace("/", "_").replace(".parquet", f"_{version}.parquet"))
+    if os.path.exists(local): return pd.read_parquet(local)
+    df = _download(_archive_path(table_name, forest_id, month))
+    if not df.empty: df.to_parquet(local, index=False)
+    return df
+
+# --- D. 查询 / 还原 ---
+def _paged(query):
+    """query(): 返回新的查询 builder；按 id 分页拉全 (单次最多 1000 行)，结果按插入顺序"""
+    out, offset = [], 0
+    while True:
+        page = query().order("id").range(offset, offset + 999).execute().data
+        out.extend(page)
+        if len(page) < 1000: return out
+        offset += 1000
+
+def history(table_name, forest_id, month, since=None):
+    """某个 林地-月 的修改记录 (表里 + 归档)，按时间排序"""
+    month = f"{str(month)[:7]}-01"
+    def query():
+        q = backend.supabase.table("change_log").select(",".join(COLS))\
+            .eq("table_name", table_name).eq("forest_id", forest_id).eq("month", month)
+        return q.gt("changed_at", since) if since else q
+    live = pd.DataFrame(_paged(query), columns=COLS)
+    arch = _archived(table_name, forest_id, month, backend.get_data_version("change_log_archive", forest_id, month))
+    if not arch.empty:
+        arch = arch.reindex(columns=COLS)
+        if since: arch = arch[arch['changed_at'] > str(since)]
+    df = pd.concat([arch, live], ignore_index=True) if not arch.empty else live
+    return df.sort_values('changed_at', kind='stable').reset_index(drop=True)
+
+def _current(table_name, forest_id, month):
+    end = f"{int(month[:4]) + (month[5:7] == '12')}-{int(month[5:7]) % 12 + 1:02d}-01"
+    def query():
+        q = backend.supabase.table(table_name).select("*").eq("forest_id", forest_id)
+        return q.gte("date", month).lt("date", end) if table_name == "actual_sales_transactions" else q.eq("month", month)
+    return _paged(query)
+
+def as_of(table_name, forest_id, month, at):
+    """
+    还原 林地-月 在时间点 at (ISO 字符串 / datetime) 的数据，返回 DataFrame (行键 + 跟踪字段)。
+    at 之后新增的行会去掉；值为文本还原，数值列再转回 float。
+    """
+    try: flush_all()            # 先把本进程发件箱里的推上去，保证查到的是完整日志
+    except Exception as e: print(f"Change log flush before as_of failed: {e}")
+    month = f"{str(month)[:7]}-01"
+    at = at.isoformat() if hasattr(at, "isoformat") else str(at)
+    keys, fields = TRACKED[table_name]
+    cur = pd.DataFrame(_current(table_name, forest_id, month))
+    cur = cur.reindex(columns=list(dict.fromkeys(keys + fields)))
+    if not cur.empty: cur.index = [row_key(table_name, r) for r in cur.to_dict('records')]
+    later = history(table_name, forest_id, month, since=at)
+    if later.empty: return cur.reset_index(drop=True)
+
+    # 每个 (行, 字段) 在 at 之后第一次修改前的旧值
+    first = later.drop_duplicates(['row_key', 'field'], keep='first')
+    created = set(first.loc[first['field'] == '*', 'row_key'])
+    cur = cur.drop(index=[k for k in cur.index if k in created])
+    for r in first[first['field'] != '*'].itertuples():
+        if r.row_key in cur.index and r.field in cur.columns:
+            cur[r.field] = cur[r.field].astype(object)
+            cur.at[r.row_key, r.field] = r.old_value
+    # 日志里是文本，按表结构把数值列转回来
+    kinds = frames.SCHEMAS.get(table_name, {})
+    for f in fields:
+        if kinds.get(f) in ("float32", "float64", "Int32"): cur[f] = pd.to_numeric(cur[f], errors='coerce')
+    return cur.reset_index(drop=True)
@@ -0,0 +1,197 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+import time
+import local_store
+import backend
+import snapshots
+
+# --- Compartment 主数据 + 月度汇总 ---
+# dim_compartments: 每个林地自己的 compartment 列表及林分属性，(forest_id, code) 唯一
+#   id, forest_id, code, name, area_ha, species, plant_year, stand_type, status ('Active' / 'Harvested' / ...)
+# 查找：按林地建 code -> 记录 的字典索引 (按数据版本缓存)，下拉框和导入 / 粘贴的值都走这里规范化。
+# 汇总：票据按 林地 × compartment × 月 预聚合 (tickets / tonnes / JAS / value) 存本地 SQLite，
+#   每个 林地-月 记下汇总时的数据版本，只重算版本变了的月份，查询不再扫全部票据。
+
+GENERAL = "General"     # 不属于任何 compartment 的票据
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS compartment_rollups (
+    forest_id INTEGER NOT NULL,
+    compartment TEXT NOT NULL,
+    month TEXT NOT NULL,
+    tickets INTEGER NOT NULL,
+    tonnes REAL NOT NULL,
+    jas REAL NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (forest_id, compartment, month)
+);
+CREATE INDEX IF NOT EXISTS idx_compartment_rollups_month ON compartment_rollups(forest_id, month);
+CREATE TABLE IF NOT EXISTS compartment_rollup_state (
+    forest_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    built_at REAL,
+    PRIMARY KEY (forest_id, month)
+);
+"""
+
+ATTRS = ["code", "name", "area_ha", "species", "plant_year", "stand_type", "status"]
+
+# --- A. 主数据 / 索引 ---
+def normalize(values):
+    """'60810.0' / ' 60810 ' / 60810 -> '60810'；空值 -> None (向量化，导入和粘贴共用)"""
+    s = pd.Series(values, dtype=object)
+    out = s.astype(str).str.strip().str.replace(r"\.0+$", "", regex=True)
+    return out.where(s.notna() & ~out.str.upper().isin(["", "NAN", "NONE"]), None)
+
+def _keys(values):
+    """查找用的 key：规范化后再忽略大小写"""
+    return normalize(values).str.upper()
+
+def get_compartments(forest_id):
+    """该林地的 compartment 主数据 (DataFrame，按 code 排序)"""
+    rows = backend.cached_select("dim_compartments", "*", filters=[("eq", "forest_id", forest_id)], forest_id=forest_id)
+    df = pd.DataFrame(rows, columns=["id", "forest_id"] + ATTRS) if not rows else pd.DataFrame(rows)
+    if not df.empty: df = df.sort_values("code", kind="stable").reset_index(drop=True)
+    return df
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _index(forest_id, version):
+    df = get_compartments(forest_id)
+    if df.empty: return {}
+    keys = _keys(df['code'])
+    return {k: r for k, r in zip(keys, df.to_dict('records')) if k}
+
+def index(forest_id):
+    """规范化 code (大写) -> 主数据记录"""
+    version = backend.get_data_version("dim_compartments", forest_id)
+    if snapshots.active() or not backend.supabase: version = (version, "snapshot", snapshots.stamp("dim_compartments"))
+    return _index(forest_id, version)
+
+def options(forest_id, include_inactive=False):
+    """下拉框选项：该林地的 compartment code (默认只含 Active) + General"""
+    idx = index(forest_id)
+    codes = [r['code'] for r in idx.values() if include_inactive or (r.get('status') or "Active") == "Active"]
+    return codes + [GENERAL]
+
+def resolve(forest_id, values):
+    """
+    把导入 / 粘贴的 compartment 值映射到主数据里的 code，返回 (codes, unknown)：
+      codes: 与 values 等长的 Series，找不到的保留规范化后的原值，空值为 General
+      unknown: 主数据里没有的值 (排序去重)
+    """
+    idx = index(forest_id)
+    keys = _keys(values)
+    lookup = {k: r['code'] for k, r in idx.items()}
+    lookup[GENERAL.upper()] = GENERAL
+    codes = keys.map(lookup)
+    unknown = sorted(set(keys[codes.isna() & keys.notna()]))
+    return codes.fillna(normalize(values)).fillna(GENERAL), unknown
+
+def save_compartments(forest_id, df):
+    """upsert 主数据 (按 forest_id + code)，返回写入条数"""
+    df = df.reindex(columns=ATTRS)
+    df['code'] = normalize(df['code'])
+    df = df[df['code'].notna()]
+    df = df[~_keys(df['code']).duplicated(keep='last')]
+    if _keys(df['code']).eq(GENERAL.upper()).any(): raise ValueError(f"'{GENERAL}' is reserved")
+    df['area_ha'] = pd.to_numeric(df['area_ha'], errors='coerce')
+    df['plant_year'] = pd.to_numeric(df['plant_year'], errors='coerce').astype("Int32")
+    df['status'] = df['status'].fillna("Active")
+    recs = [{k: (None if pd.isna(v) else (int(v) if k == 'plant_year' else v)) for k, v in r.items()}
+            for r in df.astype(object).to_dict('records')]
+    for r in recs: r['forest_id'] = forest_id
+    if not recs: return 0
+    backend.supabase.table("dim_compartments").upsert(recs, on_conflict="forest_id,code").execute()
+    backend.bump_data_version("dim_compartments", forest_id)
+    return len(recs)
+
+# --- B. 月度汇总 (预聚合，按版本增量刷新) ---
+def _aggregate(rows, forest_id):
+    if not rows: return pd.DataFrame(columns=["month", "compartment", "tickets", "tonnes", "jas", "value"])
+    df = pd.DataFrame(rows)
+    codes, _ = resolve(forest_id, df['compartment'] if 'compartment' in df else [None] * len(df))
+    df = pd.DataFrame({
+        "month": df['date'].astype(str).str[:7] + "-01",
+        "compartment": codes.values,
+        "tonnes": pd.to_numeric(df['net_tonnes'], errors='coerce').fillna(0.0),
+        "jas": pd.to_numeric(df['jas'], errors='coerce').fillna(0.0),
+        "value": pd.to_numeric(df['total_value'], errors='coerce').fillna(0.0),
+    })
+    return df.groupby(['month', 'compartment'], as_index=False).agg(
+        tickets=('tonnes', 'size'), tonnes=('tonnes', 'sum'), jas=('jas', 'sum'), value=('value', 'sum'))
+
+def refresh(forest_id, year):
+    """
+    重算版本有变化的月份，返回重算的月份数。
+    版本号全局递增，取 max(票据分区版本, 主数据版本)：改了 compartment 主数据 (code 规范化结果可能变) 也会重算。
+    """
+    local_store.ensure_schema(_SCHEMA)
+    months = [f"{year}-{m:02d}-01" for m in range(1, 13)]
+    dim_v = backend.get_data_version("dim_compartments", forest_id)
+    versions = {m: max(backend.get_data_version("actual_sales_transactions", forest_id, m), dim_v) for m in months}
+    conn = local_store.connect()
+    try:
+        built = {r['month']: r['version'] for r in conn.execute(
+            "SELECT month, version FROM compartment_rollup_state WHERE forest_id = ? AND month BETWEEN ? AND ?",
+            (forest_id, months[0], months[-1]))}
+        stale = [m for m in months if built.get(m) != versions[m]]
+        if not stale: return 0
+        # 一次取覆盖所有过期月份的区间 (只取汇总需要的列，按 id 分页拉全)
+        end = f"{year + 1}-01-01" if stale[-1].endswith("12-01") else f"{year}-{int(stale[-1][5:7]) + 1:02d}-01"
+        rows = backend.cached_select("actual_sales_transactions", "date, compartment, net_tonnes, jas, total_value",
+                                     filters=[("eq", "forest_id", forest_id), ("gte", "date", stale[0]), ("lt", "date", end)],
+                                     forest_id=forest_id)
+        agg = _aggregate(rows, forest_id)
+        agg = agg[agg['month'].isin(stale)]
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("DELETE FROM compartment_rollups WHERE forest_id = ? AND month = ?", [(forest_id, m) for m in stale])
+        conn.executemany("INSERT INTO compartment_rollups VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(forest_id, r.compartment, r.month, int(r.tickets), float(r.tonnes), float(r.jas), float(r.value))
+                          for r in agg.itertuples()])
+        # cached_select 已分页；行数正好是整页的倍数时仍不记版本 (万一被截断，下次会重算而不是一直错下去)
+        if not rows or len(rows) % backend.PAGE:
+            conn.executemany("INSERT OR REPLACE INTO compartment_rollup_state VALUES (?, ?, ?, ?)",
+                             [(forest_id, m, versions[m], time.time()) for m in stale])
+        conn.commit()
+        return len(stale)
+    finally:
+        conn.close()
+
+def monthly(forest_id, year):
+    """compartment × 月: forest_id, compartment, month, tickets, tonnes, jas, value"""
+    cols = ["forest_id", "compartment", "month", "tickets", "tonnes", "jas", "value"]
+    if snapshots.active() or not backend.supabase:
+        rows = backend.cached_select("actual_sales_transactions", "date, compartment, net_tonnes, jas, total_value",
+                                     filters=[("eq", "forest_id", forest_id), ("gte", "date", f"{year}-01-01"), ("lt", "date", f"{year + 1}-01-01")])
+        df = _aggregate(rows, forest_id).assign(forest_id=forest_id)
+    else:
+        refresh(forest_id, year)
+        conn = local_store.connect()
+        try:
+            df = pd.DataFrame([dict(r) for r in conn.execute(
+                "SELECT * FROM compartment_rollups WHERE forest_id = ? AND month BETWEEN ? AND ? ORDER BY month, compartment",
+                (forest_id, f"{year}-01-01", f"{year}-12-01")).fetchall()], columns=cols)
+        finally:
+            conn.close()
+    if df.empty: return pd.DataFrame(columns=cols)
+    df['month'] = pd.to_datetime(df['month'])
+    return df[cols]
+
+def yield_summary(forest_id, year):
+    """每个 compartment 的全年合计 + 林分属性 + 单位面积产量 (t/ha, JAS/ha, $/ha) 和 $/t"""
+    m = monthly(forest_id, year)
+    g = m.groupby('compartment', as_index=False)[['tickets', 'tonnes', 'jas', 'value']].sum() if not m.empty \
+        else pd.DataFrame(columns=['compartment', 'tickets', 'tonnes', 'jas', 'value'])
+    master = get_compartments(forest_id)
+    attrs = master.reindex(columns=ATTRS).rename(columns={'code': 'compartment'}) if not master.empty else pd.DataFrame(columns=['compartment'] + ATTRS[1:])
+    out = attrs.merge(g, on='compartment', how='outer')
+    out[['tickets', 'tonnes', 'jas', 'value']] = out[['tickets', 'tonnes', 'jas', 'value']].astype(float).fillna(0.0)
+    area = pd.to_numeric(out['area_ha'], errors='coerce').to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['tonnes_per_ha'] = np.where(area > 0, out['tonnes'] / area, np.nan)
+        out['jas_per_ha'] = np.where(area > 0, out['jas'] / area, np.nan)
+        out['value_per_ha'] = np.where(area > 0, out['value'] / area, np.nan)
+        out['value_per_tonne'] = np.where(out['tonnes'] > 0, out['value'] / out['tonnes'], np.nan)
+    return out.sort_values('compartment', key=lambda s: s.eq(GENERAL).astype(int).astype(str) + s.astype(str)).reset_index(drop=True)
@@ -0,0 +1,144 @@
+import random
+import threading
+import time
+import httpx
+from supabase import create_client, ClientOptions
+
+# --- 数据库客户端封装 (连接池 / 超时 / 重试 / 熔断 / 预热) ---
+# 免费版数据库会休眠，第一次请求很慢或失败。这里：
+#   1. 所有请求共用一个 httpx 连接池，设置连接 / 读超时
+#   2. 只对幂等的读 (select) 做带抖动的指数退避重试；写入不重试
+#   3. 连续失败达到阈值就熔断一段时间，期间直接报错 (上层改读快照)，不再一个个等超时
+#   4. 会话开始时后台 ping 一次唤醒数据库，其它读请求先等预热结束，避免一起超时
+
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 20.0
+WARMUP_TIMEOUT = 60.0       # 唤醒休眠的数据库可能要几十秒
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5          # 秒，第 n 次重试等待 base * 2^n * (0.5 ~ 1.5)
+FAIL_THRESHOLD = 5
+COOLDOWN = 30.0             # 熔断持续秒数
+WARMUP_INTERVAL = 300.0     # 两次预热 ping 的最小间隔
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class _Breaker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def before(self):
+        with self.lock:
+            if self.opened_at is None: return
+            if time.time() - self.opened_at < COOLDOWN or self.trial:
+                raise CircuitOpenError(f"Database unavailable (circuit open, retry in {max(COOLDOWN - (time.time() - self.opened_at), 0):.0f}s)")
+            self.trial = True           # 半开：只放一个请求试探
+
+    def success(self):
+        with self.lock:
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= FAIL_THRESHOLD or self.opened_at is not None: self.opened_at = time.time()
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None: return "closed"
+            return "half-open" if time.time() - self.opened_at >= COOLDOWN else "open"
+
+def _is_transient(e):
+    if isinstance(e, (httpx.TransportError, httpx.TimeoutException)): return True
+    msg = str(e).lower()
+    return any(k in msg for k in ("timeout", "timed out", "connection", "502", "503", "504", "520", "522", "bad gateway"))
+
+class _Builder:
+    """包装 postgrest 的请求构造器：链式调用照常转发，execute 时加上重试 / 熔断"""
+    def __init__(self, client, inner, idempotent=True):
+        self._client, self._inner, self._idempotent = client, inner, idempotent
+
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr): return attr
+        def call(*args, **kwargs):
+            out = attr(*args, **kwargs)
+            if not hasattr(out, "execute"): return out
+            idem = self._idempotent and name not in ("insert", "upsert", "update", "delete")
+            return _Builder(self._client, out, idem)
+        return call
+
+    def execute(self):
+        return self._client._run(self._inner.execute, self._idempotent)
+
+class ResilientClient:
+    def __init__(self, url, key):
+        self.http = httpx.Client(limits=POOL_LIMITS, timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT))
+        try:
+            options = ClientOptions(postgrest_client_timeout=READ_TIMEOUT, httpx_client=self.http)
+        except TypeError:       # 旧版 supabase-py 没有 httpx_client 参数
+            options = ClientOptions(postgrest_client_timeout=READ_TIMEOUT)
+        self.client = create_client(url, key, options=options)
+        self._rest_url, self._key = f"{url.rstrip('/')}/rest/v1", key
+        self.breaker = _Breaker()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+        self._warm = threading.Event()
+        self._warm.set()
+        self._last_warmup = 0.0
+
+    def table(self, name):
+        return _Builder(self, self.client.table(name))
+
+    def __getattr__(self, name):
+        # storage / rpc / auth 等直接转发
+        return getattr(self.client, name)
+
+    def _run(self, fn, idempotent):
+        # 预热进行中：先等它结束 (唤醒只需要一个慢请求)
+        self._warm.wait(WARMUP_TIMEOUT)
+        attempts = MAX_RETRIES + 1 if idempotent else 1
+        for attempt in range(attempts):
+            self.breaker.before()
+            self.stats["requests"] += 1
+            try:
+                out = fn()
+            except Exception as e:
+                if not _is_transient(e):
+                    # 业务错误 (约束冲突、列不存在等) 说明数据库是通的
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                self.stats["failures"] += 1
+                if attempt == attempts - 1: raise
+                self.stats["retries"] += 1
+                time.sleep(BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.5))
+            else:
+                self.breaker.success()
+                return out
+
+    def warm_up(self, table="dim_forests"):
+        """后台线程 ping 一次 (超时放宽)；最近刚 ping 过或正在 ping 时直接返回"""
+        if not self._warm.is_set() or time.time() - self._last_warmup < WARMUP_INTERVAL: return
+        self._last_warmup = time.time()
+        self._warm.clear()
+        def ping():
+            try:
+                # 直接用连接池发一个最小的请求，超时比普通读宽松
+                r = self.http.get(f"{self._rest_url}/{table}", params={"select": "id", "limit": 1}, timeout=WARMUP_TIMEOUT,
+                                  headers={"apikey": self._key, "Authorization": f"Bearer {self._key}"})
+                r.raise_for_status()
+                self.breaker.success()
+            except Exception as e:
+                print(f"DB warm-up failed: {e}")
+                self.breaker.failure()
+            finally:
+                self._warm.set()
+        threading.Thread(target=ping, name="db-warmup", daemon=True).start()
+
+    def health(self):
+        return {"circuit": self.breaker.state(), "warming": not self._warm.is_set(), **self.stats}
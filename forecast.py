@@ -0,0 +1,114 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+import backend
+
+# --- 滚动预测 (Rolling Forecast) ---
+# 对每个 林地 × 项目(grade / activity) × 月份 建 NumPy 数组，一次性对所有林地计算：
+#   已有 Actual 的月份 -> 用 Actual
+#   剩余月份 -> 预算 × YTD 执行率 (run-rate)，再与 Actual 线性趋势按权重混合
+# 预算本身的月度分布即季节性。结果按数据版本缓存，数据没变就不重算。
+
+RUN_RATE_CLIP = (0.5, 1.5)
+TREND_WEIGHT = 0.3
+MIN_TREND_MONTHS = 3
+
+# kind -> (事实表, 项目 id 列, 金额列, 维度表, 名称列)
+SOURCES = {
+    "Revenue": ("fact_production_volume", "grade_id", "amount", "dim_products", "grade_code"),
+    "Cost": ("fact_operational_costs", "activity_id", "total_amount", "dim_cost_activities", "activity_name"),
+}
+
+def _to_cube(rows, item_col, value_col, forests, items):
+    """rows -> (Actual 数组, Budget 数组)，形状 [forest, item, 12]"""
+    actual = np.zeros((len(forests), len(items), 12))
+    budget = np.zeros_like(actual)
+    has_actual = np.zeros((len(forests), 12), dtype=bool)
+    if not rows: return actual, budget, has_actual
+    df = pd.DataFrame(rows)
+    f_idx = df['forest_id'].map({f: i for i, f in enumerate(forests)})
+    i_idx = df[item_col].map({it: i for i, it in enumerate(items)})
+    m_idx = pd.to_datetime(df['month']).dt.month - 1
+    ok = f_idx.notna() & i_idx.notna()
+    f_idx, i_idx, m_idx = f_idx[ok].astype(int).to_numpy(), i_idx[ok].astype(int).to_numpy(), m_idx[ok].to_numpy()
+    vals = pd.to_numeric(df.loc[ok, value_col], errors='coerce').fillna(0.0).to_numpy()
+    is_act = (df.loc[ok, 'record_type'] == "Actual").to_numpy()
+    np.add.at(actual, (f_idx[is_act], i_idx[is_act], m_idx[is_act]), vals[is_act])
+    np.add.at(budget, (f_idx[~is_act], i_idx[~is_act], m_idx[~is_act]), vals[~is_act])
+    has_actual[f_idx[is_act], m_idx[is_act]] = True
+    return actual, budget, has_actual
+
+def project(actual, budget, cutoff):
+    """
+    actual / budget: [forest, item, 12]；cutoff: [forest]，已结账月份数 (0-12)。
+    返回 forecast 数组，同形状。
+    """
+    months = np.arange(12)
+    closed = months[None, None, :] < cutoff[:, None, None]          # [F, 1, 12]
+
+    ytd_act = np.where(closed, actual, 0.0).sum(axis=2)
+    ytd_bud = np.where(closed, budget, 0.0).sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(ytd_bud > 0, ytd_act / ytd_bud, 1.0)
+    rate = np.clip(rate, *RUN_RATE_CLIP)
+    base = budget * rate[:, :, None]
+
+    # 线性趋势：对已结账月份做最小二乘 (闭式解，全部向量化)
+    w = closed.astype(float)
+    n = w.sum(axis=2)
+    sx, sy = (w * months).sum(axis=2), (w * actual).sum(axis=2)
+    sxx, sxy = (w * months ** 2).sum(axis=2), (w * months * actual).sum(axis=2)
+    denom = n * sxx - sx ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(denom > 0, (n * sxy - sx * sy) / denom, 0.0)
+        intercept = np.where(n > 0, (sy - slope * sx) / n, 0.0)
+    trend = np.maximum(intercept[:, :, None] + slope[:, :, None] * months, 0.0)
+    use_trend = (cutoff >= MIN_TREND_MONTHS)[:, None, None]
+    blended = np.where(use_trend, (1 - TREND_WEIGHT) * base + TREND_WEIGHT * trend, base)
+
+    return np.where(closed, actual, blended)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _compute(year, versions):
+    start, end = f"{year}-01-01", f"{year + 1}-01-01"
+    forests = [f['id'] for f in backend.get_forest_list()]
+    frames = []
+    for kind, (table, item_col, value_col, dim_table, name_col) in SOURCES.items():
+        rows = backend.cached_select(
+            table, f"forest_id, {item_col}, month, record_type, {value_col}",
+            filters=[("gte", "month", start), ("lt", "month", end), ("in_", "record_type", ("Actual", "Budget"))])
+        dims = backend.cached_select(dim_table, f"id, {name_col}")
+        items = [d['id'] for d in dims]
+        actual, budget, has_actual = _to_cube(rows, item_col, value_col, forests, items)
+
+        # 每个林地的结账月份 = 最后一个有 Actual 的月份
+        last = np.where(has_actual.any(axis=1), 12 - np.argmax(has_actual[:, ::-1], axis=1), 0)
+        fc = project(actual, budget, last)
+
+        f_grid, i_grid, m_grid = np.meshgrid(np.arange(len(forests)), np.arange(len(items)), np.arange(12), indexing='ij')
+        frames.append(pd.DataFrame({
+            "forest_id": np.asarray(forests)[f_grid.ravel()] if forests else [],
+            "kind": kind,
+            "item": np.asarray([d[name_col] for d in dims], dtype=object)[i_grid.ravel()] if items else [],
+            "month": m_grid.ravel() + 1,
+            "actual": actual.ravel(), "budget": budget.ravel(), "forecast": fc.ravel(),
+            "closed": (m_grid < last[f_grid]).ravel(),
+        }))
+    df = pd.concat(frames, ignore_index=True)
+    return df[(df['actual'] != 0) | (df['budget'] != 0) | (df['forecast'] != 0)].reset_index(drop=True)
+
+def rolling_forecast(year):
+    """
+    全部林地的滚动预测，长表：
+    forest_id, kind (Revenue/Cost), item, month (1-12), actual, budget, forecast, closed
+    """
+    versions = tuple(backend.get_data_version(t) for t in
+                     ("fact_production_volume", "fact_operational_costs", "dim_products", "dim_cost_activities", "dim_forests"))
+    return _compute(year, versions)
+
+def summarize(df_fc):
+    """按 林地 × kind 汇总: YTD Actual / Full Year Forecast / Full Year Budget"""
+    if df_fc.empty: return pd.DataFrame()
+    g = df_fc.assign(ytd=np.where(df_fc['closed'], df_fc['actual'], 0.0))\
+        .groupby(['forest_id', 'kind'])[['ytd', 'forecast', 'budget']].sum().reset_index()
+    return g.rename(columns={"ytd": "YTD Actual", "forecast": "FY Forecast", "budget": "FY Budget"})
@@ -0,0 +1,59 @@
+import pandas as pd
+
+# --- 类型化 DataFrame 加载 ---
+# 每张表固定一套 dtype：id 用 Int32，文本维度用 category，月份 / 日期用 datetime64，
+# 只有金额用 float64，数量用 float32。嵌套的 join 结果 (例如 dim_products(grade_code))
+# 在加载时直接展平成普通列，不再每行保留一个 dict。
+# 注意：只用于只读 / 分析用的 DataFrame；可编辑表格 (AgGrid) 保持原始类型。
+
+SCHEMAS = {
+    "actual_sales_transactions": {
+        "id": "Int32", "forest_id": "Int32", "grade_id": "Int32", "date": "datetime",
+        "ticket_number": "string", "compartment": "category", "customer": "category",
+        "market": "category", "sale_type": "category",
+        "net_tonnes": "float32", "jas": "float32",
+        "price": "float64", "levy_deduction": "float64", "total_value": "float64", "price_book_id": "Int32", "row_version": "Int32",
+    },
+    "fact_production_volume": {
+        "id": "Int32", "forest_id": "Int32", "grade_id": "Int32", "month": "datetime", "record_type": "category",
+        "vol_tonnes": "float32", "vol_jas": "float32", "price_jas": "float64", "amount": "float64", "row_version": "Int32",
+    },
+    "fact_operational_costs": {
+        "id": "Int32", "forest_id": "Int32", "activity_id": "Int32", "month": "datetime", "record_type": "category",
+        "quantity": "float32", "unit_rate": "float64", "total_amount": "float64", "row_version": "Int32",
+    },
+    "invoice_archive": {
+        "id": "Int32", "invoice_no": "string", "vendor": "category", "invoice_date": "datetime",
+        "description": "string", "amount": "float64", "file_name": "string", "file_url": "string",
+        "status": "category",
+    },
+}
+
+# 嵌套 join -> 展平后的列及类型
+EMBEDDED = {
+    "dim_products": {"grade_code": "category"},
+    "dim_cost_activities": {"activity_name": "category"},
+}
+
+def _cast(s, kind):
+    if kind == "datetime": return pd.to_datetime(s, errors='coerce')
+    if kind in ("Int32", "int32"): return pd.to_numeric(s, errors='coerce').round().astype("Int32")
+    if kind in ("float32", "float64"): return pd.to_numeric(s, errors='coerce').astype(kind)
+    return s.astype(kind)
+
+def load_frame(table_name, rows):
+    """rows (Supabase .data) -> 按表结构定型的 DataFrame"""
+    df = pd.DataFrame(rows)
+    if df.empty: return df
+
+    # 1. 展平 join
+    for embed, fields in EMBEDDED.items():
+        if embed not in df.columns: continue
+        nested = df.pop(embed)
+        for field, kind in fields.items():
+            df[field] = _cast(nested.map(lambda x: x.get(field) if isinstance(x, dict) else None), kind)
+
+    # 2. 定型
+    for col, kind in SCHEMAS.get(table_name, {}).items():
+        if col in df.columns: df[col] = _cast(df[col], kind)
+    return df
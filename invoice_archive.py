@@ -0,0 +1,104 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import backend
+import invoice_jobs
+import archive_search
+import invoice_fastpath
+
+# --- 发票归档写入 ---
+# 同一个 PDF (按内容 sha256) 只上传一次，路径由内容哈希决定；
+# 上传并发执行 (有上限)，invoice_archive 一次性批量插入。
+
+BUCKET = "invoices"
+MAX_UPLOAD_WORKERS = 4
+
+def storage_path(file_hash):
+    return f"sha256/{file_hash}.pdf"
+
+def file_hash_from_url(file_url):
+    """从归档 URL 反推内容哈希 (旧的时间戳路径返回 None)"""
+    if not file_url or "/sha256/" not in str(file_url): return None
+    return str(file_url).split("/sha256/")[-1].split(".pdf")[0].split("?")[0]
+
+def _is_duplicate_error(e):
+    """Storage 同一路径已存在 (409 / "Duplicate")：按状态码和错误码判断，不在消息文字里找 "409" """
+    info = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+    codes = {str(getattr(e, a, "")) for a in ("status", "status_code", "statusCode", "code", "error")}
+    codes |= {str(info.get(k, "")) for k in ("statusCode", "status", "code", "error")}
+    return bool(codes & {"409", "Duplicate"})
+
+def _upload_one(file_hash, job_id):
+    bucket = backend.supabase.storage.from_(BUCKET)
+    path = storage_path(file_hash)
+    try:
+        bucket.upload(path, invoice_jobs.get_file_bytes(job_id), {"content-type": "application/pdf"})
+        outcome = "uploaded"
+    except Exception as e:
+        # 相同内容之前已经归档过：直接复用
+        if not _is_duplicate_error(e): return "failed", None, str(e)
+        outcome = "exists"
+    return outcome, bucket.get_public_url(path), None
+
+def archive_invoices(rows):
+    """
+    rows: list of dict, 每条包含 invoice_archive 字段
+          (invoice_no, vendor, invoice_date, description, amount, file_name)
+          以及 file_hash / job_id (用于取回 PDF)。
+    返回每个文件的处理结果 DataFrame；数据库未连接时抛 RuntimeError。
+    """
+    if not backend.supabase: raise RuntimeError("Database not connected — nothing was saved.")
+    if not rows: return pd.DataFrame()
+
+    by_hash = {}
+    for r in rows: by_hash.setdefault(r['file_hash'], []).append(r)
+
+    # 1. 并发上传 (每个唯一文件一次)
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as pool:
+        futures = {h: pool.submit(_upload_one, h, items[0]['job_id']) for h, items in by_hash.items()}
+    uploads = {h: f.result() for h, f in futures.items()}
+
+    # 2. 批量插入归档记录 (只插上传成功的文件)
+    records = []
+    for h, items in by_hash.items():
+        outcome, public_url, _ = uploads[h]
+        if outcome == "failed": continue
+        for r in items:
+            records.append({
+                "invoice_no": r.get('invoice_no'),
+                "vendor": r.get('vendor'),
+                "invoice_date": r.get('invoice_date'),
+                "description": r.get('description'),
+                "amount": r.get('amount'),
+                "file_name": r.get('file_name'),
+                "file_url": public_url,
+                "status": "Verified"
+            })
+    insert_error = None
+    if records:
+        try:
+            backend.supabase.table("invoice_archive").insert(records).execute()
+        except Exception as e:
+            insert_error = str(e)
+        else:
+            # 新记录立即进入本地搜索索引
+            try: archive_search.sync(force=True)
+            except Exception as e: print(f"Archive index sync error: {e}")
+            # 已审核的发票用于学习 vendor 模板 (下次同一 vendor 走本地快速通道)
+            for h, items in by_hash.items():
+                if uploads[h][0] == "failed": continue
+                try: invoice_fastpath.learn(invoice_jobs.get_file_bytes(items[0]['job_id']), items, file_hash=h)
+                except Exception as e: print(f"Template learn error: {e}")
+
+    # 3. 每个文件的结果
+    report = []
+    for h, items in by_hash.items():
+        outcome, _, err = uploads[h]
+        if outcome != "failed" and insert_error: err = f"Archive insert failed: {insert_error}"
+        report.append({
+            "File": items[0].get('file_name'),
+            "Invoices": len(items),
+            "Upload": "♻️ Already stored" if outcome == "exists" else ("✅ Uploaded" if outcome == "uploaded" else "❌ Failed"),
+            "Archived": 0 if err else len(items),
+            "Error": err or ""
+        })
+    return pd.DataFrame(report)
@@ -0,0 +1,115 @@
+import re
+import threading
+from bisect import bisect_left
+from datetime import date
+import local_store
+import archive_search
+import invoice_archive
+
+# --- 重复发票检测索引 ---
+# 基于本地归档镜像 (archive_search) 在内存里建三类索引：
+#   1. (标准化 vendor, 标准化 invoice_no) -> 精确重复，O(1)
+#   2. 文件内容哈希 -> 同一个 PDF 已归档过，O(1)
+#   3. vendor -> 按金额排序的列表，金额 ± 容差 且 日期相近 -> 疑似重复，O(log n)
+# 审核时每张发票只查内存，不额外请求数据库。
+
+AMOUNT_TOL = 1.0        # $
+DATE_WINDOW_DAYS = 7
+
+_VENDOR_SUFFIXES = {"ltd", "limited", "co", "company", "inc", "nz", "pty", "llc", "the"}
+
+def normalize_vendor(vendor):
+    words = re.sub(r"[^a-z0-9 ]", " ", str(vendor or "").lower()).split()
+    return " ".join(w for w in words if w not in _VENDOR_SUFFIXES)
+
+def normalize_invoice_no(invoice_no):
+    no = re.sub(r"[^A-Z0-9]", "", str(invoice_no or "").upper())
+    return "" if no in ("", "UNKNOWN") else no
+
+def _date_ordinal(d):
+    try: return date.fromisoformat(str(d)[:10]).toordinal()
+    except (TypeError, ValueError): return None
+
+class DedupIndex:
+    def __init__(self, rows=(), base=None):
+        # base: 另一个 (只读) 索引，check 时一并查询；用于 "归档索引 + 本批次" 叠加
+        self.base = base
+        self.by_key = {}
+        self.by_hash = {}
+        self.by_vendor = {}     # vendor -> (sorted amounts, entries)
+        self._pending = {}      # vendor -> 未排序的新条目
+        for r in rows: self.add(r, file_hash=invoice_archive.file_hash_from_url(r.get('file_url')))
+
+    def add(self, row, file_hash=None):
+        """row 使用归档字段名: vendor / invoice_no / invoice_date / amount"""
+        vendor = normalize_vendor(row.get('vendor'))
+        inv_no = normalize_invoice_no(row.get('invoice_no'))
+        ref = row.get('invoice_no') or row.get('file_name') or ""
+        if vendor and inv_no: self.by_key.setdefault((vendor, inv_no), ref)
+        if file_hash: self.by_hash.setdefault(file_hash, ref)
+        try: amount = float(row.get('amount') or 0)
+        except (TypeError, ValueError): amount = 0.0
+        if vendor and amount:
+            self._pending.setdefault(vendor, []).append((amount, _date_ordinal(row.get('invoice_date')), ref))
+
+    def _amount_list(self, vendor):
+        # 延迟排序：批量 add 之后第一次查询时才合并
+        if vendor in self._pending:
+            amounts, entries = self.by_vendor.get(vendor, ([], []))
+            merged = sorted(entries + self._pending.pop(vendor), key=lambda e: e[0])
+            self.by_vendor[vendor] = ([e[0] for e in merged], merged)
+        return self.by_vendor.get(vendor, ([], []))
+
+    def check(self, item, file_hash=None):
+        """
+        item 使用 AI 识别字段名 (vendor_detected / invoice_no / invoice_date / amount_detected)。
+        返回状态字符串；没有重复时返回 "" 。
+        """
+        vendor = normalize_vendor(item.get('vendor_detected'))
+        inv_no = normalize_invoice_no(item.get('invoice_no'))
+        if self.base:
+            status = self.base.check(item, file_hash)
+            if status: return status
+        if vendor and inv_no and (vendor, inv_no) in self.by_key:
+            return f"🔁 Duplicate (Inv # {self.by_key[(vendor, inv_no)]})"
+        if file_hash and file_hash in self.by_hash:
+            return f"🔁 Duplicate (Same File as {self.by_hash[file_hash]})"
+
+        try: amount = float(item.get('amount_detected') or 0)
+        except (TypeError, ValueError): amount = 0.0
+        if not vendor or not amount: return ""
+        amounts, entries = self._amount_list(vendor)
+        d = _date_ordinal(item.get('invoice_date'))
+        i = bisect_left(amounts, amount - AMOUNT_TOL)
+        while i < len(amounts) and amounts[i] <= amount + AMOUNT_TOL:
+            _, d2, ref = entries[i]
+            if d is None or d2 is None or abs(d - d2) <= DATE_WINDOW_DAYS:
+                return f"⚠️ Possible Duplicate ({ref})"
+            i += 1
+        return ""
+
+# --- 缓存：归档镜像没变化就复用同一份索引 ---
+_cache_lock = threading.Lock()
+_cache = {"key": None, "index": None}
+
+def get_archive_index():
+    """
+    返回基于已归档发票的索引 (进程内共享，只读)。
+    本批次的发票请用 DedupIndex(base=get_archive_index()) 叠加，不要直接 add。
+    """
+    try: archive_search.sync()
+    except Exception as e: print(f"Archive index sync error: {e}")
+
+    local_store.ensure_schema(archive_search._SCHEMA)
+    conn = local_store.connect()
+    try:
+        key = tuple(conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM archive_rows").fetchone())
+        with _cache_lock:
+            if _cache["key"] != key:
+                rows = conn.execute("SELECT vendor, invoice_no, invoice_date, amount, file_name, file_url FROM archive_rows").fetchall()
+                index = DedupIndex([dict(r) for r in rows])
+                for v in list(index._pending): index._amount_list(v)   # 预先排序，之后只读
+                _cache["index"], _cache["key"] = index, key
+            return _cache["index"]
+    finally:
+        conn.close()
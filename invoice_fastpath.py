@@ -0,0 +1,274 @@
+import io
+import re
+import time
+from datetime import datetime
+import local_store
+import backend
+import invoice_dedup
+
+try:
+    from pypdf import PdfReader
+except ImportError:     # 没装 pypdf 时快速通道直接关闭，全部走 Gemini
+    PdfReader = None
+
+# --- 发票识别快速通道 (PDF 文字层 + 按 vendor 学习的模板) ---
+# 大部分承包商发票是电子生成的 PDF，自带文字层。对已审核归档过的发票，
+# 记下 invoice_no / 日期 / 金额 前面的标签 (anchor) 作为该 vendor 的模板；
+# 新文件先本地读文字层套模板，所有页面都高置信度识别出来才直接返回，
+# 否则整份文件仍交给 Gemini。
+
+MIN_TEXT_CHARS = 200    # 文字层少于这个长度视为扫描件
+MIN_HITS = 2            # anchor 至少在 N 张已审核发票上出现过才用于识别
+ANCHOR_WORDS = 3        # anchor 取值前面最多几个词
+BACKFILL_LIMIT = 200
+
+FIELDS = ("invoice_no", "invoice_date", "amount")
+
+DATE_FORMATS = ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d %B %Y", "%d %b %Y", "%B %d, %Y", "%b %d, %Y", "%d-%b-%Y", "%d/%m/%y"]
+_VALUE_RE = {
+    "invoice_no": r"([A-Za-z0-9][A-Za-z0-9\-/]{1,30})",
+    "amount": r"\$?\s*(-?[\d,]+\.\d{2})\b",
+    "invoice_date": r"(\d{1,4}[/\-.]\d{1,2}[/\-.]\d{2,4}|\d{1,2}[ \-][A-Za-z]{3,9}[ \-]\d{4}|[A-Za-z]{3,9} \d{1,2}, \d{4})",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoice_templates (
+    vendor_key TEXT NOT NULL,
+    field TEXT NOT NULL,
+    anchor TEXT NOT NULL,
+    fmt TEXT NOT NULL DEFAULT '',
+    hits INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    PRIMARY KEY (vendor_key, field, anchor, fmt)
+);
+CREATE TABLE IF NOT EXISTS invoice_template_vendors (
+    vendor_key TEXT PRIMARY KEY,
+    vendor TEXT,
+    samples INTEGER NOT NULL DEFAULT 0,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS invoice_template_sources (
+    file_hash TEXT NOT NULL,
+    invoice_no TEXT NOT NULL,
+    PRIMARY KEY (file_hash, invoice_no)
+);
+"""
+
+# --- A. 文字层 ---
+def extract_pages(file_bytes):
+    """返回每页文字列表；没有 pypdf / 读取失败 / 没有文字层返回 []"""
+    if PdfReader is None or not file_bytes: return []
+    try:
+        pages = [p.extract_text() or "" for p in PdfReader(io.BytesIO(file_bytes)).pages]
+    except Exception:
+        return []
+    return pages if sum(len(p.strip()) for p in pages) >= MIN_TEXT_CHARS else []
+
+def _lines(text):
+    return [re.sub(r"\s+", " ", l).strip() for l in text.splitlines() if l.strip()]
+
+def _anchor(line, start):
+    """值前面同一行的最后几个词 (去掉末尾的 : # 等)"""
+    words = line[:start].strip().rstrip(":#-").strip().split()
+    return " ".join(words[-ANCHOR_WORDS:]).lower()
+
+# --- B. 学习模板 ---
+def _date_variants(iso):
+    try: d = datetime.strptime(str(iso)[:10], "%Y-%m-%d")
+    except ValueError: return []
+    out = []
+    for fmt in DATE_FORMATS:
+        s = d.strftime(fmt)
+        out.append((s, fmt))
+        # 不补零的写法 (例如 5/3/2025)
+        alt = re.sub(r"(?<!\d)0(\d)", r"\1", s)
+        if alt != s: out.append((alt, fmt))
+    return out
+
+def _amount_variants(amount):
+    try: a = float(amount)
+    except (TypeError, ValueError): return []
+    return [(f"{a:,.2f}", ""), (f"{a:.2f}", "")]
+
+def _find_anchors(lines, variants, last=False):
+    """在各行里找值出现的位置，返回 [(anchor, fmt)]；last=True 只取最后一次出现 (合计通常在最后)"""
+    found = []
+    for line in lines:
+        low = line.lower()
+        for value, fmt in variants:
+            i = low.find(value.lower())
+            if i < 0: continue
+            a = _anchor(line, i)
+            if a: found.append((a, fmt))
+    if last and found: return found[-1:]
+    return list(dict.fromkeys(found))
+
+def _page_for(pages, invoice_no):
+    key = invoice_dedup.normalize_invoice_no(invoice_no)
+    if not key: return None
+    for p in pages:
+        if key in re.sub(r"[^A-Z0-9]", "", p.upper()): return p
+    return None
+
+def learn(file_bytes, rows, file_hash=None):
+    """
+    rows: 已审核的归档记录 (vendor / invoice_no / invoice_date / amount / description)。
+    从 PDF 文字层里找出各字段前面的标签，累加到该 vendor 的模板。返回学习到的发票数。
+    """
+    pages = extract_pages(file_bytes)
+    if not pages: return 0
+    local_store.ensure_schema(_SCHEMA)
+    conn = local_store.connect()
+    learned = 0
+    try:
+        for r in rows:
+            vendor_key = invoice_dedup.normalize_vendor(r.get('vendor'))
+            inv_no = invoice_dedup.normalize_invoice_no(r.get('invoice_no'))
+            if not vendor_key or not inv_no: continue
+            if file_hash:
+                cur = conn.execute("INSERT OR IGNORE INTO invoice_template_sources (file_hash, invoice_no) VALUES (?, ?)", (file_hash, inv_no))
+                if cur.rowcount == 0: continue      # 这张发票已经学过
+            page = _page_for(pages, r.get('invoice_no'))
+            if page is None: continue
+            lines = _lines(page)
+            anchors = {
+                "invoice_no": [(a, "") for a, _ in _find_anchors(lines, [(str(r.get('invoice_no')).strip(), "")])],
+                "invoice_date": _find_anchors(lines, _date_variants(r.get('invoice_date'))),
+                "amount": _find_anchors(lines, _amount_variants(r.get('amount')), last=True),
+            }
+            now = time.time()
+            for field, found in anchors.items():
+                conn.executemany(
+                    "INSERT INTO invoice_templates (vendor_key, field, anchor, fmt, hits, updated_at) VALUES (?, ?, ?, ?, 1, ?) "
+                    "ON CONFLICT(vendor_key, field, anchor, fmt) DO UPDATE SET hits = hits + 1, updated_at = excluded.updated_at",
+                    [(vendor_key, field, a, fmt, now) for a, fmt in found]
+                )
+            conn.execute(
+                "INSERT INTO invoice_template_vendors (vendor_key, vendor, samples, description) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(vendor_key) DO UPDATE SET vendor = excluded.vendor, samples = samples + 1, description = excluded.description",
+                (vendor_key, r.get('vendor'), r.get('description'))
+            )
+            learned += 1
+        conn.commit()
+    finally:
+        conn.close()
+    return learned
+
+def backfill_from_archive(limit=BACKFILL_LIMIT):
+    """从已归档的 Verified 发票 (Storage 里的 PDF) 补学模板，返回学习到的发票数"""
+    import invoice_archive
+    if not backend.supabase: return 0
+    rows = backend.supabase.table("invoice_archive").select("vendor, invoice_no, invoice_date, amount, description, file_url")\
+        .eq("status", "Verified").order("id", desc=True).limit(limit).execute().data
+    by_hash = {}
+    for r in rows:
+        h = invoice_archive.file_hash_from_url(r.get('file_url'))
+        if h: by_hash.setdefault(h, []).append(r)
+    bucket = backend.supabase.storage.from_(invoice_archive.BUCKET)
+    learned = 0
+    for h, items in by_hash.items():
+        try: learned += learn(bucket.download(invoice_archive.storage_path(h)), items, file_hash=h)
+        except Exception as e: print(f"Template backfill error ({h[:8]}): {e}")
+    return learned
+
+# --- C. 识别 ---
+def _load_templates(conn):
+    vendors = {r['vendor_key']: dict(r) for r in conn.execute("SELECT * FROM invoice_template_vendors")}
+    anchors = {}
+    for r in conn.execute("SELECT vendor_key, field, anchor, fmt, hits FROM invoice_templates WHERE hits >= ? ORDER BY hits DESC", (MIN_HITS,)):
+        anchors.setdefault(r['vendor_key'], {}).setdefault(r['field'], []).append((r['anchor'], r['fmt']))
+    return vendors, anchors
+
+def _parse_date(text, fmt):
+    for f in ([fmt] if fmt else []) + DATE_FORMATS:
+        try: return datetime.strptime(text, f).date().isoformat()
+        except ValueError: continue
+    return None
+
+def _match_field(lines, field, anchors):
+    """按 anchor (命中次数从高到低) 找值；返回解析后的值或 None"""
+    for anchor, fmt in anchors:
+        pat = re.compile(re.escape(anchor) + r"\s*[:#\-]?\s*" + _VALUE_RE[field], re.IGNORECASE)
+        for line in (lines if field != "amount" else reversed(lines)):
+            m = pat.search(line)
+            if not m: continue
+            raw = m.group(1)
+            if field == "amount":
+                try: return float(raw.replace(",", ""))
+                except ValueError: continue
+            if field == "invoice_date":
+                d = _parse_date(raw, fmt)
+                if d: return d
+                continue
+            return raw
+    return None
+
+_DESC_RE = re.compile(r"^(?:description|particulars|details|re)\s*(?:[:\-]\s*(.*))?$", re.I)
+
+def _description(lines):
+    """本页 'Description:' 等标签后面的文字 (标签单独一行时取下一行)；没有返回 N/A，不沿用模板里的旧描述"""
+    for i, line in enumerate(lines):
+        m = _DESC_RE.match(line)
+        if not m: continue
+        text = (m.group(1) or "").strip() or (lines[i + 1] if i + 1 < len(lines) else "")
+        if text: return text[:200]
+    return "N/A"
+
+def _vendor_of(page, vendors, anchors):
+    norm = " " + invoice_dedup.normalize_vendor(page) + " "
+    hits = [v for v in anchors if v in vendors and f" {v} " in norm]
+    # 多个 vendor 名字都出现时取最长的 (更具体)
+    return max(hits, key=len) if hits else None
+
+def try_extract(file_bytes, filename):
+    """
+    本地快速识别；返回与 backend.real_extract_invoice_data 相同格式的列表，
+    任何一页没把握时返回 None (调用方改走 Gemini)。
+    """
+    pages = extract_pages(file_bytes)
+    if not pages: return None
+    local_store.ensure_schema(_SCHEMA)
+    conn = local_store.connect()
+    try: vendors, anchors = _load_templates(conn)
+    finally: conn.close()
+    if not anchors: return None
+
+    results, seen = [], set()
+    for page in pages:
+        if not page.strip(): continue
+        vendor_key = _vendor_of(page, vendors, anchors)
+        if vendor_key is None: return None
+        lines = _lines(page)
+        tpl = anchors[vendor_key]
+        values = {f: _match_field(lines, f, tpl.get(f, [])) for f in FIELDS}
+        inv_key = invoice_dedup.normalize_invoice_no(values["invoice_no"])
+        if not inv_key: return None
+        # 同一张发票跨多页：后续页面没有新的发票号，视为续页
+        if inv_key in seen: continue
+        if values["invoice_date"] is None or values["amount"] is None: return None
+        seen.add(inv_key)
+        results.append({
+            "vendor_detected": vendors[vendor_key]['vendor'],
+            "invoice_no": values["invoice_no"],
+            "invoice_date": values["invoice_date"],
+            "amount_detected": values["amount"],
+            "description": _description(lines),
+            "filename": filename,
+            "source": "text-layer",
+        })
+    return results or None
+
+def template_stats():
+    """每个 vendor 的模板概况，用于页面展示"""
+    local_store.ensure_schema(_SCHEMA)
+    conn = local_store.connect()
+    try:
+        rows = conn.execute(
+            "SELECT v.vendor, v.samples, "
+            "SUM(CASE WHEN t.hits >= ? THEN 1 ELSE 0 END) AS usable_anchors, COUNT(t.anchor) AS anchors "
+            "FROM invoice_template_vendors v LEFT JOIN invoice_templates t ON t.vendor_key = v.vendor_key "
+            "GROUP BY v.vendor_key ORDER BY v.samples DESC", (MIN_HITS,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
@@ -0,0 +1,201 @@
+import streamlit as st
+import io
+import json
+import time
+import uuid
+import hashlib
+import threading
+import local_store
+import backend
+import invoice_fastpath
+import ai_usage
+
+# --- 后台发票识别队列 ---
+# 上传的 PDF 先写进本地 SQLite 任务表，由常驻 worker 线程异步识别：
+# 先试本地文字层快速通道 (invoice_fastpath)，没把握再调用 Gemini。
+# 页面只负责轮询状态，切换页面 / 点击其它控件都不会打断或重复识别。
+
+WORKER_COUNT = 3
+KEEP_DAYS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoice_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    file_hash TEXT,
+    file_bytes BLOB,
+    status TEXT NOT NULL DEFAULT 'queued',
+    result_json TEXT,
+    error_msg TEXT,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_invoice_jobs_batch ON invoice_jobs(batch_id);
+CREATE INDEX IF NOT EXISTS idx_invoice_jobs_status ON invoice_jobs(status, id);
+"""
+
+class _NamedBytes(io.BytesIO):
+    """backend.real_extract_invoice_data 需要 .name 属性，模拟 UploadedFile"""
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+# --- A. Worker Pool ---
+class _WorkerPool:
+    def __init__(self, n_workers):
+        self._wake = threading.Event()
+        self._claim_lock = threading.Lock()
+        local_store.ensure_schema(_SCHEMA)
+        self._recover()
+        self.threads = []
+        for i in range(n_workers):
+            t = threading.Thread(target=self._loop, name=f"invoice-worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _recover(self):
+        # 进程重启时，'running' 的任务已丢失执行者，重新排队；顺便清理过期任务
+        conn = local_store.connect()
+        try:
+            conn.execute("UPDATE invoice_jobs SET status='queued', started_at=NULL WHERE status='running'")
+            conn.execute("DELETE FROM invoice_jobs WHERE created_at < ?", (time.time() - KEEP_DAYS * 86400,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def notify(self):
+        self._wake.set()
+
+    def _claim(self):
+        with self._claim_lock:
+            conn = local_store.connect()
+            try:
+                row = conn.execute("SELECT id, batch_id, filename, file_bytes FROM invoice_jobs WHERE status='queued' ORDER BY id LIMIT 1").fetchone()
+                if not row: return None
+                conn.execute("UPDATE invoice_jobs SET status='running', started_at=? WHERE id=?", (time.time(), row['id']))
+                conn.commit()
+                return row['id'], row['batch_id'], row['filename'], row['file_bytes']
+            finally:
+                conn.close()
+
+    def _loop(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                self._wake.wait(timeout=5)
+                self._wake.clear()
+                continue
+            job_id, batch_id, filename, file_bytes = job
+            status, result, err = "done", [], None
+            stats = ai_usage.new_stats()
+            try:
+                t0 = time.perf_counter()
+                try: result = invoice_fastpath.try_extract(file_bytes, filename)
+                except Exception as e:
+                    print(f"Fast path error ({filename}): {e}")
+                    result = None
+                if result:
+                    stats.update(source="text-layer", latency_ms=(time.perf_counter() - t0) * 1000, pdf_bytes=len(file_bytes))
+                else:
+                    result = backend.real_extract_invoice_data(_NamedBytes(file_bytes, filename), stats=stats)
+                if result and all(r.get("vendor_detected") == "Error" for r in result):
+                    status = "error"
+                    err = result[0].get("error_msg")
+            except Exception as e:
+                status, err = "error", str(e)
+                result = [{"filename": filename, "vendor_detected": "Error", "error_msg": err, "amount_detected": 0}]
+            try: ai_usage.record(stats, batch_id, job_id, filename, status, sum(r.get("vendor_detected") != "Error" for r in result), err)
+            except Exception as e: print(f"AI usage record error: {e}")
+            conn = local_store.connect()
+            try:
+                conn.execute(
+                    "UPDATE invoice_jobs SET status=?, result_json=?, error_msg=?, finished_at=? WHERE id=?",
+                    (status, json.dumps(result, default=str), err, time.time(), job_id)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+
+@st.cache_resource
+def get_worker_pool():
+    # 进程级单例：所有 session 共享同一组 worker
+    return _WorkerPool(WORKER_COUNT)
+
+# --- B. 对外接口 ---
+def enqueue_files(uploaded_files):
+    """把上传的文件写入任务表，返回 batch_id"""
+    pool = get_worker_pool()
+    batch_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    rows = []
+    for f in uploaded_files:
+        f.seek(0)
+        data = f.read()
+        rows.append((batch_id, f.name, hashlib.sha256(data).hexdigest(), data, now))
+    conn = local_store.connect()
+    try:
+        conn.executemany(
+            "INSERT INTO invoice_jobs (batch_id, filename, file_hash, file_bytes, created_at) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    pool.notify()
+    return batch_id
+
+def get_batch_status(batch_id):
+    get_worker_pool()  # 重启后页面一打开就拉起 worker：_recover 把中断的任务重新排队并继续处理
+    conn = local_store.connect()
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) AS n FROM invoice_jobs WHERE batch_id=? GROUP BY status", (batch_id,)).fetchall()
+    finally:
+        conn.close()
+    counts = {r['status']: r['n'] for r in rows}
+    total = sum(counts.values())
+    pending = counts.get('queued', 0) + counts.get('running', 0)
+    return {"total": total, "pending": pending, "done": counts.get('done', 0), "error": counts.get('error', 0),
+            "running": counts.get('running', 0)}
+
+def get_batch_results(batch_id):
+    """
+    返回批次内所有已完成的识别结果 (每张发票一条)，
+    每条附带 job_id / file_hash，用于之后取回原始 PDF。
+    """
+    conn = local_store.connect()
+    try:
+        rows = conn.execute(
+            "SELECT id, filename, file_hash, result_json FROM invoice_jobs WHERE batch_id=? AND status IN ('done','error') ORDER BY id",
+            (batch_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    results = []
+    for r in rows:
+        for item in json.loads(r['result_json'] or "[]"):
+            item['job_id'] = r['id']
+            item['file_hash'] = r['file_hash']
+            item.setdefault('filename', r['filename'])
+            results.append(item)
+    return results
+
+def get_file_bytes(job_id):
+    conn = local_store.connect()
+    try:
+        row = conn.execute("SELECT file_bytes FROM invoice_jobs WHERE id=?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return row['file_bytes'] if row else None
+
+def list_recent_batches(limit=10):
+    get_worker_pool()  # 同上；建池时也会 ensure_schema
+    conn = local_store.connect()
+    try:
+        rows = conn.execute(
+            "SELECT batch_id, MIN(created_at) AS created_at, COUNT(*) AS files FROM invoice_jobs GROUP BY batch_id ORDER BY created_at DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
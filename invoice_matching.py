@@ -0,0 +1,160 @@
+import difflib
+from datetime import date
+import backend
+import invoice_dedup
+
+# --- 发票 ↔ 成本 匹配引擎 ---
+# 按 林地 + 发票月份 限定范围，一次性拉取当月 Actual 成本，然后在内存里匹配：
+#   1. vendor 与 activity 名称的相似度打分 (倒排索引预筛 + difflib)
+#   2. 多张发票合计 = 一个 activity 总额 (subset-sum，带容差和剪枝)
+#   3. 一张发票 = 多个 activity 合计 (同上，反向)
+#   4. 剩下的按最佳相似度给出 Variance / Not Found
+
+AMOUNT_TOL = 1.0        # $，与原来 Match 判定一致
+MIN_SIMILARITY = 0.5
+MAX_SUBSET_CANDIDATES = 20
+MAX_SEARCH_NODES = 20000
+
+def month_of(invoice_date):
+    try: return date.fromisoformat(str(invoice_date)[:10]).replace(day=1).isoformat()
+    except (TypeError, ValueError): return None
+
+def _tokens(text):
+    return set(invoice_dedup.normalize_vendor(text).split())
+
+class _ActivityIndex:
+    def __init__(self, activities):
+        self.names = {a['id']: a['activity_name'] for a in activities}
+        self.norm = {aid: invoice_dedup.normalize_vendor(n) for aid, n in self.names.items()}
+        self.by_token = {}
+        for aid, n in self.norm.items():
+            for t in n.split(): self.by_token.setdefault(t, set()).add(aid)
+        self._cache = {}
+
+    def scores(self, vendor):
+        """返回 {activity_id: similarity}，只保留 >= MIN_SIMILARITY 的"""
+        if vendor in self._cache: return self._cache[vendor]
+        v_norm = invoice_dedup.normalize_vendor(vendor)
+        v_tokens = set(v_norm.split())
+        # 有共同词的 activity 优先；都没有时才全量 difflib
+        cand = set().union(*(self.by_token.get(t, set()) for t in v_tokens)) if v_tokens else set()
+        if not cand: cand = self.norm.keys()
+        out = {}
+        for aid in cand:
+            a_tokens = set(self.norm[aid].split())
+            jac = len(v_tokens & a_tokens) / len(v_tokens | a_tokens) if (v_tokens | a_tokens) else 0.0
+            # 包含关系 (例如 "Road Maintenance" ⊂ "Road Maintenance - Grading") 视为强匹配
+            contain = 1.0 if v_norm and (v_norm in self.norm[aid] or self.norm[aid] in v_norm) else 0.0
+            ratio = difflib.SequenceMatcher(None, v_norm, self.norm[aid]).ratio()
+            score = max(contain * 0.9, jac, ratio)
+            if score >= MIN_SIMILARITY: out[aid] = score
+        self._cache[vendor] = out
+        return out
+
+def _subset_sum(target, candidates, tol=AMOUNT_TOL):
+    """
+    candidates: [(key, amount, score)]，找合计在 target ± tol 内的子集：张数最少优先，同样张数取总分最高。
+    金额 <= 0 的 (识别失败的 0 元 / 贷项) 不参与：0 元会白白加分，负数会让剪枝失效。
+    按金额降序 DFS，用前缀上下界剪枝，节点数有上限。返回 key 列表或 None。
+    """
+    cands = sorted((c for c in candidates if c[1] > 0), key=lambda c: -c[2])[:MAX_SUBSET_CANDIDATES]
+    cands.sort(key=lambda c: -c[1])
+    suffix = [0.0] * (len(cands) + 1)
+    for i in range(len(cands) - 1, -1, -1): suffix[i] = suffix[i + 1] + cands[i][1]
+
+    best = {"rank": None, "keys": None}
+    nodes = [0]
+    def dfs(i, total, score, picked):
+        nodes[0] += 1
+        if nodes[0] > MAX_SEARCH_NODES: return
+        if picked and abs(total - target) <= tol:
+            rank = (-len(picked), score)
+            if best["rank"] is None or rank > best["rank"]: best["rank"], best["keys"] = rank, list(picked)
+        if i == len(cands) or total - tol > target or total + suffix[i] + tol < target: return
+        # 已经比当前最优用了更多张：再加只会更多
+        if best["rank"] is not None and len(picked) + 1 > -best["rank"][0]: return
+        key, amt, sc = cands[i]
+        picked.append(key)
+        dfs(i + 1, total + amt, score + sc, picked)
+        picked.pop()
+        dfs(i + 1, total, score, picked)
+    dfs(0, 0.0, 0.0, [])
+    return best["keys"]
+
+def _load_month_costs(forest_id, months):
+    """一次查询拿到所有相关月份的 Actual 成本，返回 {(month, activity_id): total}"""
+    rows = backend.supabase.table("fact_operational_costs").select("activity_id, month, total_amount")\
+        .eq("forest_id", forest_id).eq("record_type", "Actual").in_("month", sorted(months)).execute().data
+    totals = {}
+    for r in rows:
+        k = (str(r['month'])[:10], r['activity_id'])
+        totals[k] = totals.get(k, 0.0) + float(r.get('total_amount') or 0)
+    return {k: v for k, v in totals.items() if v}
+
+def match_invoices(items, forest_id):
+    """
+    items: AI 识别结果列表 (vendor_detected / amount_detected / invoice_date)。
+    返回与 items 等长的列表，每项为
+    {"activity": str, "erp_amount": float, "diff": float, "status": str}
+    """
+    out = [{"activity": "", "erp_amount": 0.0, "diff": 0.0, "status": "❌ Not Found"} for _ in items]
+    live = []
+    for i, it in enumerate(items):
+        if it.get("vendor_detected") == "Error":
+            out[i]["status"] = "❌ AI Error"
+        elif not month_of(it.get('invoice_date')):
+            out[i]["status"] = "❓ No Date"
+        else:
+            live.append(i)
+    if not live or not backend.supabase: return out
+
+    months = {month_of(items[i]['invoice_date']) for i in live}
+    acts = _ActivityIndex(backend.supabase.table("dim_cost_activities").select("id, activity_name").execute().data)
+    totals = _load_month_costs(forest_id, months)
+
+    def amount(i):
+        try: return float(items[i].get('amount_detected') or 0)
+        except (TypeError, ValueError): return 0.0
+
+    for month in months:
+        inv_open = {i for i in live if month_of(items[i]['invoice_date']) == month}
+        act_open = {aid for (m, aid) in totals if m == month}
+        sims = {i: {a: s for a, s in acts.scores(items[i].get('vendor_detected')).items() if a in act_open} for i in inv_open}
+
+        def assign(inv_ids, aid, label):
+            erp = totals[(month, aid)]
+            group = sum(amount(i) for i in inv_ids)
+            for i in inv_ids:
+                out[i].update({"activity": acts.names[aid], "erp_amount": erp, "diff": group - erp, "status": label})
+
+        # 1. 多张发票 -> 一个 activity (先处理候选最相似的 activity)
+        order = sorted(act_open, key=lambda a: -max([sims[i].get(a, 0.0) for i in inv_open] or [0.0]))
+        for aid in order:
+            cands = [(i, amount(i), sims[i][aid]) for i in inv_open if aid in sims[i]]
+            if not cands: continue
+            picked = _subset_sum(totals[(month, aid)], cands)
+            if picked:
+                assign(picked, aid, "✅ Match" if len(picked) == 1 else f"✅ Match ({len(picked)} invoices)")
+                inv_open -= set(picked)
+                act_open.discard(aid)
+
+        # 2. 一张发票 -> 多个 activity
+        for i in sorted(inv_open, key=amount, reverse=True):
+            cands = [(a, totals[(month, a)], s) for a, s in sims[i].items() if a in act_open]
+            picked = _subset_sum(amount(i), cands) if len(cands) > 1 else None
+            if picked and len(picked) > 1:
+                erp = sum(totals[(month, a)] for a in picked)
+                out[i].update({"activity": " + ".join(acts.names[a] for a in picked), "erp_amount": erp,
+                               "diff": amount(i) - erp, "status": f"✅ Match ({len(picked)} activities)"})
+                inv_open.discard(i)
+                act_open -= set(picked)
+
+        # 3. 剩余：取最相似的 activity，报告差额
+        for i in inv_open:
+            if not sims[i]: continue
+            aid = max(sims[i], key=sims[i].get)
+            erp = totals[(month, aid)]
+            diff = amount(i) - erp
+            out[i].update({"activity": acts.names[aid], "erp_amount": erp, "diff": diff,
+                           "status": "✅ Match" if abs(diff) < AMOUNT_TOL else "⚠️ Variance"})
+    return out
@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# --- 并发会话压测 (Load Test) ---
+# 用 Streamlit 的 AppTest 在同一进程里开 N 个模拟会话，轮流切换 Budget.py 的页面，
+# 数据库换成内存里的假数据 (_StandIn，可加固定网络延迟)。和真实部署一样，所有会话共用
+# 进程级缓存 (st.cache_data / cache_resource) 和 GIL，所以能看出缓存命中与排队的效果。
+# 输出：每个页面 rerun 延迟分位数、每次 rerun 的数据库请求数、每个会话的 session_state 大小和进程内存。
+# 命令行：python loadtest.py --sessions 10 --rounds 3 [--pages "Dashboard,1. Log Sales Data"] [--db-latency-ms 30] [--json out.json]
+# 本地 SQLite (数据版本、汇总等) 写到临时目录，不影响 .local_data。
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Budget.py")
+PAGE_KEY = "_loadtest_page"     # 会话当前页面，_StandIn 用它把请求记到页面上
+
+# 需要外部服务 / 会写数据的页面默认跳过
+SKIP_PAGES = {"5. 3rd Party Invoice Check", "6. 🛠️ DEBUG MODELS"}
+
+# --- A. 数据库替身 ---
+class _Query:
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.rows = db.tables.setdefault(table, [])
+        self.columns, self.filters, self.orders = "*", [], []
+        self.bounds, self.op = None, None
+
+    def select(self, columns="*", **kwargs):
+        self.columns = columns
+        return self
+
+    def _f(self, fn):
+        self.filters.append(fn)
+        return self
+
+    def eq(self, c, v): return self._f(lambda r: r.get(c) == v)
+    def neq(self, c, v): return self._f(lambda r: r.get(c) != v)
+    def gt(self, c, v): return self._f(lambda r: r.get(c) is not None and r[c] > v)
+    def gte(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r[c]) >= str(v))
+    def lt(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r[c]) < str(v))
+    def lte(self, c, v): return self._f(lambda r: r.get(c) is not None and str(r[c]) <= str(v))
+    def in_(self, c, v): return self._f(lambda r, v=set(v): r.get(c) in v)
+    def ilike(self, c, v):
+        pat = re.compile("^" + re.escape(v).replace("%", ".*") + "$", re.I)
+        return self._f(lambda r: pat.match(str(r.get(c) or "")) is not None)
+
+    def order(self, c, desc=False, **kwargs):
+        self.orders.append((c, desc))
+        return self
+
+    def range(self, a, b):
+        self.bounds = (a, b + 1)
+        return self
+
+    def limit(self, n):
+        self.bounds = (0, n)
+        return self
+
+    def insert(self, rows, **kwargs): self.op = ("insert", rows); return self
+    def upsert(self, rows, **kwargs): self.op = ("upsert", rows); return self
+    def update(self, values): self.op = ("update", values); return self
+    def delete(self): self.op = ("delete", None); return self
+
+    def _project(self, rows):
+        plain = [p.strip() for p in re.sub(r"\w+\([^)]*\)", "", self.columns).split(",") if p.strip()]
+        embeds = re.findall(r"(\w+)\(([^)]*)\)", self.columns)
+        out = []
+        for r in rows:
+            d = dict(r) if "*" in plain else {c: r.get(c) for c in plain}
+            for dim, cols in embeds:
+                fk = self.db.EMBED_FK.get(dim)
+                ref = self.db.index(dim).get(r.get(fk)) if fk else None
+                d[dim] = {c.strip(): ref.get(c.strip()) for c in cols.split(",")} if ref else None
+            out.append(d)
+        return out
+
+    def execute(self):
+        self.db.count(self.table, self.op[0] if self.op else "select")
+        if self.db.latency: time.sleep(self.db.latency)
+        rows = [r for r in self.rows if all(f(r) for f in self.filters)]
+        if self.op:      # 写入只记数，不改数据 (保证每轮结果一致)
+            return _Result(self.op[1] if isinstance(self.op[1], list) else [])
+        for c, desc in reversed(self.orders):
+            rows.sort(key=lambda r: (r.get(c) is None, str(r.get(c))), reverse=desc)
+        if self.bounds: rows = rows[self.bounds[0]:self.bounds[1]]
+        return _Result(self._project(rows))
+
+class _Result:
+    def __init__(self, data): self.data = data
+
+class _StandIn:
+    """内存数据库：接口与 supabase client 的 table() 链式调用一致，按 页面 × 表 统计请求数"""
+    EMBED_FK = {"dim_products": "grade_id", "dim_cost_activities": "activity_id", "dim_forests": "forest_id"}
+
+    def __init__(self, tables, latency_ms=0):
+        self.tables, self.latency = tables, latency_ms / 1000
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self._idx = {}
+
+    def index(self, table):
+        if table not in self._idx: self._idx[table] = {r['id']: r for r in self.tables.get(table, [])}
+        return self._idx[table]
+
+    def count(self, table, op):
+        page = None
+        try:
+            import streamlit as st
+            page = st.session_state.get(PAGE_KEY)
+        except Exception:
+            pass
+        with self.lock: self.calls[(page, table, op)] += 1
+
+    def table(self, name):
+        return _Query(self, name)
+
+    def warm_up(self): pass
+    def health(self): return {"circuit": "closed", "warming": False}
+
+def make_data(forests=3, tickets=5000, years=(2025, 2026), seed=0):
+    """合成数据：维度表 + 两年的 Budget/Actual 月度事实 + 销售票据 + 发票存档"""
+    rng = np.random.default_rng(seed)
+    t = {
+        "dim_forests": [{"id": i + 1, "name": f"Forest {i + 1}"} for i in range(forests)],
+        "dim_products": [{"id": i + 1, "grade_code": g} for i, g in enumerate(["A", "K", "KI", "KIS", "P", "S", "SX", "PULP", "CHIP", "UM"])],
+        "dim_cost_activities": [{"id": i + 1, "activity_name": f"Activity {i + 1:02d}"} for i in range(15)],
+    }
+    t["dim_gl_mappings"] = [{"forest_id": f['id'], "item_type": "Cost", "item_id": a['id'], "gl_code": f"5{a['id']:03d}", "gl_name": a['activity_name']}
+                            for f in t["dim_forests"] for a in t["dim_cost_activities"]]
+    prod, cost, n = [], [], 0
+    for f in t["dim_forests"]:
+        for y in years:
+            for m in range(1, 13):
+                for rt in ("Budget", "Actual"):
+                    for p in t["dim_products"]:
+                        n += 1
+                        vol = float(rng.uniform(100, 2000))
+                        prod.append({"id": n, "forest_id": f['id'], "grade_id": p['id'], "month": f"{y}-{m:02d}-01", "record_type": rt,
+                                     "vol_tonnes": vol, "vol_jas": vol * 0.8, "price_jas": 150.0, "amount": vol * 120})
+                    for a in t["dim_cost_activities"]:
+                        n += 1
+                        q = float(rng.uniform(1, 100))
+                        cost.append({"id": n, "forest_id": f['id'], "activity_id": a['id'], "month": f"{y}-{m:02d}-01", "record_type": rt,
+                                     "quantity": q, "unit_rate": 50.0, "total_amount": q * 50})
+    t["fact_production_volume"], t["fact_operational_costs"] = prod, cost
+    days = pd.date_range(f"{years[0]}-01-01", f"{years[-1]}-12-31").strftime("%Y-%m-%d").to_numpy()
+    t["actual_sales_transactions"] = [{
+        "id": i + 1, "forest_id": int(rng.integers(1, forests + 1)), "grade_id": int(rng.integers(1, 11)),
+        "date": str(days[rng.integers(0, len(days))]), "ticket_number": f"T{i + 1:06d}",
+        "compartment": str(rng.choice(["60810", "60812", "60814", "General"])), "customer": "C001",
+        "market": str(rng.choice(["Export", "Domestic"])), "sale_type": "Purchase (Inv)",
+        "net_tonnes": 30.0, "jas": 25.0, "price": 120.0, "levy_deduction": 8.1, "total_value": 3591.9, "price_book_id": None,
+    } for i in range(tickets)]
+    t["invoice_archive"] = [{"id": i + 1, "invoice_no": f"INV{i:05d}", "vendor": f"Vendor {i % 20}", "invoice_date": str(days[i % len(days)]),
+                             "description": "Harvesting services", "amount": 1000.0 + i, "file_name": f"inv{i}.pdf",
+                             "file_url": None, "status": "Pending"} for i in range(500)]
+    return t
+
+# --- B. 会话 ---
+def _sizeof(obj, seen=None):
+    """session_state 里对象的大致字节数 (DataFrame 用 deep memory_usage)"""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    if isinstance(obj, pd.DataFrame): return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)): return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray): return obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict): size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)): size += sum(_sizeof(v, seen) for v in obj)
+    return size
+
+def _session_bytes(at):
+    try: state = at.session_state.to_dict()
+    except Exception: return 0
+    state.pop(PAGE_KEY, None)
+    return _sizeof(state)
+
+def _rerun(at, results, sid, r, page, action):
+    at.session_state[PAGE_KEY] = page
+    t0 = time.perf_counter()
+    error = None
+    try:
+        action()
+        if at.exception: error = at.exception[0].message
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    results.append({"session": sid, "round": r, "page": page, "ms": (time.perf_counter() - t0) * 1000,
+                    "error": error, "state_bytes": _session_bytes(at)})
+
+def _share_runtime():
+    """
+    AppTest 每次 run 都把全局 Runtime._instance 设成自己的 mock，结束时再清成 None，
+    多个会话并发时会互相清掉。这里让 Runtime.instance() 在 _instance 为空时返回最近一次的 mock，
+    并把 global.appTest 固定为 True (AppTest 退出时会恢复成进入时的值)。
+    """
+    from streamlit import config
+    from streamlit.runtime.runtime import Runtime
+    last = [None]
+    def instance(cls):
+        if cls._instance is not None: last[0] = cls._instance
+        if last[0] is None: raise RuntimeError("Runtime hasn't been created!")
+        return last[0]
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or last[0] is not None)
+    config.set_option("global.appTest", True)
+
+def run_session(sid, pages, rounds, timeout, results):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    # 首次打开 (默认页面)，之后每轮依次切换所有页面
+    _rerun(at, results, sid, 0, "(first load)", at.run)
+    for r in range(rounds):
+        for page in pages:
+            _rerun(at, results, sid, r, page, lambda: at.sidebar.radio[0].set_value(page).run())
+    return sid
+
+def _rss_mb():
+    # Linux ru_maxrss 单位 KB，macOS 为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+# --- C. 汇总 ---
+def report(results, db, sessions, rss_before, rss_after):
+    df = pd.DataFrame(results)
+    calls = pd.DataFrame([{"page": p, "table": t, "op": op, "n": n} for (p, t, op), n in db.calls.items()])
+    runs = df.groupby('page').size()
+    lat = df.groupby('page')['ms'].describe(percentiles=[.5, .95, .99])[['count', '50%', '95%', '99%', 'max']]
+    lat.columns = ['reruns', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    lat['errors'] = df.groupby('page')['error'].apply(lambda s: int(s.notna().sum()))
+    # 第一轮 (冷缓存) 和之后 (热缓存) 分开看
+    lat['cold_p50_ms'] = df[df['round'] == 0].groupby('page')['ms'].median()
+    lat['warm_p50_ms'] = df[df['round'] > 0].groupby('page')['ms'].median()
+    if not calls.empty:
+        per_page = calls.groupby('page')['n'].sum()
+        lat['queries_per_rerun'] = (per_page / runs).reindex(lat.index).fillna(0).round(2)
+        lat['writes'] = calls[calls['op'] != 'select'].groupby('page')['n'].sum().reindex(lat.index).fillna(0).astype(int)
+    state = df.groupby('session')['state_bytes'].max()
+    return {
+        "pages": lat.reset_index(),
+        "tables": calls.groupby(['page', 'table'], as_index=False)['n'].sum().sort_values('n', ascending=False) if not calls.empty else calls,
+        "overall": {
+            "sessions": sessions, "reruns": len(df),
+            "p50_ms": float(df['ms'].median()), "p95_ms": float(df['ms'].quantile(.95)), "p99_ms": float(df['ms'].quantile(.99)),
+            "errors": int(df['error'].notna().sum()),
+            "session_state_kb_avg": float(state.mean() / 1024), "session_state_kb_max": float(state.max() / 1024),
+            "rss_mb_start": rss_before, "rss_mb_peak": rss_after,
+            "rss_mb_per_session": (rss_after - rss_before) / max(sessions, 1),
+        },
+        "errors": df[df['error'].notna()][['session', 'page', 'error']].drop_duplicates(['page', 'error']),
+    }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Concurrent-session load test for Budget.py")
+    ap.add_argument("--sessions", type=int, default=5)
+    ap.add_argument("--rounds", type=int, default=3, help="each session visits every page this many times")
+    ap.add_argument("--pages", default="", help="comma-separated page names (default: all read-only pages)")
+    ap.add_argument("--tickets", type=int, default=5000)
+    ap.add_argument("--forests", type=int, default=3)
+    ap.add_argument("--db-latency-ms", type=float, default=0.0, help="simulated round-trip per query")
+    ap.add_argument("--timeout", type=float, default=60.0, help="per-rerun timeout (s)")
+    ap.add_argument("--json", help="also write the report to this file")
+    args = ap.parse_args(argv)
+
+    import tempfile
+    os.environ.setdefault("FCO_DATA_DIR", tempfile.mkdtemp(prefix="fco_loadtest_"))
+    sys.path.insert(0, os.path.dirname(APP))
+    import backend
+    from streamlit import logger
+    logger.set_log_level("error")       # 压测时不刷 deprecation 日志
+    db = _StandIn(make_data(args.forests, args.tickets), args.db_latency_ms)
+    backend.supabase = db
+    _share_runtime()
+
+    # 页面列表直接从 Budget.py 的 pages 字典里读，保持同步
+    src = open(APP, encoding="utf-8").read()
+    all_pages = re.findall(r'^\s*"([^"]+)":\s*(?:views_|lambda)', src, re.M)
+    pages = [p.strip() for p in args.pages.split(",") if p.strip()] or [p for p in all_pages if p not in SKIP_PAGES]
+
+    results = []
+    rss_before = _rss_mb()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        list(pool.map(lambda i: run_session(i, pages, args.rounds, args.timeout, results), range(args.sessions)))
+    wall = time.perf_counter() - t0
+    rep = report(results, db, args.sessions, rss_before, _rss_mb())
+    rep["overall"]["wall_s"] = wall
+
+    pd.set_option("display.width", 200)
+    print(f"\n=== {args.sessions} sessions × {args.rounds} rounds × {len(pages)} pages in {wall:.1f}s ===")
+    print(rep["pages"].to_string(index=False, float_format=lambda v: f"{v:,.1f}"))
+    print("\n--- Top tables by query count ---")
+    print(rep["tables"].head(15).to_string(index=False))
+    print("\n--- Overall ---")
+    for k, v in rep["overall"].items(): print(f"{k:>22}: {v:,.1f}" if isinstance(v, float) else f"{k:>22}: {v}")
+    if not rep["errors"].empty:
+        print("\n--- Errors ---")
+        print(rep["errors"].to_string(index=False))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({k: (v.astype(object).where(v.notna(), None).to_dict('records') if isinstance(v, pd.DataFrame) else v)
+                       for k, v in rep.items()}, f, indent=2, default=str)
+
+if __name__ == "__main__":
+    main()
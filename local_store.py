@@ -0,0 +1,26 @@
+import os
+import sqlite3
+
+# --- 本地 SQLite 存储 (后台任务、索引、统计等共用) ---
+# 放在 .local_data/ 下，不进 git；可用 FCO_DATA_DIR 环境变量改位置
+DATA_DIR = os.environ.get("FCO_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".local_data"))
+DB_PATH = os.path.join(DATA_DIR, "fco_local.db")
+
+def connect():
+    """
+    每次调用返回一个新连接 (短连接，线程安全)，用完请 close。
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+def ensure_schema(ddl):
+    conn = connect()
+    try:
+        conn.executescript(ddl)
+        conn.commit()
+    finally:
+        conn.close()
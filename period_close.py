@@ -0,0 +1,143 @@
+import json
+import pandas as pd
+from datetime import datetime
+import backend
+import frames
+
+# --- 月结 (Period Close) ---
+# 关账后，林地-月份 在 period_closes 表里存一份不可变的预聚合结果
+# (按 activity / grade + GL 汇总的成本和收入、预算成本)，之后的读取直接用这份结果；
+# 所有写入路径在写之前检查该月是否已关账，已关账则拒绝。
+# period_closes: forest_id, month, closed_at, closed_by, payload (json)，(forest_id, month) 唯一
+
+COST_KEYS = ['activity_id', 'activity', 'gl_code', 'gl_desc']
+SALES_KEYS = ['grade_id', 'grade', 'gl_code', 'gl_desc', 'sale_type']
+
+# 关账只锁实际数和正式预算；预算情景 (record_type = "Scenario:<名称>") 在已关账月份仍可修改
+LOCKED_TYPES = ("Actual", "Budget")
+
+class PeriodLockedError(Exception):
+    pass
+
+def _month_key(month):
+    return f"{str(month)[:7]}-01"
+
+def _month_end(target_date):
+    y, m = int(target_date[:4]), int(target_date[5:7])
+    return f"{y + 1}-01-01" if m == 12 else f"{y}-{m + 1:02d}-01"
+
+# --- A. 锁状态 ---
+def closed_months(forest_id):
+    """该林地已关账的月份集合 ('YYYY-MM-01')，按数据版本缓存"""
+    rows = backend.cached_select("period_closes", "month", filters=[("eq", "forest_id", forest_id)], forest_id=forest_id)
+    return {_month_key(r['month']) for r in rows}
+
+def locks(record_type):
+    """该 record_type 是否受关账限制"""
+    return record_type in LOCKED_TYPES
+
+def is_closed(forest_id, month):
+    return _month_key(month) in closed_months(forest_id)
+
+def assert_open(forest_id, months):
+    """
+    写入前调用：months 为单个月份或列表。直接查库 (不走缓存)，
+    避免其它实例刚关账而本地缓存还没更新。
+    """
+    if not backend.supabase: return
+    if months is None or isinstance(months, str): months = [months]
+    keys = sorted({_month_key(m) for m in months if m})
+    if not keys: return
+    rows = backend.supabase.table("period_closes").select("month")\
+        .eq("forest_id", forest_id).in_("month", keys).execute().data
+    if rows:
+        locked = ", ".join(sorted(_month_key(r['month'])[:7] for r in rows))
+        raise PeriodLockedError(f"Period closed for {locked} — reopen it before editing.")
+
+# --- B. 期间数据 (实时计算) ---
+def compute_period(forest_id, target_date):
+    """
+    实时计算一个 林地-月 的分析数据，返回 (df_costs, df_sales, budget_costs)：
+      df_costs: activity_id, activity, gl_code, gl_desc, total_amount
+      df_sales: grade_id, grade, gl_code, gl_desc, sale_type, total_value, net_tonnes, jas
+    """
+    end_date = _month_end(target_date)
+    cost_map, rev_map = backend.get_gl_mapping(forest_id)
+
+    sales_data = backend.cached_select(
+        "actual_sales_transactions", "*, dim_products(grade_code)",
+        filters=[("eq", "forest_id", forest_id), ("gte", "date", target_date), ("lt", "date", end_date)],
+        depends_on=["dim_products"], forest_id=forest_id, month=target_date)
+    df_sales = frames.load_frame("actual_sales_transactions", sales_data)
+
+    cost_data = backend.cached_select(
+        "fact_operational_costs", "*, dim_cost_activities(activity_name)",
+        filters=[("eq", "forest_id", forest_id), ("eq", "month", target_date), ("eq", "record_type", "Actual")],
+        depends_on=["dim_cost_activities"], forest_id=forest_id, month=target_date)
+    df_costs = frames.load_frame("fact_operational_costs", cost_data)
+
+    # Activity Name / Grade Code 已在加载时展平；GL Mapping 用 map 向量化，然后按报表维度汇总
+    if not df_costs.empty:
+        df_costs['activity'] = df_costs['activity_name'].astype(object).fillna('Unknown')
+        df_costs['gl_code'] = df_costs['activity_id'].map({k: v['code'] for k, v in cost_map.items()}).fillna("UNMAPPED")
+        df_costs['gl_desc'] = df_costs['activity_id'].map({k: v['name'] for k, v in cost_map.items()}).fillna(df_costs['activity'])
+        df_costs = df_costs.groupby(COST_KEYS, as_index=False, dropna=False)['total_amount'].sum()
+    else:
+        df_costs = pd.DataFrame(columns=COST_KEYS + ['total_amount'])
+
+    if not df_sales.empty:
+        df_sales['grade'] = df_sales['grade_code'].astype(object).fillna('Unknown')
+        df_sales['gl_code'] = df_sales['grade_id'].map({k: v['code'] for k, v in rev_map.items()}).fillna("UNMAPPED")
+        df_sales['gl_desc'] = df_sales['grade_id'].map({k: v['name'] for k, v in rev_map.items()}).fillna("Log Sales - " + df_sales['grade'])
+        if 'sale_type' not in df_sales.columns: df_sales['sale_type'] = "Purchase (Inv)"
+        df_sales['sale_type'] = df_sales['sale_type'].astype(object).fillna("")
+        df_sales = df_sales.groupby(SALES_KEYS, as_index=False, dropna=False)[['total_value', 'net_tonnes', 'jas']].sum()
+    else:
+        df_sales = pd.DataFrame(columns=SALES_KEYS + ['total_value', 'net_tonnes', 'jas'])
+
+    bud_costs = backend.cached_select("fact_operational_costs", "total_amount",
+        filters=[("eq", "forest_id", forest_id), ("eq", "month", target_date), ("eq", "record_type", "Budget")],
+        forest_id=forest_id, month=target_date)
+    budget_costs = float(sum((x['total_amount'] or 0) for x in bud_costs)) if bud_costs else 0.0
+    return df_costs, df_sales, budget_costs
+
+# --- C. 读取 (已关账读快照，否则实时计算) ---
+def get_period(forest_id, target_date):
+    """返回 (df_costs, df_sales, budget_costs, closed_info)；closed_info 为 None 表示未关账"""
+    if is_closed(forest_id, target_date):
+        rows = backend.cached_select("period_closes", "closed_at, closed_by, payload",
+            filters=[("eq", "forest_id", forest_id), ("eq", "month", _month_key(target_date))],
+            forest_id=forest_id, month=target_date)
+        if rows:
+            p = rows[0]['payload']
+            if isinstance(p, str): p = json.loads(p)
+            df_costs = pd.DataFrame(p['costs'], columns=COST_KEYS + ['total_amount'])
+            df_sales = pd.DataFrame(p['sales'], columns=SALES_KEYS + ['total_value', 'net_tonnes', 'jas'])
+            return df_costs, df_sales, float(p.get('budget_costs') or 0), {"closed_at": rows[0]['closed_at'], "closed_by": rows[0].get('closed_by')}
+    return compute_period(forest_id, target_date) + (None,)
+
+# --- D. 关账 / 重开 ---
+def _records(df):
+    return json.loads(df.to_json(orient='records'))
+
+def close_period(forest_id, target_date, closed_by=""):
+    """计算并写入不可变快照；已关账时抛 PeriodLockedError"""
+    month = _month_key(target_date)
+    assert_open(forest_id, month)
+    df_costs, df_sales, budget_costs = compute_period(forest_id, month)
+    payload = {
+        "costs": _records(df_costs), "sales": _records(df_sales), "budget_costs": budget_costs,
+        "totals": {"costs": float(df_costs['total_amount'].sum()), "revenue": float(df_sales['total_value'].sum()),
+                   "variance": budget_costs - float(df_costs['total_amount'].sum())},
+    }
+    backend.supabase.table("period_closes").insert({
+        "forest_id": forest_id, "month": month, "closed_at": datetime.now().isoformat(),
+        "closed_by": closed_by, "payload": payload
+    }).execute()
+    backend.bump_data_version("period_closes", forest_id, month)
+    return payload
+
+def reopen_period(forest_id, target_date):
+    month = _month_key(target_date)
+    backend.supabase.table("period_closes").delete().eq("forest_id", forest_id).eq("month", month).execute()
+    backend.bump_data_version("period_closes", forest_id, month)
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+import backend
+import period_close
+import change_log
+
+# --- 价格本 (Price Book) ---
+# price_book: id, grade_id, market, customer, price, unit ('tonne' / 'JAS'), levy_per_tonne,
+#             effective_from, effective_to (含当天，空 = 一直有效)
+#   market / customer 为空表示通配。同一票据按 具体程度 匹配：
+#   grade+market+customer > grade+customer (任意市场) > grade+market > grade。
+#   同一组合时间段重叠时，取 effective_from 最晚的那条。
+# 查找用 merge_asof：每个组合按 effective_from 排好序，票据日期一次性二分定位，整批向量化，不逐行查。
+# actual_sales_transactions.price_book_id 记录价格来自哪条价格本 (手填价格为空)，
+#   价格本追溯修改后 revalue() 只重算这些票据。
+
+PAGE = 1000
+LEVELS = [["grade_id", "market", "customer"], ["grade_id", "customer"], ["grade_id", "market"], ["grade_id"]]
+WILDCARDS = ["market", "customer"]
+
+def _norm(s):
+    return s.astype(object).where(s.notna(), None).map(lambda v: None if v is None or str(v).strip() == "" else str(v).strip().upper())
+
+def get_price_book():
+    """价格本 DataFrame (日期已转为 datetime)"""
+    rows = backend.cached_select("price_book", "*")
+    cols = ["id", "grade_id", "market", "customer", "price", "unit", "levy_per_tonne", "effective_from", "effective_to"]
+    df = pd.DataFrame(rows) if rows else pd.DataFrame(columns=cols)
+    df = df.reindex(columns=cols)
+    df['effective_from'] = pd.to_datetime(df['effective_from'], errors='coerce')
+    df['effective_to'] = pd.to_datetime(df['effective_to'], errors='coerce')
+    df['price'] = pd.to_numeric(df['price'], errors='coerce')
+    df['levy_per_tonne'] = pd.to_numeric(df['levy_per_tonne'], errors='coerce')
+    df['unit'] = df['unit'].fillna("tonne")
+    return df
+
+def lookup(tickets, book=None):
+    """
+    tickets: 含 grade_id, market, customer, date 的 DataFrame
+    返回与 tickets 同 index 的 DataFrame: price_book_id, price, unit, levy_per_tonne (没匹配到为 NaN)
+    """
+    out = pd.DataFrame(index=tickets.index, columns=["price_book_id", "price", "unit", "levy_per_tonne"], dtype=object)
+    book = get_price_book() if book is None else book
+    book = book.dropna(subset=["grade_id", "effective_from", "price"])
+    if tickets.empty or book.empty: return out.astype({"price": float, "levy_per_tonne": float})
+
+    t = pd.DataFrame({
+        "_row": np.arange(len(tickets)),
+        "grade_id": pd.to_numeric(tickets['grade_id'], errors='coerce') if 'grade_id' in tickets else np.nan,
+        "market": _norm(tickets['market']) if 'market' in tickets else None,
+        "customer": _norm(tickets['customer']) if 'customer' in tickets else None,
+        "date": pd.to_datetime(tickets['date'], errors='coerce').astype("datetime64[ns]"),
+    }).dropna(subset=["grade_id", "date"]).sort_values("date")
+    t['grade_id'] = t['grade_id'].astype("int64")
+    b = book.assign(grade_id=pd.to_numeric(book['grade_id']).astype("int64"), market=_norm(book['market']), customer=_norm(book['customer']),
+                    effective_from=book['effective_from'].astype("datetime64[ns]"), effective_to=book['effective_to'].astype("datetime64[ns]"))
+
+    found = np.full(len(tickets), -1, dtype=np.int64)      # 命中的 book 行号，-1 = 未命中
+    b = b.reset_index(drop=True).assign(_b=lambda d: np.arange(len(d)))
+    for by in LEVELS:
+        # 这一层：by 里的列必须有值，其余通配列必须为空
+        rest = [c for c in WILDCARDS if c not in by]
+        right = b.dropna(subset=by)
+        for c in rest: right = right[right[c].isna()]
+        left = t[found[t['_row']] < 0].dropna(subset=by)
+        if right.empty or left.empty: continue
+        m = pd.merge_asof(left[["_row", "date"] + by].astype({c: str for c in by}),
+                          right[["_b", "effective_from", "effective_to"] + by].astype({c: str for c in by}).sort_values("effective_from"),
+                          left_on="date", right_on="effective_from", by=by, direction="backward")
+        ok = m['_b'].notna() & (m['effective_to'].isna() | (m['date'] <= m['effective_to']))
+        found[m.loc[ok, '_row'].to_numpy()] = m.loc[ok, '_b'].astype(int).to_numpy()
+
+    hit = found >= 0
+    rows = b.iloc[found[hit]]
+    out.loc[out.index[hit], "price_book_id"] = rows['id'].to_numpy()
+    out.loc[out.index[hit], "price"] = rows['price'].to_numpy()
+    out.loc[out.index[hit], "unit"] = rows['unit'].to_numpy()
+    out.loc[out.index[hit], "levy_per_tonne"] = rows['levy_per_tonne'].to_numpy()
+    return out.astype({"price": float, "levy_per_tonne": float})
+
+def _kept(df, loaded):
+    """已有 price_book_id、且价格和匹配条件 (grade / market / customer / 日期) 都没改的行"""
+    if loaded is None or 'price_book_id' not in df: return pd.Series(False, index=df.index)
+    loaded = loaded.reindex(index=df.index)
+    same = pd.to_numeric(df['price_book_id'], errors='coerce').notna() \
+        & np.isclose(df['price'], pd.to_numeric(loaded.get('price'), errors='coerce'))
+    same &= pd.to_numeric(df['grade_id'], errors='coerce').eq(pd.to_numeric(loaded.get('grade_id'), errors='coerce'))
+    same &= df['date'].astype(str).str[:10].eq(loaded.get('date').astype(str).str[:10])
+    for c in WILDCARDS:
+        a = _norm(df[c]) if c in df else pd.Series(None, index=df.index, dtype=object)
+        b = _norm(loaded[c]) if c in loaded else pd.Series(None, index=df.index, dtype=object)
+        same &= a.eq(b) | (a.isna() & b.isna())
+    return same.fillna(False).astype(bool)
+
+def apply_prices(df, book=None, loaded=None):
+    """
+    Log Sales 保存前调用 (整批向量化)：
+      - price 为 0 / 空的票据，用价格本补价格
+      - levy_deduction 为 0 且价格本有 levy 单价时，levy = 吨数 × levy 单价
+      - 价格等于价格本价格的票据记下 price_book_id，并按 数量 × 价格 - levy 重算 total_value；
+        其余 (手填价格) total_value 仍只在为 0 时计算
+    loaded: 打开表格时的原始行 (与 df 同 index，新行为空)。已按价格本定价、且价格 / 匹配条件没改的票据
+      保留原来的 price_book_id 和金额，不重新匹配 (价格本追溯修改后由 revalue() 统一重算)。
+    返回新的 DataFrame (不修改传入的)
+    """
+    df = df.copy()
+    for c in ["net_tonnes", "jas", "price", "levy_deduction", "total_value"]:
+        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0) if c in df else 0.0
+    keep = _kept(df, loaded)
+    before = df.loc[keep, ["price", "levy_deduction", "total_value", "price_book_id"]].copy()
+    hit = lookup(df, book)
+
+    has = hit['price'].notna()
+    df['price'] = np.where((df['price'] == 0) & has, hit['price'], df['price'])
+    from_book = has & np.isclose(df['price'], hit['price'])
+    df['price_book_id'] = hit['price_book_id'].where(from_book, None)
+
+    levy_rate = hit['levy_per_tonne']
+    df['levy_deduction'] = np.where((df['levy_deduction'] == 0) & from_book & levy_rate.notna(),
+                                    df['net_tonnes'] * levy_rate.fillna(0.0), df['levy_deduction'])
+    qty = np.where(hit['unit'].astype(str).str.upper() == "JAS", df['jas'], df['net_tonnes'])
+    calc = qty * df['price'] - df['levy_deduction']
+    recalc = from_book | ((df['total_value'] == 0) & (df['price'] != 0))
+    df['total_value'] = np.where(recalc, calc, df['total_value']).round(2)
+    df.loc[keep, before.columns] = before
+    return df
+
+# --- 追溯重估 ---
+def _fetch_priced(start, end, forest_id=None, grade_id=None):
+    out, offset = [], 0
+    while True:
+        q = backend.supabase.table("actual_sales_transactions").select("*")\
+            .gte("date", start).lt("date", end).gt("price_book_id", 0)
+        if forest_id is not None: q = q.eq("forest_id", forest_id)
+        if grade_id is not None: q = q.eq("grade_id", grade_id)
+        rows = q.order("id").range(offset, offset + PAGE - 1).execute().data
+        out.extend(rows)
+        if len(rows) < PAGE: return out
+        offset += PAGE
+
+def revalue(start, end, forest_id=None, grade_id=None, apply=False):
+    """
+    价格本修改后，重算 [start, end) 内按价格本定价的票据。
+    返回 (changes, skipped)：changes 为有变化的票据 (旧值 / 新值)，skipped 为落在已关账月份、未写入的条数。
+    apply=False 只预览。
+    """
+    rows = _fetch_priced(start, end, forest_id, grade_id)
+    cols = ["id", "forest_id", "date", "grade_id", "price_old", "price", "levy_old", "levy_deduction", "total_old", "total_value"]
+    if not rows: return pd.DataFrame(columns=cols), 0
+    df = pd.DataFrame(rows)
+    # 按价格本重新定价：先清空旧价格 (价格本有 levy 单价时也清空 levy)，让 apply_prices 全部重新取
+    book = get_price_book()
+    levy = pd.to_numeric(df['levy_deduction'], errors='coerce').fillna(0.0).where(lookup(df, book)['levy_per_tonne'].isna(), 0.0)
+    new = apply_prices(df.assign(price=0.0, levy_deduction=levy, total_value=0.0), book)
+    df = df.assign(price_old=pd.to_numeric(df['price']), levy_old=pd.to_numeric(df['levy_deduction']),
+                   total_old=pd.to_numeric(df['total_value']), book_old=df['price_book_id'])
+    for c in ["price", "levy_deduction", "total_value", "price_book_id"]: df[c] = new[c]
+    # 价格本里已经匹配不到的票据保持原样
+    df = df[df['price_book_id'].notna()]
+    changed = df[~(np.isclose(df['price'], df['price_old']) & np.isclose(df['levy_deduction'], df['levy_old'])
+                   & np.isclose(df['total_value'], df['total_old']))]
+
+    # 已关账月份不改
+    locked = {f: period_close.closed_months(f) for f in changed['forest_id'].unique()}
+    month = changed['date'].astype(str).str[:7] + "-01"
+    closed = pd.Series([m in locked[f] for f, m in zip(changed['forest_id'], month)], index=changed.index, dtype=bool)
+    if apply and not changed[~closed].empty:
+        todo = changed[~closed]
+        t = todo.drop(columns=["price_old", "levy_old", "total_old", "book_old"])
+        recs = t.astype(object).where(t.notna(), None).to_dict('records')
+        for r in recs: r['price_book_id'] = int(r['price_book_id'])
+        backend.upsert_chunked("actual_sales_transactions", recs, on_conflict="id")
+        # 修改日志：旧值就是重估前的价格 / levy / 金额 / 价格本链接
+        o = todo.assign(price=todo['price_old'], levy_deduction=todo['levy_old'], total_value=todo['total_old'], price_book_id=todo['book_old'])
+        old = o.drop(columns=["price_old", "levy_old", "total_old", "book_old"]).astype(object)
+        old = old.where(old.notna(), None).to_dict('records')
+        for f, g in todo.groupby('forest_id'):
+            backend.bump_data_version("actual_sales_transactions", f, sorted(set(g['date'].astype(str).str[:7])))
+            change_log.log_changes("actual_sales_transactions", f, [r for r in old if r['forest_id'] == f],
+                                   [r for r in recs if r['forest_id'] == f])
+    return changed.reindex(columns=cols), int(closed.sum())
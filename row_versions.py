@@ -0,0 +1,206 @@
+import re
+import numpy as np
+import pandas as pd
+import streamlit as st
+import backend
+import change_log
+
+# --- 乐观并发 (Row Versions) ---
+# 表格是整页保存的，两个人同时改同一个 林地-月 时后保存的人会把前一个人的改动整页覆盖。
+# fact_operational_costs / fact_production_volume / actual_sales_transactions 各加一列 row_version：
+#   ALTER TABLE ... ADD COLUMN row_version INTEGER NOT NULL DEFAULT 1;
+#   再加一个 BEFORE UPDATE 触发器 NEW.row_version := OLD.row_version + 1，
+#   这样 upsert / 重估 / 整年保存等其它写入路径也会让版本号前进。
+# 流程：
+#   - 表格第一次打开时把读到的行 (含 row_version) 存进 session_state 作为基线，之后的 rerun 直接用基线，不再整页重读
+#   - 保存时只写和基线相比真正改了的行，每行带 .eq("row_version", 基线版本) 条件更新；
+#     影响 0 行说明别人已经改过这一行 -> 记为冲突，不覆盖。其余行照常写入
+#   - 基线里没有的行 insert；别人已插入同一键 (唯一约束冲突) -> 冲突
+#   - 合并界面只按键重读冲突的那几行，逐行选 保留我的 / 用他们的
+
+VERSION = "row_version"
+STATE_KEY = "_row_versions"
+
+# 行键：最后一列是表格里区分行的列，前面的在同一张表格里固定 (用于按键重读时分组)
+KEYS = {
+    "fact_operational_costs": ["forest_id", "month", "record_type", "activity_id"],
+    "fact_production_volume": ["forest_id", "month", "record_type", "grade_id"],
+    "actual_sales_transactions": ["id"],
+}
+
+class SaveResult:
+    """saved: 写入后的行 (Supabase 返回)；conflicts: [{key, mine, base}]；skipped: 没改动未写入的行数"""
+    def __init__(self, saved=None, conflicts=None, skipped=0):
+        self.saved, self.conflicts, self.skipped = saved or [], conflicts or [], skipped
+
+    def __bool__(self):
+        return not self.conflicts
+
+def _kv(v):
+    """键值统一成文本 (1 / 1.0 / '1' 相同；日期只取前 10 位)"""
+    if v is None or (isinstance(v, float) and np.isnan(v)): return None
+    if isinstance(v, (float, np.floating)) and float(v).is_integer(): return str(int(v))
+    s = str(v)
+    return s[:10] if re.match(r"\d{4}-\d{2}-\d{2}", s) else s
+
+def key(table_name, row):
+    return tuple(_kv(row.get(k)) for k in KEYS[table_name])
+
+def _version(row):
+    v = (row or {}).get(VERSION)
+    return None if v is None or pd.isna(v) else int(v)
+
+def _unchanged(table_name, base, row):
+    return all(change_log._same(change_log._text(base.get(f)), change_log._text(row.get(f)))
+               for f in change_log.TRACKED[table_name][1] if f in row)
+
+def _is_duplicate(e):
+    return "23505" in str(e) or "duplicate key" in str(e).lower()
+
+def to_rows(rows):
+    """DataFrame / list -> list of dict (NaN -> None)"""
+    if isinstance(rows, pd.DataFrame): rows = rows.astype(object).where(rows.notna(), None).to_dict('records')
+    return list(rows or [])
+
+# --- A. 条件写入 ---
+def save(table_name, forest_id, records, base_rows, month=None):
+    """
+    records: 表格里的行 (含行键)；base_rows: 打开表格时读到的行 (含 row_version)。
+    只写改过的行；基线版本已过期的行不写，作为冲突返回。返回 SaveResult。
+    """
+    fields = change_log.TRACKED[table_name][1]
+    base = {key(table_name, r): r for r in to_rows(base_rows)}
+    updates, inserts, skipped = [], [], 0
+    for r in to_rows(records):
+        o = base.get(key(table_name, r))
+        if o is not None and _unchanged(table_name, o, r):
+            skipped += 1
+        elif _version(o) is None:
+            inserts.append(r)
+        else:
+            updates.append((r, o))
+
+    saved, conflicts = [], []
+    for r, o in updates:
+        v = _version(o)
+        q = backend.supabase.table(table_name).update(dict({f: r[f] for f in fields if f in r}, **{VERSION: v + 1}))
+        for k in KEYS[table_name]: q = q.eq(k, r[k])
+        rows = q.eq(VERSION, v).execute().data
+        if rows: saved.extend(rows)
+        else: conflicts.append({"key": key(table_name, r), "mine": r, "base": o})
+
+    if inserts:
+        rows = [dict({k: v for k, v in r.items() if not (k == "id" and v is None)}, **{VERSION: 1}) for r in inserts]
+        try:
+            saved.extend(backend.supabase.table(table_name).insert(rows).execute().data or [])
+        except Exception as e:
+            if not _is_duplicate(e): raise
+            # 有行被别人抢先插入：逐行重试，找出是哪几行
+            for r, orig in zip(rows, inserts):
+                try: saved.extend(backend.supabase.table(table_name).insert(r).execute().data or [])
+                except Exception as e2:
+                    if not _is_duplicate(e2): raise
+                    conflicts.append({"key": key(table_name, orig), "mine": orig, "base": base.get(key(table_name, orig))})
+
+    if saved:
+        old = [base[key(table_name, r)] for r in saved if key(table_name, r) in base]
+        # 改了日期的行 (小票挪到别的月)：新旧两个月的缓存都要失效
+        months = sorted({f"{str(r.get('month') or r.get('date'))[:7]}-01" for r in saved + old if r.get('month') or r.get('date')})
+        backend.bump_data_version(table_name, forest_id, month or months)
+        change_log.log_changes(table_name, forest_id, old, saved, month)
+    return SaveResult(saved, conflicts, skipped)
+
+def fetch(table_name, rows):
+    """只按键重读这些行 (固定键相同的一组一次 in_ 查询)，返回 {key: 当前行}；被删掉的行不在结果里"""
+    *fixed, col = KEYS[table_name]
+    groups = {}
+    for r in to_rows(rows):
+        groups.setdefault(tuple(r.get(k) for k in fixed), []).append(r.get(col))
+    out = {}
+    for g, ids in groups.items():
+        q = backend.supabase.table(table_name).select("*")
+        for k, v in zip(fixed, g): q = q.eq(k, v)
+        for r in q.in_(col, [i for i in ids if i is not None]).execute().data:
+            out[key(table_name, r)] = r
+    return out
+
+# --- B. 表格基线 (session_state) ---
+def _store():
+    return st.session_state.setdefault(STATE_KEY, {})
+
+def baseline(grid, context, loader):
+    """
+    grid: 表格 key；context: 林地 / 月份 / 类型等 (变了就重新加载)；loader(): 返回含 row_version 的 DataFrame。
+    返回 {"df", "rev", "conflicts", ...}；同一 context 的 rerun 不重读。rev 变了表示基线已更新 (表格 key 带上它重建)。
+    """
+    store = _store()
+    b = store.get(grid)
+    if b is None or b['context'] != context:
+        b = store[grid] = {"context": context, "df": loader(), "rev": 0, "conflicts": [], "table": None}
+    return b
+
+def reload(grid):
+    _store().pop(grid, None)
+
+def apply(grid, table_name, rows):
+    """把写入后 / 重读到的行合并进基线 (按区分行的列对齐，没对上的追加)，表格随后重建"""
+    b = _store().get(grid)
+    if b is None or not rows: return
+    col = KEYS[table_name][-1]
+    df = b['df'].copy()
+    new = pd.DataFrame(to_rows(rows))
+    new = new[[c for c in new.columns if c in df.columns]]
+    pos = {_kv(v): i for i, v in zip(df.index, df[col])}
+    hit = new[col].map(_kv).map(pos)
+    idx = hit[hit.notna()].astype(int).to_numpy()
+    for c in new.columns:
+        if c == col or not len(idx): continue
+        vals = new.loc[hit.notna(), c]
+        if pd.api.types.is_numeric_dtype(df[c]): vals = pd.to_numeric(vals, errors='coerce')
+        else: df[c] = df[c].astype(object)
+        df.loc[idx, c] = vals.to_numpy()
+    b['df'] = pd.concat([df, new[hit.isna()]], ignore_index=True) if hit.isna().any() else df
+    b['rev'] += 1
+
+def _drop(grid, table_name, row):
+    """别人已删掉的行：从基线里去掉"""
+    b = _store().get(grid)
+    col = KEYS[table_name][-1]
+    if b is None or _kv(row.get(col)) is None: return
+    b['df'] = b['df'][b['df'][col].map(_kv) != _kv(row.get(col))].reset_index(drop=True)
+    b['rev'] += 1
+
+# --- C. 冲突 ---
+def set_conflicts(grid, table_name, result):
+    """保存后记下冲突 (并重读这些行的当前值)，供合并界面使用；没冲突时清空"""
+    b = _store().get(grid)
+    if b is None: return
+    theirs = fetch(table_name, [c['mine'] for c in result.conflicts]) if result.conflicts else {}
+    b['table'] = table_name
+    b['conflicts'] = [dict(c, theirs=theirs.get(c['key'])) for c in result.conflicts]
+
+def resolve(grid, forest_id, choices, month=None):
+    """
+    choices: {冲突序号: 'mine' / 'theirs'}。
+    'theirs' 把对方的当前行合并进基线；'mine' 以对方的当前版本为基线重新保存我的行 (又冲突则留在列表里)。
+    返回仍未解决的冲突数。
+    """
+    b = _store().get(grid)
+    if b is None or not b['conflicts']: return 0
+    table_name, left = b['table'], []
+    for i, c in enumerate(b['conflicts']):
+        pick = choices.get(i)
+        if pick == "theirs":
+            if c['theirs'] is not None: apply(grid, table_name, [c['theirs']])
+            else: _drop(grid, table_name, c['mine'])
+        elif pick == "mine":
+            mine = c['mine'] if c['theirs'] is not None else {k: v for k, v in c['mine'].items() if k != "id"}
+            res = save(table_name, forest_id, [mine], [c['theirs']] if c['theirs'] is not None else [], month)
+            apply(grid, table_name, res.saved)
+            if res.conflicts:
+                theirs = fetch(table_name, [mine]).get(key(table_name, mine))
+                left.append(dict(c, theirs=theirs))
+        else:
+            left.append(c)
+    b['conflicts'] = left
+    return len(left)
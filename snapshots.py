@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import time
+import streamlit as st
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import local_store
+import backend
+
+# --- 本地列式快照 (Parquet) ---
+# 把 app 用到的表导出到 .local_data/snapshots/<表>/，事实表按 林地 × 年 分文件。
+# 增量：对比 data_versions 与上次快照时记录的版本，只重写有变化的分区；维度表很小，每次全量。
+# 查询层 select() 返回与 PostgREST 相同格式的 list of dict (支持列投影、过滤、嵌套 join)，
+# backend.cached_select 在离线模式 / 数据库不可用时直接读这里。
+# 命令行：python snapshots.py [--full]
+
+SNAPSHOT_DIR = os.path.join(local_store.DATA_DIR, "snapshots")
+PAGE = 1000
+
+# 表 -> 按年分区用的日期列 (None = 不分区，整表一个文件)
+TABLES = {
+    "fact_production_volume": "month",
+    "fact_operational_costs": "month",
+    "actual_sales_transactions": "date",
+    "dim_forests": None,
+    "dim_products": None,
+    "dim_cost_activities": None,
+    "dim_gl_mappings": None,
+    "dim_compartments": None,
+    "price_book": None,
+    "invoice_archive": None,
+    "budget_scenarios": None,
+}
+
+# 嵌套 join "dim_x(col)" -> 事实表上的外键列
+EMBED_FK = {"dim_products": "grade_id", "dim_cost_activities": "activity_id", "dim_forests": "forest_id"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot_partitions (
+    table_name TEXT NOT NULL,
+    forest_id TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    written_at REAL,
+    PRIMARY KEY (table_name, forest_id, year)
+);
+"""
+
+def _path(table_name, forest_id='*', year=0):
+    if forest_id == '*': return os.path.join(SNAPSHOT_DIR, table_name, "all.parquet")
+    return os.path.join(SNAPSHOT_DIR, table_name, f"{forest_id}_{year}.parquet")
+
+# --- A. 写快照 ---
+def _fetch(table_name, filters=()):
+    out, offset = [], 0
+    while True:
+        q = backend.supabase.table(table_name).select("*")
+        for op, col, val in filters: q = getattr(q, op)(col, val)
+        rows = q.order("id").range(offset, offset + PAGE - 1).execute().data
+        out.extend(rows)
+        if len(rows) < PAGE: return out
+        offset += PAGE
+
+def _write(path, rows):
+    """原子写入 (先写临时文件再替换)；没有行时删除文件"""
+    if not rows:
+        if os.path.exists(path): os.remove(path)
+        return 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    pq.write_table(pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False), tmp, compression="zstd")
+    os.replace(tmp, path)
+    return len(rows)
+
+def _manifest(conn, table_name):
+    return {(r['forest_id'], r['year']): dict(r) for r in
+            conn.execute("SELECT * FROM snapshot_partitions WHERE table_name = ?", (table_name,))}
+
+def _stale_partitions(table_name, manifest):
+    """
+    data_versions 里版本比快照新的 (forest_id, year)；'*' 通配影响所有已有分区。
+    快照里还没有的林地整月通配 (month = '*') 时不知道涉及哪些年份，返回 (forest_id, None)：整个林地重新导出。
+    """
+    rows = [r for r in backend.changes_since(min((m['version'] for m in manifest.values()), default=0), table_name)]
+    forests = {f for f, _ in manifest}
+    stale = set()
+    for r in rows:
+        f_list = forests if r['forest_id'] == '*' else {str(r['forest_id'])}
+        for f in f_list:
+            if r['month'] == '*' and f not in forests:
+                stale.add((f, None))
+                continue
+            years = {y for (ff, y) in manifest if ff == f} if r['month'] == '*' else {int(r['month'][:4])}
+            for y in years:
+                if r['version'] > manifest.get((f, y), {}).get('version', 0): stale.add((f, y))
+    whole = {f for f, y in stale if y is None}
+    return {(f, y) for f, y in stale if y is None or f not in whole}
+
+def _record(conn, table_name, forest_id, year, version, n):
+    if n: conn.execute("INSERT OR REPLACE INTO snapshot_partitions VALUES (?, ?, ?, ?, ?, ?)",
+                       (table_name, str(forest_id), year, version, n, time.time()))
+    else: conn.execute("DELETE FROM snapshot_partitions WHERE table_name = ? AND forest_id = ? AND year = ?",
+                       (table_name, str(forest_id), year))
+
+def take(full=False, tables=None, log=print):
+    """
+    导出快照。full=False 时事实表只重写版本有变化的分区。
+    返回 [{table, partitions, rows}] 汇总。
+    """
+    if not backend.supabase: raise RuntimeError("Database not connected")
+    local_store.ensure_schema(_SCHEMA)
+    version = backend.get_current_version()      # 取数前的版本，之后的写入会在下次被视为变化
+    summary = []
+    conn = local_store.connect()
+    try:
+        for table_name in tables or TABLES:
+            date_col = TABLES[table_name]
+            manifest = _manifest(conn, table_name)
+            if date_col is None:
+                n = _write(_path(table_name), _fetch(table_name))
+                _record(conn, table_name, '*', 0, version, n)
+                parts, total = 1, n
+            elif full or not manifest:
+                # 全量：一次分页拉取后按 林地 × 年 拆分
+                rows = _fetch(table_name)
+                groups = {}
+                for r in rows: groups.setdefault((str(r.get('forest_id')), int(str(r[date_col])[:4])), []).append(r)
+                for key in set(manifest) - set(groups):
+                    _write(_path(table_name, *key), []); _record(conn, table_name, key[0], key[1], version, 0)
+                for (f, y), g in groups.items():
+                    _record(conn, table_name, f, y, version, _write(_path(table_name, f, y), g))
+                parts, total = len(groups), len(rows)
+            else:
+                stale = _stale_partitions(table_name, manifest)
+                total, parts = 0, 0
+                for f, y in sorted(stale, key=lambda p: (p[0], p[1] or 0)):
+                    fid = int(f) if f.isdigit() else f
+                    if y is None:
+                        # 新林地：整个林地拉一次，按年拆分
+                        groups = {}
+                        for r in _fetch(table_name, [("eq", "forest_id", fid)]): groups.setdefault(int(str(r[date_col])[:4]), []).append(r)
+                        for yy, g in groups.items():
+                            _record(conn, table_name, f, yy, version, _write(_path(table_name, f, yy), g))
+                            total += len(g)
+                        parts += len(groups)
+                        continue
+                    rows = _fetch(table_name, [("eq", "forest_id", fid),
+                                               ("gte", date_col, f"{y}-01-01"), ("lt", date_col, f"{y + 1}-01-01")])
+                    _record(conn, table_name, f, y, version, _write(_path(table_name, f, y), rows))
+                    total += len(rows)
+                    parts += 1
+            conn.commit()
+            log(f"{table_name}: {parts} partition(s), {total} rows")
+            summary.append({"table": table_name, "partitions": parts, "rows": total})
+    finally:
+        conn.close()
+    return summary
+
+def status():
+    """每张表的快照概况 (分区数、行数、最后写入时间)"""
+    local_store.ensure_schema(_SCHEMA)
+    conn = local_store.connect()
+    try:
+        rows = conn.execute("SELECT table_name, COUNT(*) AS partitions, SUM(rows) AS rows, MAX(written_at) AS written_at "
+                            "FROM snapshot_partitions GROUP BY table_name ORDER BY table_name").fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+# --- B. 查询层 ---
+def active():
+    """当前 session 选择了离线快照模式"""
+    try: return bool(st.session_state.get("use_snapshot"))
+    except Exception: return False
+
+def available(table_name):
+    d = os.path.join(SNAPSHOT_DIR, table_name)
+    return os.path.isdir(d) and any(f.endswith(".parquet") for f in os.listdir(d))
+
+def stamp(table_name):
+    """快照文件的 (最后修改时间, 文件数)，作为查询缓存的 key"""
+    d = os.path.join(SNAPSHOT_DIR, table_name)
+    if not os.path.isdir(d): return (0, 0)
+    files = [os.path.join(d, f) for f in os.listdir(d) if f.endswith(".parquet")]
+    return (max((os.path.getmtime(f) for f in files), default=0), len(files))
+
+def _files(table_name, filters):
+    """按 forest_id / 日期范围 先裁掉不相关的分区文件"""
+    d = os.path.join(SNAPSHOT_DIR, table_name)
+    files = sorted(os.path.join(d, f) for f in os.listdir(d) if f.endswith(".parquet"))
+    date_col = TABLES.get(table_name)
+    if not date_col: return files
+    forest = {str(v) for op, c, v in filters if c == "forest_id" and op == "eq"}
+    lo = max((int(str(v)[:4]) for op, c, v in filters if c == date_col and op in ("gte", "gt", "eq")), default=None)
+    hi = min((int(str(v)[:4]) - (op == "lt" and str(v)[5:10] == "01-01") for op, c, v in filters
+              if c == date_col and op in ("lt", "lte", "eq")), default=None)
+    out = []
+    for p in files:
+        f, y = os.path.basename(p)[:-8].rsplit("_", 1)
+        if forest and f not in forest: continue
+        if lo is not None and int(y) < lo: continue
+        if hi is not None and int(y) > hi: continue
+        out.append(p)
+    return out
+
+_OPS = {"eq": "__eq__", "neq": "__ne__", "gt": "__gt__", "gte": "__ge__", "lt": "__lt__", "lte": "__le__"}
+
+def _expr(filters, names):
+    expr = None
+    for op, col, val in filters:
+        if col not in names: continue
+        f = ds.field(col)
+        e = f.isin(list(val)) if op == "in_" else getattr(f, _OPS[op])(val)
+        expr = e if expr is None else expr & e
+    return expr
+
+def _split_columns(columns):
+    """'a, b, dim_x(c, d)' -> (['a', 'b'] 或 None 表示 *, {'dim_x': ['c', 'd']})"""
+    plain, embeds = [], {}
+    for part in re.findall(r"[\w*]+\([^)]*\)|[\w*]+", columns or "*"):
+        m = re.match(r"(\w+)\(([^)]*)\)", part)
+        if m: embeds[m.group(1)] = [c.strip() for c in m.group(2).split(",") if c.strip()]
+        else: plain.append(part)
+    return (None if "*" in plain else plain), embeds
+
+def read(table_name, columns=None, filters=()):
+    """快照 -> DataFrame (列投影 + 过滤下推到 pyarrow)"""
+    files = _files(table_name, filters) if available(table_name) else []
+    if not files: return pd.DataFrame(columns=columns or [])
+    # 各分区单独写入，空列的类型可能不同 (null vs string)，先合并 schema
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive")
+    dataset = ds.dataset(files, schema=schema, format="parquet")
+    names = set(dataset.schema.names)
+    cols = [c for c in columns if c in names] if columns else None
+    return dataset.to_table(columns=cols, filter=_expr(filters, names)).to_pandas()
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _select(table_name, columns, filters, stamp):
+    plain, embeds = _split_columns(columns)
+    need = None if plain is None else list(dict.fromkeys(plain + [EMBED_FK[e] for e in embeds if e in EMBED_FK]))
+    df = read(table_name, need, filters)
+    for embed, cols in embeds.items():
+        fk = EMBED_FK.get(embed)
+        dims = read(embed, ["id"] + cols) if fk else pd.DataFrame()
+        lookup = {r.pop('id'): r for r in dims.to_dict('records')} if not dims.empty else {}
+        df[embed] = df[fk].map(lookup) if fk in df.columns else None
+    if plain is not None: df = df[[c for c in plain if c in df.columns] + list(embeds)]
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def select(table_name, columns="*", filters=()):
+    """与 supabase.table(t).select(columns) + 过滤 结果格式一致 (list of dict)"""
+    return _select(table_name, columns, tuple(tuple(f) for f in filters), stamp(table_name))
+
+if __name__ == "__main__":
+    take(full="--full" in sys.argv)
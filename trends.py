@@ -0,0 +1,109 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+from datetime import date
+import backend
+import snapshots
+
+# --- 多年趋势 (Revenue / Cost / Margin) ---
+# 先把 Actual 事实表预聚合成 林地 × 项目 × 月 的长表 (按数据版本缓存)，
+# 画图前再在服务端按 月 / 季 / 年 聚合，保证每条曲线的点数有上限，
+# 历史再长，发给浏览器的 plotly 数据量也不变。
+
+YEARS_BACK = 5
+MAX_POINTS = 24         # 每条曲线最多点数，超过就升一级粒度
+TOP_ITEMS = 8           # 下钻图只单独显示前 N 个项目，其余合并为 Other
+PAGE = 1000             # PostgREST 单次最多返回行数
+
+FREQS = {"Month": "MS", "Quarter": "QS", "Year": "YS"}
+
+# kind -> (事实表, 项目 id 列, 金额列, 维度表, 名称列)
+SOURCES = {
+    "Revenue": ("fact_production_volume", "grade_id", "amount", "dim_products", "grade_code"),
+    "Cost": ("fact_operational_costs", "activity_id", "total_amount", "dim_cost_activities", "activity_name"),
+}
+
+def year_range(end_year=None, years=YEARS_BACK):
+    end_year = end_year or date.today().year
+    return end_year - years + 1, end_year
+
+def _fetch_all(table, columns, start, end):
+    """分页拉取 (只取需要的列)，多年数据会超过单次 1000 行的上限；离线模式读快照"""
+    if snapshots.active() or not backend.supabase:
+        return snapshots.select(table, columns, [("eq", "record_type", "Actual"), ("gte", "month", start), ("lt", "month", end)])
+    out, offset = [], 0
+    while True:
+        rows = backend.supabase.table(table).select(columns).eq("record_type", "Actual")\
+            .gte("month", start).lt("month", end).order("id").range(offset, offset + PAGE - 1).execute().data
+        out.extend(rows)
+        if len(rows) < PAGE: return out
+        offset += PAGE
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _rollup(start_year, end_year, versions):
+    start, end = f"{start_year}-01-01", f"{end_year + 1}-01-01"
+    parts = []
+    for kind, (table, item_col, value_col, dim_table, name_col) in SOURCES.items():
+        rows = _fetch_all(table, f"id, forest_id, {item_col}, month, {value_col}", start, end)
+        if not rows: continue
+        df = pd.DataFrame(rows)
+        names = {d['id']: d[name_col] for d in backend.cached_select(dim_table, f"id, {name_col}")}
+        df = df.assign(month=pd.to_datetime(df['month']).dt.to_period('M').dt.to_timestamp(),
+                       value=pd.to_numeric(df[value_col], errors='coerce').fillna(0.0))
+        g = df.groupby(['forest_id', item_col, 'month'], as_index=False)['value'].sum()
+        parts.append(pd.DataFrame({
+            "forest_id": g['forest_id'].astype("int32"),
+            "kind": kind,
+            "item": g[item_col].map(names).fillna("Unknown"),
+            "month": g['month'],
+            "value": g['value'],
+        }))
+    if not parts: return pd.DataFrame(columns=["forest_id", "kind", "item", "month", "value"])
+    out = pd.concat(parts, ignore_index=True)
+    out['kind'] = pd.Categorical(out['kind'], categories=list(SOURCES))
+    out['item'] = out['item'].astype("category")
+    return out
+
+def monthly_rollup(start_year, end_year):
+    """
+    Actual 预聚合长表: forest_id, kind (Revenue/Cost), item, month (月初), value
+    数据版本不变时直接复用缓存。
+    """
+    if not backend.supabase and not snapshots.available("fact_production_volume"):
+        return pd.DataFrame(columns=["forest_id", "kind", "item", "month", "value"])
+    versions = tuple(backend.get_data_version(t) for t in
+                     ("fact_production_volume", "fact_operational_costs", "dim_products", "dim_cost_activities"))
+    if snapshots.active() or not backend.supabase:
+        versions += ("snapshot", snapshots.stamp("fact_production_volume"), snapshots.stamp("fact_operational_costs"))
+    return _rollup(start_year, end_year, versions)
+
+def pick_freq(start_year, end_year, max_points=MAX_POINTS):
+    """让每条曲线的点数不超过 max_points 的最细粒度"""
+    months = (end_year - start_year + 1) * 12
+    if months <= max_points: return "Month"
+    if months // 3 <= max_points: return "Quarter"
+    return "Year"
+
+def forest_series(df, freq):
+    """林地 × 周期: Revenue / Cost / Margin (宽表)"""
+    if df.empty: return pd.DataFrame(columns=["forest_id", "period", "Revenue", "Cost", "Margin"])
+    p = df.assign(period=df['month'].dt.to_period(FREQS[freq][0]).dt.to_timestamp())
+    wide = p.pivot_table(index=['forest_id', 'period'], columns='kind', values='value',
+                         aggfunc='sum', fill_value=0.0, observed=False).reset_index()
+    for k in SOURCES:
+        if k not in wide.columns: wide[k] = 0.0
+    wide['Margin'] = wide['Revenue'] - wide['Cost']
+    wide.columns.name = None
+    return wide[["forest_id", "period", "Revenue", "Cost", "Margin"]]
+
+def item_series(df, kind, freq, forest_ids=None, top=TOP_ITEMS):
+    """下钻：指定 kind 按 grade / activity 的周期合计，前 top 个之外合并为 Other"""
+    d = df[df['kind'] == kind]
+    if forest_ids is not None: d = d[d['forest_id'].isin(forest_ids)]
+    if d.empty: return pd.DataFrame(columns=["period", "item", "value"])
+    totals = d.groupby('item', observed=True)['value'].sum().abs().sort_values(ascending=False)
+    keep = set(totals.index[:top])
+    item = np.where(d['item'].isin(keep), d['item'].astype(str), "Other")
+    out = d.assign(item=item, period=d['month'].dt.to_period(FREQS[freq][0]).dt.to_timestamp())\
+        .groupby(['period', 'item'], as_index=False)['value'].sum()
+    return out
@@ -0,0 +1,125 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+import backend
+import frames
+
+# --- 单位经济 (Unit Economics) ---
+# 按 林地 × 月 把销售票据 (tonnes / JAS / 收入 / levy) 和 Actual 成本对齐：
+#   $/tonne、$/JAS = 当月成本 / 当月销量
+#   grade / compartment 的成本按当月吨数比例分摊，得到每个 grade 的毛利和 levy 影响
+# 没有票据的月份退回用 fact_production_volume 的产量。结果按 期间 + 数据版本 缓存。
+
+KEYS = ['forest_id', 'month']
+METRICS = ['tonnes', 'jas', 'revenue', 'levy', 'cost']
+
+def _period(year, month=None):
+    if month: return f"{year}-{month:02d}-01", (f"{year + 1}-01-01" if month == 12 else f"{year}-{month + 1:02d}-01")
+    return f"{year}-01-01", f"{year + 1}-01-01"
+
+def _safe_div(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(b != 0, a / b, np.nan)
+
+def add_ratios(df):
+    df['cost_per_tonne'] = _safe_div(df['cost'], df['tonnes'])
+    df['cost_per_jas'] = _safe_div(df['cost'], df['jas'])
+    df['revenue_per_tonne'] = _safe_div(df['revenue'], df['tonnes'])
+    df['margin'] = df['revenue'] - df['cost']
+    df['margin_per_tonne'] = _safe_div(df['margin'], df['tonnes'])
+    df['levy_per_tonne'] = _safe_div(df['levy'], df['tonnes'])
+    # levy 影响：levy 占 (收入 + levy) 的比例，即扣费前毛收入的百分比
+    df['levy_pct'] = _safe_div(df['levy'] * 100, df['revenue'] + df['levy'])
+    return df
+
+def _load(start, end, forest_id):
+    # forest_id 为 None 时是 全部林地 × 整年，票据远超 1000 行：cached_select 按 id 分页拉全，不会只算到一部分
+    f = [("gte", "date", start), ("lt", "date", end)]
+    fm = [("gte", "month", start), ("lt", "month", end), ("eq", "record_type", "Actual")]
+    if forest_id is not None:
+        f.append(("eq", "forest_id", forest_id)); fm.append(("eq", "forest_id", forest_id))
+    sales = frames.load_frame("actual_sales_transactions", backend.cached_select(
+        "actual_sales_transactions",
+        "forest_id, grade_id, date, compartment, net_tonnes, jas, levy_deduction, total_value, dim_products(grade_code)",
+        filters=f, depends_on=["dim_products"], forest_id=forest_id))
+    prod = frames.load_frame("fact_production_volume", backend.cached_select(
+        "fact_production_volume", "forest_id, grade_id, month, vol_tonnes, vol_jas, amount, dim_products(grade_code)",
+        filters=fm, depends_on=["dim_products"], forest_id=forest_id))
+    costs = frames.load_frame("fact_operational_costs", backend.cached_select(
+        "fact_operational_costs", "forest_id, month, total_amount", filters=fm, forest_id=forest_id))
+    return sales, prod, costs
+
+def _volumes(sales, prod):
+    """票据 -> 统一的销量明细 (forest_id, month, grade, compartment, tonnes, jas, revenue, levy)"""
+    cols = KEYS + ['grade', 'compartment', 'tonnes', 'jas', 'revenue', 'levy']
+    parts = []
+    if not sales.empty:
+        parts.append(pd.DataFrame({
+            'forest_id': sales['forest_id'], 'month': sales['date'].dt.to_period('M').dt.to_timestamp(),
+            'grade': sales['grade_code'].astype(object).fillna('Unknown') if 'grade_code' in sales else 'Unknown',
+            'compartment': sales['compartment'].astype(object).fillna('General') if 'compartment' in sales else 'General',
+            'tonnes': sales['net_tonnes'].astype(float), 'jas': sales['jas'].astype(float),
+            'revenue': sales['total_value'], 'levy': sales['levy_deduction'],
+        }))
+    if not prod.empty:
+        p = pd.DataFrame({
+            'forest_id': prod['forest_id'], 'month': prod['month'],
+            'grade': prod['grade_code'].astype(object).fillna('Unknown') if 'grade_code' in prod else 'Unknown',
+            'compartment': 'General',
+            'tonnes': prod['vol_tonnes'].astype(float), 'jas': prod['vol_jas'].astype(float),
+            'revenue': prod['amount'], 'levy': 0.0,
+        })
+        # 有票据的 林地-月 以票据为准，产量表只补空缺
+        if parts:
+            has = pd.MultiIndex.from_frame(parts[0][KEYS].drop_duplicates())
+            p = p[~pd.MultiIndex.from_frame(p[KEYS]).isin(has)]
+        parts.append(p)
+    if not parts: return pd.DataFrame(columns=cols)
+    df = pd.concat(parts, ignore_index=True)[cols]
+    df[['tonnes', 'jas', 'revenue', 'levy']] = df[['tonnes', 'jas', 'revenue', 'levy']].fillna(0.0)
+    return df
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _compute(start, end, forest_id, versions):
+    sales, prod, costs = _load(start, end, forest_id)
+    vol = _volumes(sales, prod)
+
+    cost_fm = costs.groupby(KEYS, as_index=False)['total_amount'].sum().rename(columns={'total_amount': 'cost'}) \
+        if not costs.empty else pd.DataFrame(columns=KEYS + ['cost'])
+    vol_fm = vol.groupby(KEYS, as_index=False)[['tonnes', 'jas', 'revenue', 'levy']].sum()
+    by_month = vol_fm.merge(cost_fm, on=KEYS, how='outer').fillna({m: 0.0 for m in METRICS})
+    by_month = add_ratios(by_month.sort_values(KEYS).reset_index(drop=True))
+
+    # 成本按吨数分摊到 grade / compartment (当月没有吨数的成本不分摊，只出现在 by_month)
+    rate = by_month.set_index(KEYS)['cost_per_tonne']
+    vol['cost'] = vol['tonnes'].to_numpy() * pd.MultiIndex.from_frame(vol[KEYS]).map(rate).to_numpy(dtype=float)
+    vol['cost'] = vol['cost'].fillna(0.0)
+
+    def roll(by):
+        g = vol.groupby(by, as_index=False)[METRICS].sum()
+        return add_ratios(g)
+    return {
+        "by_month": by_month,
+        "by_grade": roll(['forest_id', 'grade']),
+        "by_compartment": roll(['forest_id', 'compartment']),
+    }
+
+def unit_economics(year, month=None, forest_id=None):
+    """
+    期间 (整年或某个月) 的单位经济，返回 dict of DataFrame:
+      by_month:       forest_id, month, tonnes, jas, revenue, levy, cost + 比率列
+      by_grade:       forest_id, grade, ... (成本按吨数分摊)
+      by_compartment: forest_id, compartment, ...
+    比率列: cost_per_tonne, cost_per_jas, revenue_per_tonne, margin, margin_per_tonne, levy_per_tonne, levy_pct
+    """
+    start, end = _period(year, month)
+    versions = tuple(backend.get_data_version(t, forest_id) for t in
+                     ("actual_sales_transactions", "fact_production_volume", "fact_operational_costs")) \
+        + (backend.get_data_version("dim_products"),)
+    return _compute(start, end, forest_id, versions)
+
+def totals(df):
+    """把任意一张结果表汇总成一行 (比率按合计重新计算，不是简单平均)"""
+    if df.empty: return add_ratios(pd.DataFrame({m: [0.0] for m in METRICS})).iloc[0]
+    return add_ratios(df[METRICS].sum().to_frame().T).iloc[0]
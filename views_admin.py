@@ -1,6 +1,10 @@
 import streamlit as st
 import pandas as pd
 import backend
+import snapshots
+import compartments
+import price_book
+import change_log
 import time
 
 def view_admin_upload():
@@ -92,6 +96,7 @@ def view_admin_upload():
             if records:
                 try:
                     backend.supabase.table("dim_gl_mappings").upsert(records, on_conflict="forest_id,item_type,item_id").execute()
+                    for fid in {r['forest_id'] for r in records}: backend.bump_data_version("dim_gl_mappings", fid)
                     st.success(f"✅ 成功导入 {len(records)} 条会计科目映射！")
                     time.sleep(1)
                 except Exception as e:
@@ -102,4 +107,188 @@ def view_admin_upload():
                 st.dataframe(pd.DataFrame(errors, columns=["Error Log"]), use_container_width=True)
 
         except Exception as e:
-            st.error(f"文件处理失败: {e}")
\ No newline at end of file
+            st.error(f"文件处理失败: {e}")
+
+def view_admin_snapshots():
+    st.title("⚙️ Admin: Local Snapshots")
+    st.markdown("把所有表导出为本地 Parquet (事实表按 林地 × 年 分区)，供离线分析 / 数据库休眠时使用。")
+
+    df_status = pd.DataFrame(snapshots.status())
+    if not df_status.empty:
+        df_status['written_at'] = pd.to_datetime(df_status['written_at'], unit='s')
+        st.dataframe(df_status, hide_index=True, use_container_width=True)
+    else:
+        st.info("还没有快照。")
+
+    full = st.checkbox("Full refresh (重写所有分区)", value=df_status.empty)
+    if st.button("📦 Take Snapshot", type="primary"):
+        log = st.empty()
+        try:
+            with st.spinner("Exporting..."):
+                summary = snapshots.take(full=full, log=lambda m: log.caption(m))
+            st.success(f"✅ Snapshot done: {sum(s['partitions'] for s in summary)} partition(s), {sum(s['rows'] for s in summary)} rows written.")
+            time.sleep(1)
+            st.rerun()
+        except Exception as e:
+            st.error(f"Snapshot failed: {e}")
+
+def view_admin_compartments():
+    st.title("⚙️ Admin: Compartments")
+    st.markdown("每个林地的 compartment 主数据 (面积 / 林分属性)。Log Sales 的下拉框和粘贴导入都按这里的 code 校验。")
+
+    forests = backend.get_forest_list()
+    if not forests: return
+    sel_forest = st.selectbox("Forest", [f['name'] for f in forests], key="adm_cpt_f")
+    fid = next(f['id'] for f in forests if f['name'] == sel_forest)
+
+    df = compartments.get_compartments(fid).reindex(columns=compartments.ATTRS)
+    uploaded_file = st.file_uploader("Import from Excel/CSV (columns: " + ", ".join(compartments.ATTRS) + ")", type=['csv', 'xlsx'])
+    if uploaded_file:
+        up = pd.read_csv(uploaded_file) if uploaded_file.name.endswith('.csv') else pd.read_excel(uploaded_file)
+        up.columns = [str(c).strip().lower().replace(" ", "_") for c in up.columns]
+        if 'code' not in up.columns:
+            st.error("❌ 错误：文件中缺少 `code` 列！")
+            return
+        df = up.reindex(columns=compartments.ATTRS)
+
+    edited = st.data_editor(df, num_rows="dynamic", hide_index=True, use_container_width=True, key=f"cpt_edit_{fid}",
+                            column_config={
+                                "area_ha": st.column_config.NumberColumn("area (ha)", min_value=0.0, format="%.2f"),
+                                "plant_year": st.column_config.NumberColumn(min_value=1900, max_value=2100, format="%d"),
+                                "status": st.column_config.SelectboxColumn(options=["Active", "Harvested", "Fallow", "Retired"]),
+                            })
+
+    if st.button("💾 Save Compartments", type="primary"):
+        try:
+            n = compartments.save_compartments(fid, edited)
+            st.success(f"✅ Saved {n} compartment(s).")
+            time.sleep(1)
+            st.rerun()
+        except Exception as e:
+            st.error(f"数据库写入失败: {e}")
+
+def view_admin_price_book():
+    st.title("⚙️ Admin: Price Book")
+    st.markdown("按 grade × market × customer × 生效日期 的价格。market / customer 留空表示通配；effective_to 留空表示一直有效。")
+
+    products = backend.cached_select("dim_products", "id, grade_code")
+    grade_ids = {p['grade_code']: p['id'] for p in products}
+    grade_codes = {v: k for k, v in grade_ids.items()}
+
+    book = price_book.get_price_book()
+    view = book.drop(columns=['grade_id']).assign(grade=book['grade_id'].map(grade_codes))
+    view = view[['id', 'grade', 'market', 'customer', 'price', 'unit', 'levy_per_tonne', 'effective_from', 'effective_to']]
+    edited = st.data_editor(view, num_rows="dynamic", hide_index=True, use_container_width=True, key="price_book_edit",
+                            column_config={
+                                "id": None,
+                                "grade": st.column_config.SelectboxColumn(options=list(grade_ids), required=True),
+                                "market": st.column_config.SelectboxColumn(options=["Export", "Domestic"]),
+                                "price": st.column_config.NumberColumn(format="$%.2f", required=True),
+                                "unit": st.column_config.SelectboxColumn(options=["tonne", "JAS"], default="tonne"),
+                                "levy_per_tonne": st.column_config.NumberColumn("levy / t", format="$%.4f"),
+                                "effective_from": st.column_config.DateColumn(required=True),
+                                "effective_to": st.column_config.DateColumn(),
+                            })
+
+    if st.button("💾 Save Price Book", type="primary"):
+        try:
+            df = edited.dropna(subset=['grade', 'price', 'effective_from'])
+            recs = []
+            for r in df.to_dict('records'):
+                rec = {
+                    "grade_id": grade_ids[r['grade']],
+                    "market": r.get('market') or None,
+                    "customer": (str(r['customer']).strip() or None) if pd.notna(r.get('customer')) else None,
+                    "price": float(r['price']),
+                    "unit": r.get('unit') or "tonne",
+                    "levy_per_tonne": None if pd.isna(r.get('levy_per_tonne')) else float(r['levy_per_tonne']),
+                    "effective_from": str(pd.Timestamp(r['effective_from']).date()),
+                    "effective_to": None if pd.isna(r.get('effective_to')) else str(pd.Timestamp(r['effective_to']).date()),
+                }
+                if pd.notna(r.get('id')): rec['id'] = int(r['id'])
+                recs.append(rec)
+            removed = set(book['id'].dropna().astype(int)) - {r['id'] for r in recs if 'id' in r}
+            if removed: backend.supabase.table("price_book").delete().in_("id", sorted(removed)).execute()
+            # 新行 (无 id) 和已有行分开写，PostgREST 批量 upsert 要求每行的列一致
+            if [r for r in recs if 'id' in r]: backend.upsert_chunked("price_book", [r for r in recs if 'id' in r], on_conflict="id")
+            if [r for r in recs if 'id' not in r]: backend.supabase.table("price_book").insert([r for r in recs if 'id' not in r]).execute()
+            backend.bump_data_version("price_book")
+            st.success(f"✅ Saved {len(recs)} price(s). Run a revaluation below if past tickets are affected.")
+        except Exception as e:
+            st.error(f"数据库写入失败: {e}")
+
+    # --- 追溯重估 ---
+    st.divider()
+    st.subheader("🔁 Revalue Tickets")
+    st.caption("重算按价格本定价 (price_book_id 不为空) 的票据；手填价格的票据和已关账月份不改。")
+    forests = backend.get_forest_list()
+    c1, c2, c3, c4 = st.columns(4)
+    with c1: start = st.date_input("From", value=pd.Timestamp.today().replace(month=1, day=1), key="rv_from")
+    with c2: end = st.date_input("To (exclusive)", value=pd.Timestamp.today() + pd.Timedelta(days=1), key="rv_to")
+    with c3: sel_forest = st.selectbox("Forest", ["ALL"] + [f['name'] for f in forests], key="rv_f")
+    with c4: sel_grade = st.selectbox("Grade", ["ALL"] + list(grade_ids), key="rv_g")
+    fid = next((f['id'] for f in forests if f['name'] == sel_forest), None)
+    gid = grade_ids.get(sel_grade)
+
+    b1, b2 = st.columns(2)
+    preview, run = b1.button("👀 Preview"), b2.button("🚀 Apply Revaluation", type="primary")
+    if preview or run:
+        try:
+            with st.spinner("Revaluing..."):
+                changes, skipped = price_book.revalue(str(start), str(end), fid, gid, apply=run)
+            if changes.empty:
+                st.info("No ticket values change.")
+            else:
+                delta = changes['total_value'].sum() - changes['total_old'].sum()
+                msg = f"{len(changes) - skipped} ticket(s) {'updated' if run else 'would change'}, total value Δ ${delta:,.2f}"
+                (st.success if run else st.info)(msg + (f" — {skipped} in closed periods skipped." if skipped else "."))
+                st.dataframe(changes, hide_index=True, use_container_width=True)
+        except Exception as e:
+            st.error(f"Revaluation failed: {e}")
+
+def view_admin_change_log():
+    st.title("⚙️ Admin: Change Log")
+    st.markdown("每次保存只记录变化的单元格 (谁 / 何时 / 旧值 → 新值)。可以查看某个 林地-月 的修改历史，或还原到任意时间点。")
+
+    forests = backend.get_forest_list()
+    if not forests: return
+    c1, c2, c3 = st.columns([2, 2, 1])
+    with c1: table_name = st.selectbox("Table", list(change_log.TRACKED), key="cl_t")
+    with c2: sel_forest = st.selectbox("Forest", [f['name'] for f in forests], key="cl_f")
+    with c3: month = st.date_input("Month", value=pd.Timestamp.today().replace(day=1), key="cl_m")
+    fid = next(f['id'] for f in forests if f['name'] == sel_forest)
+    month = f"{month:%Y-%m}-01"
+
+    n_pending = change_log.pending()
+    if n_pending:
+        st.caption(f"⏳ {n_pending} change(s) waiting to be pushed.")
+        if st.button("Push now"):
+            try: change_log.flush_all()
+            except Exception as e: st.error(f"Push failed: {e}")
+
+    tab_hist, tab_asof = st.tabs(["📜 History", "⏪ As of"])
+    with tab_hist:
+        try:
+            df = change_log.history(table_name, fid, month)
+            if df.empty: st.info("No changes recorded for this forest-month.")
+            else: st.dataframe(df.drop(columns=['table_name', 'forest_id', 'month']).iloc[::-1], hide_index=True, use_container_width=True)
+        except Exception as e: st.error(f"History Error: {e}")
+    with tab_asof:
+        d1, d2 = st.columns(2)
+        with d1: at_date = st.date_input("Date", key="cl_at_d")
+        with d2: at_time = st.time_input("Time", key="cl_at_t")
+        if st.button("⏪ Reconstruct"):
+            try:
+                at = pd.Timestamp.combine(at_date, at_time).isoformat()
+                st.dataframe(change_log.as_of(table_name, fid, month, at), hide_index=True, use_container_width=True)
+            except Exception as e: st.error(f"Reconstruct Error: {e}")
+
+    st.divider()
+    days = st.number_input("Archive entries older than (days)", 30, 3650, change_log.ARCHIVE_AFTER_DAYS, 30)
+    if st.button("🗄️ Archive to Parquet"):
+        log = st.empty()
+        try:
+            with st.spinner("Archiving..."):
+                n = change_log.archive(days, log=lambda m: log.caption(m))
+            st.success(f"✅ Archived {n} entries.")
+        except Exception as e: st.error(f"Archive failed: {e}")
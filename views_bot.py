@@ -2,6 +2,65 @@ import streamlit as st
 import pandas as pd
 import time
 import backend 
+import invoice_jobs
+import invoice_archive
+import archive_search
+import invoice_dedup
+import invoice_matching
+import invoice_fastpath
+import ai_usage
+
+# --- Helper: 后台批次进度 (fragment 自动轮询，不影响页面其它部分) ---
+def _render_batch_progress(batch_id):
+    status = invoice_jobs.get_batch_status(batch_id)
+
+    @st.fragment(run_every=3 if status['pending'] else None)
+    def _progress():
+        s = invoice_jobs.get_batch_status(batch_id)
+        finished = s['done'] + s['error']
+        if s['pending']:
+            st.progress(finished / s['total'] if s['total'] else 0.0)
+            st.markdown(f"**Analyzing:** {finished}/{s['total']} finished, {s['running']} running. You can keep working — results are saved in the background.")
+        else:
+            if s['error']: st.warning(f"✅ Analysis Complete — {s['error']} file(s) failed.")
+            else: st.success("✅ Analysis Complete!")
+            _render_batch_usage(batch_id)
+            # 轮询中发现批次刚完成：整页刷新一次，让下方 Review 区域显示全部结果
+            if status['pending']: st.rerun()
+    _progress()
+
+# --- Helper: 批次耗时 / token / 成本汇总 ---
+def _render_batch_usage(batch_id):
+    u = ai_usage.batch_summary(batch_id)
+    if not u: return
+    m1, m2, m3, m4, m5 = st.columns(5)
+    m1.metric("Gemini Calls", u['ai_calls'], delta=f"{u['fast_path']} via text layer", delta_color="off")
+    m2.metric("Latency p50 / p95", f"{u['p50_ms'] / 1000:.1f}s / {u['p95_ms'] / 1000:.1f}s")
+    m3.metric("Batch Wall Time", f"{u['wall_s']:.0f}s")
+    m4.metric("Tokens (in / out)", f"{u['input_tokens']:,} / {u['output_tokens']:,}")
+    m5.metric("Est. Cost", f"${u['est_cost']:.4f}", delta=f"{u['pdf_mb']:.1f} MB, {u['retries']} retries", delta_color="off")
+
+def _render_usage_history():
+    with st.expander("📈 AI Usage History"):
+        days = st.selectbox("Period", [7, 30, 90, 365], index=1, format_func=lambda d: f"Last {d} days", key="ai_usage_days")
+        df = ai_usage.history(since=time.time() - days * 86400)
+        if df.empty:
+            st.info("No AI calls recorded yet.")
+            return
+        by_batch = df.groupby('batch_id').agg(
+            started=('started_at', 'min'), files=('id', 'count'),
+            gemini=('source', lambda s: int((s == "gemini").sum())),
+            p95_ms=('latency_ms', lambda s: s.quantile(0.95)),
+            input_tokens=('input_tokens', 'sum'), output_tokens=('output_tokens', 'sum'),
+            retries=('retries', 'sum'), est_cost=('est_cost', 'sum')
+        ).reset_index().sort_values('started', ascending=False)
+        st.caption(f"{len(df)} files, {int((df['source'] == 'gemini').sum())} Gemini calls, est. ${df['est_cost'].sum():.2f}")
+        st.dataframe(by_batch, column_config={
+            "est_cost": st.column_config.NumberColumn("Est. Cost", format="$%.4f"),
+            "p95_ms": st.column_config.NumberColumn("p95 (ms)", format="%.0f"),
+        }, hide_index=True, width="stretch")
+        st.download_button("⬇️ Export Call History (CSV)", df.to_csv(index=False).encode('utf-8'),
+                           f"ai_usage_last_{days}d.csv", "text/csv")
 
 # --- 1. Invoice Bot ---
 def view_invoice_bot():
@@ -20,69 +79,54 @@ def view_invoice_bot():
         
         if uploaded_files:
             if st.button("🚀 Start AI Analysis", type="primary"):
-                results = []
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                total_files = len(uploaded_files)
-                
-                for i, file in enumerate(uploaded_files):
-                    status_text.markdown(f"**Analyzing {i+1}/{total_files}:** `{file.name}`...")
-                    
-                    # 1. Backend Call
-                    data_list = backend.real_extract_invoice_data(file)
-                    
-                    # 2. Re-attach file object
-                    for item in data_list:
-                        item['file_obj'] = file
-                        
-                    results.extend(data_list)
-                    progress_bar.progress((i + 1) / total_files)
-                
-                progress_bar.progress(100)
-                status_text.success("✅ Analysis Complete!")
-                time.sleep(1)
-                status_text.empty()
-                progress_bar.empty()
-                st.session_state['ocr_results'] = results
+                # 交给后台队列处理，页面不再阻塞；结果写入本地任务表
+                st.session_state['invoice_batch'] = invoice_jobs.enqueue_files(uploaded_files)
+
+        # 最近批次：切换页面后回来仍可查看 / 继续审核
+        batches = invoice_jobs.list_recent_batches()
+        batch_id = None
+        if batches:
+            labels = {b['batch_id']: f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(b['created_at']))} ({b['files']} files)" for b in batches}
+            batch_id = st.selectbox("Batch", list(labels.keys()), format_func=lambda b: labels[b], key="invoice_batch")
+            _render_batch_progress(batch_id)
+        _render_usage_history()
 
         st.divider()
 
         # [Review Section]
         st.subheader("2. Review & Archive Results")
         
-        if 'ocr_results' in st.session_state:
-            results = st.session_state['ocr_results']
+        results = invoice_jobs.get_batch_results(batch_id) if batch_id else []
+        if results:
+            forests = backend.get_forest_list()
+            sel_forest = st.selectbox("Forest (for ERP matching)", [f['name'] for f in forests], key="bot_forest") if forests else None
+            fid = next((f['id'] for f in forests if f['name'] == sel_forest), None)
+
+            # 按林地 + 发票月份一次性匹配整批 (不再逐张查询数据库)
+            try:
+                matches = invoice_matching.match_invoices(results, fid) if fid else None
+            except Exception as e:
+                # 如果数据库请求失败，记录错误但不崩溃
+                print(f"Supabase connection error during matching: {e}")
+                matches = None
+            if matches is None:
+                matches = [{"activity": "", "erp_amount": 0.0, "diff": 0.0,
+                            "status": "❌ AI Error" if it.get("vendor_detected") == "Error" else "⚠️ Net Error"} for it in results]
+
             reconcile_data = []
+            # 重复检测：已归档索引 (进程内缓存) + 本批次内互查，均为内存查找
+            dedup = invoice_dedup.DedupIndex(base=invoice_dedup.get_archive_index())
             
             for i, item in enumerate(results):
-                # Init Variables
-                match_status = "❌ Not Found"
-                db_amount = 0.0
-                diff = 0.0
-                
-                if item.get("vendor_detected") == "Error":
-                    match_status = "❌ AI Error"
-                else:
-                    # --- [关键修改] 增加 try-except 异常捕获 ---
-                    try:
-                        # Database Match
-                        acts = backend.supabase.table("dim_cost_activities").select("id").ilike("activity_name", f"%{item['vendor_detected']}%").execute().data
-                        if acts:
-                            act_id = acts[0]['id']
-                            costs = backend.supabase.table("fact_operational_costs").select("total_amount")\
-                                .eq("activity_id", act_id).eq("record_type", "Actual").execute().data
-                            
-                            if costs:
-                                db_amount = float(costs[0]['total_amount'])
-                                diff = float(item['amount_detected']) - db_amount
-                                if abs(diff) < 1.0: match_status = "✅ Match"
-                                else: match_status = "⚠️ Variance"
-                    except Exception as e:
-                        # 如果数据库请求失败，记录错误但不崩溃
-                        match_status = "⚠️ Net Error"
-                        # 可选：在后台打印错误信息
-                        print(f"Supabase connection error for {item.get('filename')}: {e}")
-                    # ----------------------------------------
+                m = matches[i]
+                dup_status = ""
+                if item.get("vendor_detected") != "Error":
+                    dup_status = dedup.check(item, file_hash=item.get('file_hash'))
+                    dedup.add({
+                        "vendor": item.get('vendor_detected'), "invoice_no": item.get('invoice_no'),
+                        "invoice_date": item.get('invoice_date'), "amount": item.get('amount_detected'),
+                        "file_name": item.get('filename')
+                    })
 
                 reconcile_data.append({
                     "Select": False, "Index": i,
@@ -92,7 +136,10 @@ def view_invoice_bot():
                     "Desc": item.get('description'),
                     "Inv #": item.get('invoice_no', ''), 
                     "Inv Amount": item.get('amount_detected', 0), 
-                    "ERP Amount": db_amount, "Diff": diff, "Status": match_status
+                    "ERP Activity": m['activity'],
+                    "ERP Amount": m['erp_amount'], "Diff": m['diff'], "Status": m['status'],
+                    "Duplicate": dup_status,
+                    "Source": "📄 Text layer" if item.get("source") == "text-layer" else "🤖 AI"
                 })
             
             df_rec = pd.DataFrame(reconcile_data)
@@ -114,6 +161,8 @@ def view_invoice_bot():
                         "Inv Amount": st.column_config.NumberColumn(format="$%.2f"),
                         "ERP Amount": st.column_config.NumberColumn(format="$%.2f"),
                         "Diff": st.column_config.NumberColumn(format="$%.2f"),
+                        "Duplicate": st.column_config.TextColumn("Dup Check", disabled=True),
+                        "Source": st.column_config.TextColumn("Source", disabled=True),
                     },
                     hide_index=True, width="stretch"
                 )
@@ -124,55 +173,93 @@ def view_invoice_bot():
                     
                     if not selected_rows.empty:
                         save_status.info("Saving...")
+                        rows = []
                         for idx, row in selected_rows.iterrows():
-                            try:
-                                original_item = results[row['Index']]
-                                file_obj = original_item['file_obj']
-                                file_obj.seek(0)
-                                
-                                path = f"{int(time.time())}_{row['Index']}_{row['File']}"
-                                backend.supabase.storage.from_("invoices").upload(path, file_obj.read(), {"content-type": "application/pdf"})
-                                public_url = backend.supabase.storage.from_("invoices").get_public_url(path)
-                                
-                                backend.supabase.table("invoice_archive").insert({
-                                    "invoice_no": row['Inv #'], 
-                                    "vendor": row['Vendor'], 
-                                    "invoice_date": str(row['Date'].date()) if pd.notnull(row['Date']) else None,
-                                    "description": row['Desc'],        
-                                    "amount": row['Inv Amount'],
-                                    "file_name": row['File'], 
-                                    "file_url": public_url, 
-                                    "status": "Verified"
-                                }).execute()
-                            except Exception as e:
-                                st.error(f"Error saving {row['File']}: {e}")
+                            original_item = results[row['Index']]
+                            rows.append({
+                                "invoice_no": row['Inv #'], 
+                                "vendor": row['Vendor'], 
+                                "invoice_date": str(row['Date'].date()) if pd.notnull(row['Date']) else None,
+                                "description": row['Desc'],        
+                                "amount": row['Inv Amount'],
+                                "file_name": row['File'], 
+                                "file_hash": original_item['file_hash'],
+                                "job_id": original_item['job_id']
+                            })
                         
-                        save_status.success("Saved successfully!")
+                        # 每个文件只上传一次 (并发)，归档记录一次性批量写入
+                        try: df_report = invoice_archive.archive_invoices(rows)
+                        except Exception as e:
+                            save_status.error(f"Error saving invoices: {e}")
+                            df_report = None
+                        if df_report is not None:
+                            st.dataframe(df_report, hide_index=True, width="stretch")
+                            n_failed = int((df_report["Error"] != "").sum()) if not df_report.empty else 0
+                            n_saved = int(df_report["Archived"].sum()) if not df_report.empty else 0
+                            if not n_saved:
+                                save_status.error("Nothing was saved.")
+                            elif n_failed:
+                                save_status.warning(f"Saved {n_saved} invoice(s), {n_failed} file(s) failed.")
+                            else:
+                                save_status.success("Saved successfully!")
                     else:
                         st.warning("No invoices selected.")
         else:
-            if uploaded_files: st.info("Click 'Start AI Analysis' above.")
+            if batch_id: st.info("⏳ Waiting for the first results...")
+            elif uploaded_files: st.info("Click 'Start AI Analysis' above.")
 
     with tab_archive:
         st.subheader("🗄️ Invoice Digital Cabinet")
-        search = st.text_input("Search Vendor/Invoice #")
         try:
-            query = backend.supabase.table("invoice_archive").select("*").order("created_at", desc=True)
-            if search: query = query.or_(f"vendor.ilike.%{search}%,invoice_no.ilike.%{search}%")
-            res = query.execute().data
-            if res:
-                df_archive = pd.DataFrame(res)
-                if "invoice_date" in df_archive.columns:
-                     df_archive["invoice_date"] = pd.to_datetime(df_archive["invoice_date"], errors='coerce')
-
-                st.dataframe(df_archive, column_config={
+            archive_search.sync()
+        except Exception as e: st.warning(f"Archive index sync failed, showing cached results: {e}")
+
+        f1, f2, f3, f4 = st.columns([2, 2, 1, 1])
+        with f1: search = st.text_input("Search Vendor / Invoice # / Description")
+        with f2: date_range = st.date_input("Invoice Date", value=(), key="arc_dates")
+        with f3: amt_min = st.number_input("Min $", value=None, key="arc_min")
+        with f4: amt_max = st.number_input("Max $", value=None, key="arc_max")
+
+        d_from = date_range[0] if len(date_range) > 0 else None
+        d_to = date_range[1] if len(date_range) > 1 else None
+        page = st.session_state.get("arc_page", 1)
+        try:
+            df_archive, total = archive_search.search(search, d_from, d_to, amt_min, amt_max, page=page)
+            n_pages = max((total - 1) // archive_search.PAGE_SIZE + 1, 1)
+            if page > n_pages:
+                page = st.session_state["arc_page"] = n_pages
+                df_archive, total = archive_search.search(search, d_from, d_to, amt_min, amt_max, page=page)
+
+            if not df_archive.empty:
+                df_archive["invoice_date"] = pd.to_datetime(df_archive["invoice_date"], errors='coerce')
+                st.caption(f"{total} invoices found — page {page} of {n_pages}")
+                st.dataframe(df_archive.drop(columns=["id"]), column_config={
                     "file_url": st.column_config.LinkColumn("Link", display_text="Download"),
                     "amount": st.column_config.NumberColumn(format="$%.2f"),
                     "invoice_date": st.column_config.DateColumn("Date", format="YYYY-MM-DD")
                 }, width="stretch", hide_index=True)
             else: st.info("No archives.")
+
+            p1, p2, p3 = st.columns([1, 1, 4])
+            with p1: st.number_input("Page", 1, n_pages, key="arc_page")
+            with p3:
+                if st.button("🔄 Rebuild Search Index"):
+                    archive_search.rebuild()
+                    st.rerun()
         except Exception as e: st.error(f"Error loading archive: {e}")
 
+        # 快速通道模板：由已审核归档发票学习得到
+        with st.expander("📄 Text-layer Templates"):
+            if invoice_fastpath.PdfReader is None:
+                st.warning("pypdf not installed — all invoices go to Gemini.")
+            stats = invoice_fastpath.template_stats()
+            if stats: st.dataframe(pd.DataFrame(stats), hide_index=True, width="stretch")
+            else: st.info("No templates yet. They are learned automatically when invoices are archived.")
+            if st.button("🧠 Learn from Archived Invoices"):
+                with st.spinner("Reading archived PDFs..."):
+                    try: st.success(f"Learned from {invoice_fastpath.backfill_from_archive()} invoices.")
+                    except Exception as e: st.error(f"Error: {e}")
+
 # --- 2. Debug Models ---
 def view_debug_models():
     st.title("🛠️ Google Model Debugger")
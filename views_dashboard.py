@@ -5,6 +5,12 @@ import plotly.graph_objects as go
 import streamlit.components.v1 as components
 from datetime import date
 import backend 
+import forecast
+import trends
+import unit_economics
+import compartments
+import period_close
+import frames
 import time
 
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
@@ -59,34 +65,18 @@ def view_dashboard():
         sel_year = st.selectbox("Year", [2025, 2026])
     
     try:
-        # 简化的 Dashboard 逻辑，主要关注 Actual
-        q_vol = backend.supabase.table("fact_production_volume").select("*").eq("record_type", "Actual")
-        if sel_forest != "ALL":
-            fid = next(f['id'] for f in forests if f['name'] == sel_forest)
-            q_vol = q_vol.eq("forest_id", fid)
-        vol_data = q_vol.execute().data
-        df_vol = pd.DataFrame(vol_data)
-
-        q_cost = backend.supabase.table("fact_operational_costs").select("*").eq("record_type", "Actual")
-        if sel_forest != "ALL":
-            if 'fid' in locals(): q_cost = q_cost.eq("forest_id", fid)
-            else: 
-                fid = next(f['id'] for f in forests if f['name'] == sel_forest)
-                q_cost = q_cost.eq("forest_id", fid)
-
-        cost_data = q_cost.execute().data
-        df_cost = pd.DataFrame(cost_data)
-
-        rev = 0; cost = 0
-        if not df_vol.empty:
-            df_vol['month'] = pd.to_datetime(df_vol['month'])
-            df_vol = df_vol[df_vol['month'].dt.year == sel_year]
-            rev = df_vol['amount'].sum()
-        
-        if not df_cost.empty:
-            df_cost['month'] = pd.to_datetime(df_cost['month'])
-            df_cost = df_cost[df_cost['month'].dt.year == sel_year]
-            cost = df_cost['total_amount'].sum()
+        # 简化的 Dashboard 逻辑，主要关注 Actual (只取需要的列，年份在服务端筛选)
+        fid = next(f['id'] for f in forests if f['name'] == sel_forest) if sel_forest != "ALL" else None
+        year_filter = [("eq", "record_type", "Actual"), ("gte", "month", f"{sel_year}-01-01"), ("lt", "month", f"{sel_year+1}-01-01")]
+        if fid is not None: year_filter.append(("eq", "forest_id", fid))
+
+        df_vol = frames.load_frame("fact_production_volume",
+            backend.cached_select("fact_production_volume", "forest_id, month, amount", filters=year_filter, forest_id=fid))
+        df_cost = frames.load_frame("fact_operational_costs",
+            backend.cached_select("fact_operational_costs", "forest_id, month, total_amount", filters=year_filter, forest_id=fid))
+
+        rev = df_vol['amount'].sum() if not df_vol.empty else 0
+        cost = df_cost['total_amount'].sum() if not df_cost.empty else 0
             
         margin = rev - cost
 
@@ -95,12 +85,213 @@ def view_dashboard():
         k2.metric("Total Costs", f"${cost:,.0f}")
         k3.metric("Net Profit", f"${margin:,.0f}", delta=f"{(margin/rev*100) if rev else 0:.1f}%")
 
+        # --- 滚动预测：YTD Actual + 剩余月份预测 (全部林地一次计算，结果缓存) ---
+        st.divider()
+        st.subheader(f"🔮 Rolling Forecast {sel_year}")
+        df_fc = forecast.rolling_forecast(sel_year)
+        if sel_forest != "ALL": df_fc = df_fc[df_fc['forest_id'] == fid]
+
+        if df_fc.empty:
+            st.info("No Budget / Actual data for this year yet.")
+        else:
+            fc_tot = df_fc.groupby('kind')[['forecast', 'budget']].sum()
+            fc_rev = fc_tot['forecast'].get('Revenue', 0.0); bud_rev = fc_tot['budget'].get('Revenue', 0.0)
+            fc_cost = fc_tot['forecast'].get('Cost', 0.0); bud_cost = fc_tot['budget'].get('Cost', 0.0)
+            f1, f2, f3 = st.columns(3)
+            f1.metric("FY Revenue (Fcst)", f"${fc_rev:,.0f}", delta=f"${fc_rev - bud_rev:,.0f} vs Budget")
+            f2.metric("FY Costs (Fcst)", f"${fc_cost:,.0f}", delta=f"${fc_cost - bud_cost:,.0f} vs Budget", delta_color="inverse")
+            f3.metric("FY Net Profit (Fcst)", f"${fc_rev - fc_cost:,.0f}", delta=f"${(fc_rev - fc_cost) - (bud_rev - bud_cost):,.0f} vs Budget")
+
+            monthly = df_fc.groupby(['kind', 'month'])[['forecast', 'budget']].sum().reset_index()
+            monthly['Month'] = monthly['month'].map(lambda m: MONTHS[m - 1])
+            fig = go.Figure()
+            for kind in ['Revenue', 'Cost']:
+                d = monthly[monthly['kind'] == kind]
+                fig.add_trace(go.Scatter(x=d['Month'], y=d['forecast'], name=f"{kind} (Act/Fcst)", mode="lines+markers"))
+                fig.add_trace(go.Scatter(x=d['Month'], y=d['budget'], name=f"{kind} (Budget)", line=dict(dash="dot")))
+            st.plotly_chart(fig, use_container_width=True)
+
+            if sel_forest == "ALL":
+                forest_names = {f['id']: f['name'] for f in forests}
+                df_sum = forecast.summarize(df_fc)
+                df_sum.insert(0, "Forest", df_sum['forest_id'].map(forest_names))
+                st.dataframe(df_sum.drop(columns=['forest_id']), column_config={
+                    c: st.column_config.NumberColumn(format="$%.0f") for c in ["YTD Actual", "FY Forecast", "FY Budget"]
+                }, hide_index=True, use_container_width=True)
+
         st.divider()
         st.info("💡 提示：更详细的净额结算和发票生成，请前往 'Analysis & Invoice' 页面。")
 
     except Exception as e:
         st.error(f"Dashboard Error: {e}")
 
+# --- 1b. Multi-year Trends ---
+def view_trends():
+    st.title("📉 Multi-year Trends")
+
+    forests = backend.get_forest_list()
+    if not forests:
+        st.warning("正在连接数据库或数据库为空...")
+        return
+    forest_names = {f['id']: f['name'] for f in forests}
+
+    c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
+    with c1: sel = st.multiselect("Forests", list(forest_names.values()), placeholder="All forests")
+    with c2: end_year = st.selectbox("Up to", list(range(date.today().year, date.today().year - 6, -1)))
+    with c3: years = st.selectbox("Years", [1, 2, 3, 5, 10], index=3)
+    with c4: metric = st.selectbox("Metric", ["Margin", "Revenue", "Cost"])
+
+    start_year, end_year = trends.year_range(end_year, years)
+    freq = st.radio("Granularity", list(trends.FREQS), horizontal=True,
+                    index=list(trends.FREQS).index(trends.pick_freq(start_year, end_year)))
+
+    try:
+        df = trends.monthly_rollup(start_year, end_year)
+    except Exception as e:
+        st.error(f"Trend Error: {e}")
+        return
+    if df.empty:
+        st.info(f"No Actual data for {start_year}–{end_year}.")
+        return
+
+    fids = [fid for fid, name in forest_names.items() if name in sel] or None
+    if fids is not None: df = df[df['forest_id'].isin(fids)]
+
+    # 每个林地一条线 (已按周期聚合)，另加一条合计
+    series = trends.forest_series(df, freq)
+    total = series.groupby('period', as_index=False)[["Revenue", "Cost", "Margin"]].sum()
+    k1, k2, k3 = st.columns(3)
+    k1.metric(f"Revenue {start_year}–{end_year}", f"${total['Revenue'].sum():,.0f}")
+    k2.metric("Costs", f"${total['Cost'].sum():,.0f}")
+    k3.metric("Margin", f"${total['Margin'].sum():,.0f}")
+
+    fig = go.Figure()
+    for fid, d in series.groupby('forest_id'):
+        fig.add_trace(go.Scatter(x=d['period'], y=d[metric], name=forest_names.get(fid, str(fid)), mode="lines"))
+    if series['forest_id'].nunique() > 1:
+        fig.add_trace(go.Scatter(x=total['period'], y=total[metric], name="Total", line=dict(width=3, color="black")))
+    fig.update_layout(title=f"{metric} by Forest ({freq})", hovermode="x unified", yaxis_tickformat="$,.0f")
+    st.plotly_chart(fig, use_container_width=True)
+
+    # --- 下钻：Revenue 按 grade / Cost 按 activity ---
+    st.subheader("🔎 Drill-down")
+    kind = st.radio("Breakdown", list(trends.SOURCES), horizontal=True, key="trend_kind")
+    items = trends.item_series(df, kind, freq)
+    if items.empty:
+        st.info(f"No {kind} data for this selection.")
+    else:
+        fig2 = px.bar(items, x='period', y='value', color='item',
+                      title=f"{kind} by {'Grade' if kind == 'Revenue' else 'Activity'} ({freq})")
+        fig2.update_layout(yaxis_tickformat="$,.0f", legend_title_text=None)
+        st.plotly_chart(fig2, use_container_width=True)
+
+# --- 1c. Unit Economics ---
+def view_unit_economics():
+    st.title("⚖️ Unit Economics")
+
+    forests = backend.get_forest_list()
+    if not forests:
+        st.warning("正在连接数据库或数据库为空...")
+        return
+    forest_names = {f['id']: f['name'] for f in forests}
+
+    c1, c2, c3 = st.columns([2, 1, 1])
+    with c1: sel_forest = st.selectbox("Forest", ["ALL"] + list(forest_names.values()), key="ue_f")
+    with c2: year = st.selectbox("Year", [2025, 2026], key="ue_y")
+    with c3: month_str = st.selectbox("Month", ["Full Year"] + MONTHS, key="ue_m")
+
+    fid = next((k for k, v in forest_names.items() if v == sel_forest), None)
+    month = MONTH_MAP.get(month_str)
+    try:
+        ue = unit_economics.unit_economics(year, month, fid)
+    except Exception as e:
+        st.error(f"Unit Economics Error: {e}")
+        return
+
+    tot = unit_economics.totals(ue['by_month'])
+    fmt = lambda v, f="${:,.2f}": "—" if pd.isna(v) else f.format(v)
+    k1, k2, k3, k4, k5 = st.columns(5)
+    k1.metric("Cost / tonne", fmt(tot['cost_per_tonne']))
+    k2.metric("Cost / JAS", fmt(tot['cost_per_jas']))
+    k3.metric("Revenue / tonne", fmt(tot['revenue_per_tonne']))
+    k4.metric("Margin / tonne", fmt(tot['margin_per_tonne']))
+    k5.metric("Levy impact", fmt(tot['levy_pct'], "{:.1f}%"), delta=fmt(tot['levy_per_tonne'], "${:,.2f}/t"), delta_color="off")
+
+    money = {c: st.column_config.NumberColumn(format="$%.2f") for c in
+             ['revenue', 'levy', 'cost', 'margin', 'cost_per_tonne', 'cost_per_jas', 'revenue_per_tonne', 'margin_per_tonne', 'levy_per_tonne']}
+    cfg = dict(money, tonnes=st.column_config.NumberColumn(format="%.1f"), jas=st.column_config.NumberColumn(format="%.1f"),
+               levy_pct=st.column_config.NumberColumn("levy %", format="%.1f%%"))
+
+    def show(df, first):
+        if df.empty:
+            st.info("No sales / cost data for this period.")
+            return
+        out = df.copy()
+        out.insert(0, "Forest", out.pop('forest_id').map(forest_names))
+        if first == 'month': out['month'] = out['month'].dt.strftime('%Y-%m')
+        st.dataframe(out, column_config=cfg, hide_index=True, use_container_width=True)
+
+    tab_g, tab_c, tab_m = st.tabs(["🪵 By Grade", "🌲 By Compartment", "📅 By Month"])
+    with tab_g:
+        if not ue['by_grade'].empty:
+            fig = px.bar(ue['by_grade'].groupby('grade', as_index=False)[unit_economics.METRICS].sum()
+                         .pipe(unit_economics.add_ratios), x='grade', y=['revenue_per_tonne', 'cost_per_tonne', 'margin_per_tonne'],
+                         barmode='group', title="Per-tonne Revenue / Cost / Margin by Grade")
+            fig.update_layout(yaxis_tickformat="$,.0f", legend_title_text=None)
+            st.plotly_chart(fig, use_container_width=True)
+        show(ue['by_grade'], 'grade')
+        st.caption("成本按当月吨数比例分摊到 grade / compartment。")
+    with tab_c: show(ue['by_compartment'], 'compartment')
+    with tab_m: show(ue['by_month'], 'month')
+
+# --- 1d. Compartment Yield ---
+def view_compartments():
+    st.title("🌲 Compartment Yield")
+
+    forests = backend.get_forest_list()
+    if not forests:
+        st.warning("正在连接数据库或数据库为空...")
+        return
+
+    c1, c2, c3 = st.columns([2, 1, 1])
+    with c1: sel_forest = st.selectbox("Forest", [f['name'] for f in forests], key="cpt_f")
+    with c2: year = st.selectbox("Year", [2025, 2026], key="cpt_y")
+    with c3: metric = st.selectbox("Metric", ["tonnes", "jas", "value"], key="cpt_m")
+    fid = next(f['id'] for f in forests if f['name'] == sel_forest)
+
+    try:
+        summary = compartments.yield_summary(fid, year)
+        monthly = compartments.monthly(fid, year)
+    except Exception as e:
+        st.error(f"Compartment Error: {e}")
+        return
+    if summary.empty:
+        st.info("No compartments or tickets for this forest / year.")
+        return
+
+    k1, k2, k3 = st.columns(3)
+    k1.metric("Compartments", int((summary['compartment'] != compartments.GENERAL).sum()))
+    k2.metric("Tonnes", f"{summary['tonnes'].sum():,.1f}")
+    k3.metric("Value", f"${summary['value'].sum():,.0f}")
+
+    if not monthly.empty:
+        fig = px.bar(monthly, x='month', y=metric, color='compartment', title=f"{metric} by Compartment ({year})")
+        fig.update_layout(legend_title_text=None, yaxis_tickformat="$,.0f" if metric == "value" else ",.0f")
+        st.plotly_chart(fig, use_container_width=True)
+
+    st.dataframe(summary, hide_index=True, use_container_width=True, column_config={
+        "area_ha": st.column_config.NumberColumn("area (ha)", format="%.1f"),
+        "plant_year": st.column_config.NumberColumn(format="%d"),
+        "tonnes": st.column_config.NumberColumn(format="%.1f"),
+        "jas": st.column_config.NumberColumn(format="%.1f"),
+        "value": st.column_config.NumberColumn(format="$%.2f"),
+        "tonnes_per_ha": st.column_config.NumberColumn("t/ha", format="%.1f"),
+        "jas_per_ha": st.column_config.NumberColumn("JAS/ha", format="%.1f"),
+        "value_per_ha": st.column_config.NumberColumn("$/ha", format="$%.0f"),
+        "value_per_tonne": st.column_config.NumberColumn("$/t", format="$%.2f"),
+    })
+    st.caption("按 林地 × compartment × 月 预聚合，只有票据有改动的月份才会重新汇总。")
+
 # --- 2. Analysis & Invoice (全面升级版) ---
 def view_analysis_invoice():
     st.title("📈 Analysis & Invoicing (F360 Style)")
@@ -117,57 +308,28 @@ def view_analysis_invoice():
     fid = next(f['id'] for f in forests if f['name'] == sel_forest)
     target_date = f"{year}-{MONTH_MAP[month_str]:02d}-01"
     
-    # --- B. 数据获取 (Fine Granularity) ---
+    # --- B. 数据获取 ---
+    # 已关账的月份直接读不可变快照 (一次小查询)；未关账时实时计算 (结果按数据版本缓存)
     with st.spinner("Fetching Transactional Data & GL Mappings..."):
-        # 1. 获取 GL Mappings (需要 backend.py 支持 get_gl_mapping)
-        # 如果 backend 还没更新，这里做一个容错
-        try:
-            cost_map, rev_map = backend.get_gl_mapping(fid)
-        except AttributeError:
-            st.warning("⚠️ backend.py 未包含 get_gl_mapping 函数，GL 功能将不可用。")
-            cost_map, rev_map = {}, {}
-
-        # 2. 获取销售数据 (Log Sales Transactions)
-        # 注意：这里我们按月筛选，假设 transactions 里的 date 需要转换
-        # 简单起见，这里拉取当月的数据
-        start_date = target_date
-        # 计算月末 (简单处理)
-        if MONTH_MAP[month_str] == 12: end_date = f"{year+1}-01-01"
-        else: end_date = f"{year}-{MONTH_MAP[month_str]+1:02d}-01"
-
-        sales_res = backend.supabase.table("actual_sales_transactions")\
-            .select("*, dim_products(grade_code)")\
-            .eq("forest_id", fid).gte("date", start_date).lt("date", end_date).execute()
-        df_sales = pd.DataFrame(sales_res.data)
-
-        # 3. 获取成本数据 (Actual Costs)
-        cost_res = backend.supabase.table("fact_operational_costs")\
-            .select("*, dim_cost_activities(activity_name)")\
-            .eq("forest_id", fid).eq("month", target_date).eq("record_type", "Actual").execute()
-        df_costs = pd.DataFrame(cost_res.data)
-        
-        # 数据预处理：展平 Activity Name 和 Grade Code
-        if not df_costs.empty:
-            df_costs['activity'] = df_costs['dim_cost_activities'].apply(lambda x: x['activity_name'] if x else 'Unknown')
-            # 应用 GL Mapping
-            def apply_gl_cost(row):
-                act_id = row['activity_id']
-                mapping = cost_map.get(act_id) # 假设 map key 是 int
-                if mapping: return mapping['code'], mapping['name']
-                return "UNMAPPED", row['activity']
-            
-            df_costs[['gl_code', 'gl_desc']] = df_costs.apply(lambda row: pd.Series(apply_gl_cost(row)), axis=1)
+        df_costs, df_sales, total_bud, closed = period_close.get_period(fid, target_date)
 
-        if not df_sales.empty:
-            df_sales['grade'] = df_sales['dim_products'].apply(lambda x: x['grade_code'] if x else 'Unknown')
-            # 应用 GL Mapping (Revenue)
-            def apply_gl_rev(row):
-                gid = row['grade_id']
-                mapping = rev_map.get(gid)
-                if mapping: return mapping['code'], mapping['name']
-                return "UNMAPPED", f"Log Sales - {row['grade']}"
-            
-            df_sales[['gl_code', 'gl_desc']] = df_sales.apply(lambda row: pd.Series(apply_gl_rev(row)), axis=1)
+    if closed:
+        st.success(f"🔒 {month_str} {year} is closed (since {str(closed['closed_at'])[:16].replace('T', ' ')}"
+                   f"{', by ' + closed['closed_by'] if closed.get('closed_by') else ''}). Figures are frozen.")
+    with st.expander("🔒 Period Close", expanded=False):
+        if closed:
+            st.caption("重开后才能修改该月数据；重新关账会生成新的快照。")
+            if st.checkbox("I understand this unlocks edits for this month", key="reopen_ok") and st.button("🔓 Reopen Period"):
+                period_close.reopen_period(fid, target_date)
+                st.rerun()
+        else:
+            st.caption("关账后该 林地-月 的数据不可再修改，分析页面直接读取冻结的汇总结果。")
+            closed_by = st.text_input("Closed by", key="close_by")
+            if st.button("🔒 Close Period", type="primary"):
+                try:
+                    period_close.close_period(fid, target_date, closed_by)
+                    st.rerun()
+                except Exception as e: st.error(f"Close failed: {e}")
 
     # --- C. 界面显示 ---
     
@@ -176,9 +338,7 @@ def view_analysis_invoice():
     # [Tab 1: Budget Analysis] (保留原有逻辑，做简单对比)
     with tab_overview:
         # 这里为了简单，只用 Cost 对比
-        bud_costs = backend.supabase.table("fact_operational_costs").select("total_amount").eq("forest_id", fid).eq("month", target_date).eq("record_type", "Budget").execute().data
         total_act = df_costs['total_amount'].sum() if not df_costs.empty else 0
-        total_bud = sum([x['total_amount'] for x in bud_costs]) if bud_costs else 0
         
         c1, c2 = st.columns(2)
         c1.metric("Actual Costs", f"${total_act:,.0f}", delta=f"${total_bud - total_act:,.0f} (vs Budget)", delta_color="inverse")
@@ -1,84 +1,259 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import date
 import time
+import copy
+import threading
+from collections import OrderedDict
 import backend 
+import budget_scenarios
+import period_close
+import compartments
+import price_book
+import change_log
+import row_versions
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode, JsCode
 
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 MONTH_MAP = {m: i+1 for i, m in enumerate(MONTHS)}
 
-# --- Helper: AgGrid 通用配置函数 ---
-def make_aggrid(df, key, editable_cols=None, readonly_cols=None, dropdown_map=None, currency_cols=None):
-    """
-    df: Pandas DataFrame
-    key: Unique key
-    editable_cols: List of columns that are editable (if None, all editable except readonly)
-    readonly_cols: List of columns that are strictly read-only
-    dropdown_map: Dict { 'col_name': ['Option A', 'Option B'] }
-    currency_cols: List of columns to format as currency ($)
-    """
+# --- Helper: AgGrid 通用配置 ---
+# JS 代码用于前端格式化显示金额 (模块级，只创建一次)
+JS_CURRENCY = JsCode("""
+function(params) {
+    if (params.value == null) return '';
+    return '$' + params.value.toFixed(2).replace(/(\\d)(?=(\\d{3})+(?!\\d))/g, '$1,');
+}
+""")
+
+FIT_COLUMNS_MAX = 12        # 超过这么多列就不再强制挤进屏幕宽度，交给列虚拟化
+GRID_OPTIONS_CACHE_SIZE = 64
+_grid_options_cache = OrderedDict()
+_grid_options_lock = threading.Lock()   # 所有 session 共用这个缓存，读写 / 淘汰都要加锁
+
+def _build_grid_options(df, readonly_cols, dropdown_map, currency_cols):
     gb = GridOptionsBuilder.from_dataframe(df)
     
-    # 1. 全局配置：允许类似 Excel 的框选、多行复制
+    # 1. 全局配置：允许类似 Excel 的框选、多行复制；分组只开在文本列上
     gb.configure_default_column(
-        groupable=True, 
+        groupable=False, 
         value=True, 
-        enableRowGroup=True, 
+        enableRowGroup=False, 
         aggFunc='sum', 
         editable=True,
         resizable=True,
         filterable=True
     )
     gb.configure_selection('multiple', use_checkbox=True) # 允许勾选行
-    gb.configure_grid_options(enableRangeSelection=True)  # 关键：开启 Excel 框选复制功能
+    gb.configure_grid_options(
+        enableRangeSelection=True,          # 关键：开启 Excel 框选复制功能
+        rowBuffer=10,                       # 行 / 列虚拟化：只渲染可见区域附近
+        suppressColumnVirtualisation=False,
+        suppressRowVirtualisation=False,
+        animateRows=False,
+    )
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_string_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+            gb.configure_column(col, enableRowGroup=True, groupable=True)
 
     # 2. 字段特殊配置
-    if readonly_cols:
-        for col in readonly_cols:
-            gb.configure_column(col, editable=False, cellStyle={'backgroundColor': '#f9f9f9', 'color': 'gray'})
-
-    if dropdown_map:
-        for col, options in dropdown_map.items():
-            gb.configure_column(col, cellEditor='agSelectCellEditor', cellEditorParams={'values': options})
-
-    if currency_cols:
-        # JS 代码用于前端格式化显示金额
-        js_currency_func = JsCode("""
-        function(params) {
-            if (params.value == null) return '';
-            return '$' + params.value.toFixed(2).replace(/(\d)(?=(\d{3})+(?!\d))/g, '$1,');
-        }
-        """)
-        for col in currency_cols:
-            gb.configure_column(col, type=["numericColumn", "numberColumnFilter"], valueFormatter=js_currency_func)
-
-    # 3. 构建 Grid
-    gridOptions = gb.build()
+    for col in readonly_cols:
+        gb.configure_column(col, editable=False, cellStyle={'backgroundColor': '#f9f9f9', 'color': 'gray'})
+
+    for col, options in dropdown_map:
+        gb.configure_column(col, cellEditor='agSelectCellEditor', cellEditorParams={'values': list(options)})
+
+    for col in currency_cols:
+        gb.configure_column(col, type=["numericColumn", "numberColumnFilter"], valueFormatter=JS_CURRENCY)
+
+    if len(df.columns) <= FIT_COLUMNS_MAX:
+        gb.configure_grid_options(autoSizeStrategy={"type": "fitGridWidth"})
+    return gb.build()
+
+def _get_grid_options(df, readonly_cols, dropdown_map, currency_cols):
+    """按 (列结构, 配置) 缓存 gridOptions；AgGrid 会原地改写，所以每次返回深拷贝"""
+    cache_key = (
+        tuple((c, str(t)) for c, t in df.dtypes.items()),
+        tuple(readonly_cols), dropdown_map, tuple(currency_cols)
+    )
+    with _grid_options_lock:
+        opts = _grid_options_cache.get(cache_key)
+        if opts is not None: _grid_options_cache.move_to_end(cache_key)
+    if opts is None:
+        opts = _build_grid_options(df, readonly_cols, dropdown_map, currency_cols)
+        with _grid_options_lock:
+            opts = _grid_options_cache.setdefault(cache_key, opts)
+            _grid_options_cache.move_to_end(cache_key)
+            if len(_grid_options_cache) > GRID_OPTIONS_CACHE_SIZE: _grid_options_cache.popitem(last=False)
+    return copy.deepcopy(opts)
+
+def _compact_frame(df, readonly_cols, currency_cols):
+    """
+    压缩传给前端的数据：只读的低基数文本列 -> category，
+    只读、非金额、且 float32 能无损表示的浮点列 -> float32。
+    可编辑列保持原类型，避免编辑后的值被转换 / 截断。
+    """
+    out = df.copy()
+    for col in readonly_cols:
+        if col not in out.columns or col in currency_cols: continue
+        s = out[col]
+        if pd.api.types.is_string_dtype(s.dtype) and len(s) > 0 and s.nunique(dropna=True) <= len(s) // 2:
+            out[col] = s.astype('category')
+        elif s.dtype == 'float64':
+            s32 = s.astype('float32')
+            if ((s32.astype('float64') == s) | s.isna()).all(): out[col] = s32
+    return out
+
+def make_aggrid(df, key, editable_cols=None, readonly_cols=None, dropdown_map=None, currency_cols=None):
+    """
+    df: Pandas DataFrame
+    key: Unique key
+    editable_cols: List of columns that are editable (if None, all editable except readonly)
+    readonly_cols: List of columns that are strictly read-only
+    dropdown_map: Dict { 'col_name': ['Option A', 'Option B'] }
+    currency_cols: List of columns to format as currency ($)
+    """
+    t0 = time.perf_counter()
+    readonly_cols = [c for c in (readonly_cols or []) if c in df.columns]
+    currency_cols = [c for c in (currency_cols or []) if c in df.columns]
+    dropdown_map = tuple((c, tuple(o)) for c, o in (dropdown_map or {}).items())
+
+    df_grid = _compact_frame(df, readonly_cols, currency_cols)
+    gridOptions = _get_grid_options(df_grid, readonly_cols, dropdown_map, currency_cols)
+    t1 = time.perf_counter()
     
-    # 4. 渲染
+    # 渲染 (包含 Arrow 序列化 + 组件消息发送)
     grid_response = AgGrid(
-        df, 
+        df_grid, 
         gridOptions=gridOptions, 
         height=500, 
         width='100%',
         data_return_mode=DataReturnMode.FILTERED_AND_SORTED, 
         update_mode=GridUpdateMode.MANUAL, # 只有点击保存或变更时才更新，防止刷新太快
-        fit_columns_on_grid_load=True,
         allow_unsafe_jscode=True, # 允许运行上面的 JS 格式化代码
         key=key
     )
+    t2 = time.perf_counter()
+
+    # 性能数据：URL 加 ?profile=1 时显示
+    profile = {
+        "rows": len(df), "cols": len(df.columns),
+        "payload_kb": round(df_grid.memory_usage(deep=True).sum() / 1024, 1),
+        "raw_kb": round(df.memory_usage(deep=True).sum() / 1024, 1),
+        "prepare_ms": round((t1 - t0) * 1000, 1), "render_ms": round((t2 - t1) * 1000, 1),
+    }
+    st.session_state.setdefault("grid_profile", {})[key] = profile
+    if st.query_params.get("profile"):
+        st.caption(f"⏱️ {profile['rows']}×{profile['cols']} | data {profile['raw_kb']} KB → {profile['payload_kb']} KB | "
+                   f"options+compact {profile['prepare_ms']} ms | serialize+send {profile['render_ms']} ms")
     
     return grid_response['data'] # 返回修改后的数据 (List of Dicts)
 
-# --- Helper: 模拟获取 Compartments ---
+# --- Helper: Compartment 下拉选项 (来自 dim_compartments 主数据) ---
 def get_compartment_options(forest_id):
-    return ["60810", "60812", "60814", "General"]
+    return compartments.options(forest_id)
+
+# --- Helper: 整年宽表 (项目 × 12 个月) ---
+def year_grid(tab_key, table_name, dim_table, dim_id_col, dim_name_col, fid, year, record_type, value_cols, currency_cols=None):
+    df_long = backend.get_yearly_data(table_name, dim_table, dim_id_col, dim_name_col, fid, year, record_type, value_cols)
+    if df_long.empty: return
+
+    metric = st.selectbox("Metric", value_cols, key=f"ym_{tab_key}")
+
+    # Pivot: 长表 -> 宽表
+    wide = df_long.pivot(index=[dim_id_col, dim_name_col], columns='month', values=metric)
+    wide.columns = [MONTHS[m - 1] for m in wide.columns]
+    wide = wide.reset_index()
+    wide['Total'] = wide[MONTHS].sum(axis=1)
+
+    is_money = metric in (currency_cols or [])
+    grid_data = make_aggrid(
+        wide[[dim_name_col] + MONTHS + ['Total', dim_id_col]],
+        key=f"ag_year_{tab_key}_{record_type}_{metric}",
+        readonly_cols=[dim_name_col, dim_id_col, 'Total'],
+        currency_cols=MONTHS + ['Total'] if is_money else None
+    )
+
+    if st.button("Save Year", key=f"b_year_{tab_key}"):
+        # Unpivot: 宽表 -> 长表，只替换当前 metric 这一列
+        df_edit = pd.DataFrame(grid_data).melt(id_vars=[dim_id_col], value_vars=MONTHS, var_name='month', value_name=metric)
+        df_edit['month'] = df_edit['month'].map(MONTH_MAP)
+        df_edit[dim_id_col] = df_edit[dim_id_col].astype(df_long[dim_id_col].dtype)
+        edited = df_long.drop(columns=[metric]).merge(df_edit, on=[dim_id_col, 'month'], how='left')
+        edited[metric] = pd.to_numeric(edited[metric], errors='coerce').fillna(0.0)
+
+        # 成本：只对这次改了数量或单价的 项目-月 按 数量 × 单价 重算总额 (left merge 保持 df_long 的行序)
+        if metric in ('quantity', 'unit_rate') and 'total_amount' in edited.columns:
+            before = pd.to_numeric(df_long[metric], errors='coerce').fillna(0.0).to_numpy()
+            changed = ~np.isclose(edited[metric].to_numpy(dtype=float), before)
+            calc = changed & (edited['quantity'] > 0) & (edited['unit_rate'] > 0)
+            edited.loc[calc, 'total_amount'] = edited.loc[calc, 'quantity'] * edited.loc[calc, 'unit_rate']
+
+        try:
+            n = backend.save_yearly_delta(df_long, edited, table_name, dim_id_col, fid, year, record_type, value_cols)
+            st.success(f"✅ Saved {n} changed item-months." if n else "No changes to save.")
+        except Exception as e: st.error(f"Error: {e}")
+
+# --- Helper: 行版本保存结果 / 冲突合并 ---
+def _reload_button(grid, ui=None):
+    """ui: 控件 key 前缀 (同一基线在多个 tab 里显示时区分)"""
+    if st.button("🔄 Reload", key=f"{ui or grid}_reload", help="重新读取整张表 (放弃未保存的修改)"):
+        row_versions.reload(grid)
+        st.rerun()
+
+def _after_save(grid, table_name, result, msg):
+    """保存后：写入的行合并进基线，冲突记下来交给合并界面"""
+    if result is False: return st.error("Save failed.")
+    row_versions.apply(grid, table_name, result.saved)
+    row_versions.set_conflicts(grid, table_name, result)
+    if result.conflicts:
+        st.warning(f"⚠️ {len(result.saved)} row(s) saved, {len(result.conflicts)} changed by someone else — resolve below.")
+    elif result.saved: st.success(msg)
+    else: st.info("No changes to save.")
+    time.sleep(1)
+    st.rerun()
+
+def _conflict_panel(grid, fid, month=None, ui=None):
+    """只显示冲突的行：我的 / 对方当前的 / 打开表格时的值，逐行选保留哪个"""
+    b = st.session_state.get(row_versions.STATE_KEY, {}).get(grid)
+    if not b or not b['conflicts']: return
+    fields = change_log.TRACKED[b['table']][1]
+    st.warning(f"⚠️ {len(b['conflicts'])} row(s) were changed by someone else after you opened this grid. Choose which version to keep:")
+    choices = {}
+    for i, c in enumerate(b['conflicts']):
+        mine, theirs, base = c['mine'], c['theirs'], c['base'] or {}
+        label = base.get('activity_name') or base.get('grade_code') or \
+            " · ".join(str(v) for v in (mine.get('date'), mine.get('ticket_number')) if v) or str(c['key'][-1])
+        with st.container(border=True):
+            if theirs is None:
+                st.markdown(f"**{label}** — deleted by someone else")
+            else:
+                diff = [f for f in fields if f in mine and not change_log._same(change_log._text(mine.get(f)), change_log._text(theirs.get(f)))]
+                st.markdown(f"**{label}**")
+                st.dataframe(pd.DataFrame({"Field": diff, "Yours": [mine.get(f) for f in diff],
+                                           "Theirs": [theirs.get(f) for f in diff], "When opened": [base.get(f) for f in diff]}).astype(str),
+                             hide_index=True, use_container_width=True)
+            pick = st.radio("Keep", ["Mine", "Theirs"], horizontal=True, key=f"{ui or grid}_cf_{i}_{b['rev']}", label_visibility="collapsed")
+            choices[i] = "theirs" if pick == "Theirs" else "mine"
+
+    if st.button("✅ Apply Merge", key=f"{ui or grid}_merge"):
+        try:
+            keep = [b['conflicts'][i]['mine'] for i, p in choices.items() if p == "mine"]
+            keep = [r for r in keep if period_close.locks(r.get('record_type', "Actual"))]     # 情景不受关账限制
+            period_close.assert_open(fid, sorted({str(r.get('month') or r.get('date'))[:7] for r in keep}))
+            left = row_versions.resolve(grid, fid, choices, month)
+            if left: st.warning(f"⚠️ {left} row(s) changed again in the meantime — review them again.")
+            else: st.success("Merged!")
+            time.sleep(1)
+            st.rerun()
+        except period_close.PeriodLockedError as e: st.error(str(e))
 
 # --- 1. Log Sales Data (Transaction Level) ---
 def view_log_sales():
     st.title("🚛 Log Sales Data (AgGrid Edition)")
     st.caption("✨ 支持 Ctrl+C/V 复制粘贴，像 Excel 一样操作。修改后请点击 'Save Transactions'。")
+    st.caption("💲 Price 留 0 时按价格本 (grade × market × customer × 日期) 自动定价，并计算 levy 和 Total Value。")
     
     forests = backend.get_forest_list()
     if not forests: return
@@ -91,18 +266,21 @@ def view_log_sales():
     # 获取基础配置数据
     products = backend.supabase.table("dim_products").select("*").execute().data
     product_codes = [p['grade_code'] for p in products] if products else []
-    compartment_opts = get_compartment_options(fid) 
+    compartment_opts = get_compartment_options(fid)
     
-    # 获取现有数据
-    res = backend.supabase.table("actual_sales_transactions").select("*").eq("forest_id", fid).order("date", desc=True).limit(50).execute()
-    df = pd.DataFrame(res.data)
+    # 获取现有数据 (打开时读一次作为基线，保存时按 row_version 检查冲突)
+    grid = "ag_log_sales"
+    b = row_versions.baseline(grid, fid, lambda: pd.DataFrame(backend.supabase.table("actual_sales_transactions")
+                              .select("*").eq("forest_id", fid).order("date", desc=True).limit(50).execute().data))
+    base_rows = row_versions.to_rows(b['df'])
+    df = b['df'].copy()
     
     # 初始化空行
     if df.empty: 
         df = pd.DataFrame([{
             "date": str(date.today()), 
             "ticket_number": "", 
-            "compartment": compartment_opts[0], 
+            "compartment": compartments.GENERAL, 
             "customer": "C001", 
             "market": "Export",
             "sale_type": "Purchase (Inv)", 
@@ -115,7 +293,9 @@ def view_log_sales():
         }])
     else:
         # 预处理数据，保证 AgGrid 不报错
-        if 'compartment' not in df.columns: df['compartment'] = compartment_opts[0]
+        if 'compartment' not in df.columns: df['compartment'] = compartments.GENERAL
+        # 旧票据上已不在主数据里的 compartment 也保留在下拉框里，避免编辑时被清空
+        compartment_opts += [c for c in df['compartment'].dropna().unique() if c not in compartment_opts]
         if 'sale_type' not in df.columns: df['sale_type'] = "Purchase (Inv)"
         if 'levy_deduction' not in df.columns: df['levy_deduction'] = 0.0
         # 必须确保 ID 列在，但可以隐藏或设为只读
@@ -129,13 +309,13 @@ def view_log_sales():
         "grade_code": product_codes
     }
     
-    readonly = ["created_at", "forest_id", "grade_id"] # 这些列由系统维护，前端只读
+    readonly = ["created_at", "forest_id", "grade_id", "price_book_id", "row_version"] # 这些列由系统维护，前端只读
     currency = ["price", "levy_deduction", "total_value"]
     
     # 渲染表格
     grid_data = make_aggrid(
         df, 
-        key="ag_log_sales", 
+        key=f"{grid}_{b['rev']}", 
         readonly_cols=readonly,
         dropdown_map=dropdowns,
         currency_cols=currency
@@ -143,51 +323,65 @@ def view_log_sales():
 
     if st.button("💾 Save Transactions"):
         df_edited = pd.DataFrame(grid_data) # 转回 DataFrame
+        # 粘贴进来的 compartment (例如 60810.0 / 小写) 按主数据规范化
+        df_edited['compartment'], unknown = compartments.resolve(fid, df_edited.get('compartment', pd.Series(index=df_edited.index, dtype=object)))
+        if unknown: st.warning(f"⚠️ Compartments not in master data: {', '.join(unknown)}")
         
+        # grade_code -> grade_id，然后按价格本整批补 price / levy / total_value (手填的价格不覆盖)
+        gid = df_edited.get('grade_code', pd.Series(index=df_edited.index, dtype=object)).map({p['grade_code']: p['id'] for p in products})
+        df_edited['grade_id'] = gid.fillna(pd.to_numeric(df_edited.get('grade_id'), errors='coerce')) if 'grade_id' in df_edited else gid
+        # 已按价格本定价、价格没改过的旧票据保留原 price_book_id (追溯修改交给 revalue)
+        loaded = None
+        if base_rows and 'id' in df_edited:
+            loaded = pd.DataFrame(base_rows).drop_duplicates('id').set_index('id')\
+                .reindex(pd.to_numeric(df_edited['id'], errors='coerce')).set_axis(df_edited.index)
+        df_edited = price_book.apply_prices(df_edited, loaded=loaded)
+
         recs = []
         for _, row in df_edited.iterrows():
-            # 逻辑处理：ID 匹配
-            gid = next((p['id'] for p in products if p['grade_code'] == row.get('grade_code')), None)
-            
-            # 自动计算 Total Value (如果用户没填或填0)
-            net_tonnes = float(row.get('net_tonnes') or 0)
-            price = float(row.get('price') or 0)
-            levy = float(row.get('levy_deduction') or 0)
-            
-            # 简单的计算逻辑
-            calc_total = float(row.get('total_value') or 0)
-            if calc_total == 0 and price != 0:
-                calc_total = (net_tonnes * price) - levy
-
             record = {
                 "forest_id": fid, 
                 "date": str(row['date']), 
                 "ticket_number": row.get('ticket_number'),
                 "compartment": row.get('compartment'), 
                 "sale_type": row.get('sale_type'),     
-                "grade_id": gid, 
+                "grade_id": None if pd.isna(row['grade_id']) else int(row['grade_id']), 
                 "customer": row.get('customer'), 
                 "market": row.get('market'),
-                "net_tonnes": net_tonnes, 
-                "jas": float(row.get('jas') or 0), 
-                "price": price, 
-                "levy_deduction": levy, 
-                "total_value": calc_total
+                "net_tonnes": float(row['net_tonnes']), 
+                "jas": float(row['jas']), 
+                "price": float(row['price']), 
+                "levy_deduction": float(row['levy_deduction']), 
+                "total_value": float(row['total_value']),
+                "price_book_id": None if pd.isna(row['price_book_id']) else int(row['price_book_id'])
             }
             
             # 如果是更新现有行，带上 ID
             if row.get('id') and pd.notnull(row.get('id')):
-                record['id'] = row['id']
+                record['id'] = int(row['id'])
                 
             recs.append(record)
 
+        # 已关账月份里没改动的旧行不再回写 (表格是整页保存的)；改动了的仍会被 assert_open 拒绝
+        closed = period_close.closed_months(fid)
+        if closed:
+            orig = {r['id']: r for r in base_rows}
+            def _same(a, b):
+                try: return abs(float(a or 0) - float(b or 0)) < 1e-9
+                except (TypeError, ValueError): return str(a or "").split("T")[0] == str(b or "").split("T")[0]
+            recs = [r for r in recs if not (f"{r['date'][:7]}-01" in closed and r.get('id') in orig
+                                            and all(_same(orig[r['id']].get(k), v) for k, v in r.items()))]
+
         try:
-            backend.supabase.table("actual_sales_transactions").upsert(recs).execute()
-            st.success("✅ Transactions Saved Successfully!")
-            time.sleep(1)
-            st.rerun()
+            period_close.assert_open(fid, sorted({r['date'][:7] for r in recs}))
+            # 只写改过的行，别人保存过的行作为冲突返回 (不覆盖)
+            result = row_versions.save("actual_sales_transactions", fid, recs, base_rows)
+            _after_save(grid, "actual_sales_transactions", result, "✅ Transactions Saved Successfully!")
         except Exception as e: st.error(f"Error: {e}")
 
+    _conflict_panel(grid, fid)
+    _reload_button(grid)
+
 
 # --- 2. Monthly Input (Updated with AgGrid) ---
 def view_monthly_input(mode):
@@ -195,14 +389,29 @@ def view_monthly_input(mode):
     forests = backend.get_forest_list()
     if not forests: return
 
+    # Budget 可切换为整年视图：项目 × 12 个月一张表，一次读取、一次保存
+    year_view = mode == "Budget" and st.toggle("📅 Year View (all 12 months)", key=f"yv_{mode}")
+
     c1, c2, c3 = st.columns([2, 1, 1])
     with c1: sel_forest = st.selectbox("Forest", [f['name'] for f in forests], key=f"f_{mode}")
     with c2: year = st.selectbox("Year", [2025, 2026], key=f"y_{mode}")
-    with c3: month_str = st.selectbox("Month", MONTHS, key=f"m_{mode}")
+    with c3: month_str = MONTHS[0] if year_view else st.selectbox("Month", MONTHS, key=f"m_{mode}")
 
     target_date = f"{year}-{MONTH_MAP[month_str]:02d}-01"
     fid = next(f['id'] for f in forests if f['name'] == sel_forest)
+
+    # Budget 模式可切换到某个预算情景 (同表存储，record_type = "Scenario:<名称>")
+    record_type = mode
+    if mode == "Budget":
+        scen_names = [s['name'] for s in budget_scenarios.list_scenarios(year)]
+        if scen_names:
+            version = st.selectbox("Version", ["Budget"] + scen_names, key=f"v_{mode}")
+            record_type = budget_scenarios.scenario_record_type(version)
     
+    # 已关账的月份：只读
+    locked = not year_view and period_close.locks(record_type) and period_close.is_closed(fid, target_date)
+    if locked: st.warning(f"🔒 {month_str} {year} is closed for {sel_forest} — figures are read-only.")
+
     if mode == "Budget":
         tabs = ["📋 Sales Forecast", "🚛 Log Transport & Volume", "💰 Operational & Harvesting"]
     else:
@@ -210,53 +419,79 @@ def view_monthly_input(mode):
     
     current_tabs = st.tabs(tabs)
 
+    if year_view:
+        with current_tabs[0]:
+            year_grid("fc", "fact_production_volume", "dim_products", "grade_id", "grade_code", fid, year, record_type,
+                      ['amount', 'vol_tonnes', 'vol_jas', 'price_jas'], currency_cols=['price_jas', 'amount'])
+        with current_tabs[1]:
+            year_grid("vol", "fact_production_volume", "dim_products", "grade_id", "grade_code", fid, year, record_type,
+                      ['vol_tonnes', 'vol_jas', 'price_jas', 'amount'], currency_cols=['price_jas', 'amount'])
+        with current_tabs[2]:
+            year_grid("cost", "fact_operational_costs", "dim_cost_activities", "activity_id", "activity_name", fid, year, record_type,
+                      ['total_amount', 'quantity', 'unit_rate'], currency_cols=['unit_rate', 'total_amount'])
+        return
+
     for i, tab_name in enumerate(tabs):
         with current_tabs[i]:
             
             # --- Tab A: Sales Forecast (Budget Only) ---
             if tab_name == "📋 Sales Forecast":
-                df = backend.get_monthly_data("fact_production_volume", "dim_products", "grade_id", "grade_code", fid, target_date, mode, ['vol_tonnes', 'vol_jas', 'price_jas', 'amount'])
+                # Sales Forecast 和 Transport & Volume 编辑的是同一批 fact_production_volume 行：共用一个基线
+                grid, ui = f"ag_pv_{record_type}", f"ag_fc_{record_type}"
+                b = row_versions.baseline(grid, (fid, target_date), lambda: backend.get_monthly_data("fact_production_volume", "dim_products", "grade_id", "grade_code", fid, target_date, record_type, ['vol_tonnes', 'vol_jas', 'price_jas', 'amount']))
                 
                 # 重新排序列，隐藏 ID
                 cols = ['grade_code', 'market', 'customer', 'vol_tonnes', 'vol_jas', 'price_jas', 'amount', 'grade_id']
-                df = df[[c for c in cols if c in df.columns]]
+                df = b['df'][[c for c in cols if c in b['df'].columns]]
                 
                 grid_data = make_aggrid(
                     df, 
-                    key=f"ag_fc_{mode}",
+                    key=f"{ui}_{b['rev']}",
                     readonly_cols=['grade_code', 'grade_id'],
                     dropdown_map={'market': ['Export', 'Domestic']},
                     currency_cols=['price_jas', 'amount']
                 )
                 
-                if st.button("Save Forecast", key=f"b_ag_fc"):
+                if st.button("Save Forecast", key=f"b_ag_fc", disabled=locked):
                     edited_df = pd.DataFrame(grid_data)
-                    if backend.save_monthly_data(edited_df, "fact_production_volume", "grade_id", fid, target_date, mode): 
-                        st.success("Forecast Saved!")
+                    try:
+                        result = backend.save_monthly_data(edited_df, "fact_production_volume", "grade_id", fid, target_date, record_type, base=b['df'])
+                        _after_save(grid, "fact_production_volume", result, "Forecast Saved!")
+                    except Exception as e: st.error(str(e))
+                _conflict_panel(grid, fid, target_date, ui)
+                _reload_button(grid, ui)
 
             # --- Tab B: Transport & Volume ---
             elif tab_name == "🚛 Log Transport & Volume":
-                 df = backend.get_monthly_data("fact_production_volume", "dim_products", "grade_id", "grade_code", fid, target_date, mode, ['vol_tonnes', 'vol_jas', 'price_jas', 'amount'])
+                 grid, ui = f"ag_pv_{record_type}", f"ag_vol_{record_type}"
+                 b = row_versions.baseline(grid, (fid, target_date), lambda: backend.get_monthly_data("fact_production_volume", "dim_products", "grade_id", "grade_code", fid, target_date, record_type, ['vol_tonnes', 'vol_jas', 'price_jas', 'amount']))
                  
                  cols = ['grade_code', 'vol_tonnes', 'vol_jas', 'price_jas', 'amount', 'grade_id']
-                 df = df[[c for c in cols if c in df.columns]]
+                 df = b['df'][[c for c in cols if c in b['df'].columns]]
 
                  grid_data = make_aggrid(
                      df, 
-                     key=f"ag_vol_{mode}", 
+                     key=f"{ui}_{b['rev']}", 
                      readonly_cols=['grade_code', 'grade_id'],
                      currency_cols=['price_jas', 'amount']
                  )
                  
-                 if st.button("Save Volume", key=f"b_ag_vol"):
+                 if st.button("Save Volume", key=f"b_ag_vol", disabled=locked):
                      edited_df = pd.DataFrame(grid_data)
-                     if backend.save_monthly_data(edited_df, "fact_production_volume", "grade_id", fid, target_date, mode): st.success("Saved!")
+                     try:
+                         result = backend.save_monthly_data(edited_df, "fact_production_volume", "grade_id", fid, target_date, record_type, base=b['df'])
+                         _after_save(grid, "fact_production_volume", result, "Saved!")
+                     except Exception as e: st.error(str(e))
+                 _conflict_panel(grid, fid, target_date, ui)
+                 _reload_button(grid, ui)
 
             # --- Tab C: Operational Costs ---
             elif tab_name == "💰 Operational & Harvesting":
                  
-                 # 1. 获取数据
-                 df = backend.get_monthly_data("fact_operational_costs", "dim_cost_activities", "activity_id", "activity_name", fid, target_date, mode, ['quantity', 'unit_rate', 'total_amount'])
+                 # 1. 获取数据 (打开时读一次作为基线，保存时按 row_version 检查冲突)
+                 grid = f"ag_cost_{record_type}"
+                 b = row_versions.baseline(grid, (fid, target_date), lambda: backend.get_monthly_data("fact_operational_costs", "dim_cost_activities", "activity_id", "activity_name", fid, target_date, record_type, ['quantity', 'unit_rate', 'total_amount']))
+                 df = b['df'].copy()
                  
                  # 2. Actual 模式下预填预算单价 (逻辑保持不变)
                  if mode == "Actual" and df['total_amount'].sum() == 0:
@@ -264,10 +499,8 @@ def view_monthly_input(mode):
                      df_budget = backend.get_monthly_data("fact_operational_costs", "dim_cost_activities", "activity_id", "activity_name", fid, target_date, "Budget", ['unit_rate', 'total_amount'])
                      
                      if not df_budget.empty:
-                         bud_rate_map = df_budget.set_index('activity_id')['unit_rate'].to_dict()
-                         for idx, row in df.iterrows():
-                             bud_rate = bud_rate_map.get(row['activity_id'], 0.0)
-                             if bud_rate > 0: df.at[idx, 'unit_rate'] = bud_rate
+                         bud_rate = df['activity_id'].map(df_budget.set_index('activity_id')['unit_rate']).fillna(0.0)
+                         df['unit_rate'] = df['unit_rate'].where(bud_rate <= 0, bud_rate)
 
                  # 3. 整理列顺序
                  cols = ['activity_name', 'quantity', 'unit_rate', 'total_amount', 'activity_id']
@@ -276,13 +509,13 @@ def view_monthly_input(mode):
                  # 4. AgGrid
                  grid_data = make_aggrid(
                      df,
-                     key=f"ag_cost_{mode}",
+                     key=f"{grid}_{b['rev']}",
                      readonly_cols=['activity_name', 'activity_id'],
                      currency_cols=['unit_rate', 'total_amount']
                  )
                  
                  # 5. 保存
-                 if st.button("Save Costs", key=f"b_ag_cost"):
+                 if st.button("Save Costs", key=f"b_ag_cost", disabled=locked):
                      edited_df = pd.DataFrame(grid_data)
                      # 简单的后端补算
                      for i, row in edited_df.iterrows():
@@ -292,7 +525,75 @@ def view_monthly_input(mode):
                          if t == 0 and q > 0 and r > 0:
                              edited_df.at[i, 'total_amount'] = q * r
                              
-                     if backend.save_monthly_data(edited_df, "fact_operational_costs", "activity_id", fid, target_date, mode): 
-                         st.success("Costs Saved!")
-                         time.sleep(1)
-                         st.rerun()
\ No newline at end of file
+                     try:
+                         result = backend.save_monthly_data(edited_df, "fact_operational_costs", "activity_id", fid, target_date, record_type, base=b['df'])
+                         _after_save(grid, "fact_operational_costs", result, "Costs Saved!")
+                     except Exception as e: st.error(str(e))
+                 _conflict_panel(grid, fid, target_date)
+                 _reload_button(grid)
+
+# --- 3. Budget Scenarios (整年批量生成) ---
+def view_budget_scenarios():
+    st.title("🧮 Budget Scenarios (Copy-Forward)")
+    st.caption("一次为所有林地生成全年预算：复制来源年份 → 按 grade / activity 加成 → 按季节分布摊到 12 个月。")
+    forests = backend.get_forest_list()
+    if not forests: return
+
+    c1, c2, c3 = st.columns(3)
+    with c1: year = st.selectbox("Target Year", [2025, 2026, 2027], index=1, key="sc_year")
+    with c2: source_year = st.selectbox("Copy From Year", [2024, 2025, 2026], index=1, key="sc_src_year")
+    src_scens = [s['name'] for s in budget_scenarios.list_scenarios(source_year)]
+    with c3: source = st.selectbox("Source", ["Actual", "Budget"] + src_scens, key="sc_src")
+    source_type = source if source in ("Actual", "Budget") else budget_scenarios.scenario_record_type(source)
+
+    c4, c5, c6 = st.columns(3)
+    with c4: name = st.text_input("Scenario Name", "Base Case", help="填 'Budget' 会直接覆盖正式预算")
+    with c5: default_uplift = st.number_input("Default Uplift %", -50.0, 100.0, 0.0, 0.5)
+    with c6: profile = st.radio("Monthly Spread", budget_scenarios.PROFILES)
+
+    # 按项目单独设置加成 (留空 = 用默认值)
+    uplifts = {}
+    tab_rev, tab_cost = st.tabs(["📋 Revenue Uplift by Grade", "💰 Cost Uplift by Activity"])
+    for tab, kind in [(tab_rev, "Revenue"), (tab_cost, "Cost")]:
+        _, item_col, dim_table, name_col = budget_scenarios.SOURCES[kind][:4]
+        dims = backend.cached_select(dim_table, f"id, {name_col}")
+        with tab:
+            df_up = pd.DataFrame({"id": [d['id'] for d in dims], "Item": [d[name_col] for d in dims], "Uplift %": [None] * len(dims)})
+            df_up = st.data_editor(df_up, column_config={"id": None, "Item": st.column_config.TextColumn(disabled=True),
+                                   "Uplift %": st.column_config.NumberColumn(format="%.1f%%")},
+                                   hide_index=True, width="stretch", key=f"sc_up_{kind}")
+            uplifts[kind] = {r['id']: r['Uplift %'] for _, r in df_up.iterrows() if pd.notnull(r['Uplift %'])}
+
+    # 内存中生成 + 预览
+    results = {}
+    preview = pd.DataFrame({"forest_id": [f['id'] for f in forests]})
+    for kind in budget_scenarios.SOURCES:
+        f_ids, items, _, cube = budget_scenarios.generate(kind, year, source_year, source_type, uplifts[kind], default_uplift, profile)
+        results[kind] = (f_ids, items, cube)
+        preview = preview.merge(budget_scenarios.summarize(kind, f_ids, cube).rename(columns={"annual": kind}), on="forest_id", how="left")
+    preview.insert(0, "Forest", preview['forest_id'].map({f['id']: f['name'] for f in forests}))
+    preview["Net"] = preview["Revenue"].fillna(0) - preview["Cost"].fillna(0)
+
+    st.subheader(f"Preview: {name} ({year})")
+    st.dataframe(preview.drop(columns=["forest_id"]), column_config={
+        c: st.column_config.NumberColumn(format="$%.0f") for c in ["Revenue", "Cost", "Net"]
+    }, hide_index=True, width="stretch")
+
+    if st.button("💾 Write Scenario", type="primary", disabled=not name.strip()):
+        try:
+            n = budget_scenarios.save_scenario(name.strip(), year, f"{source} {source_year}", results)
+            st.success(f"✅ Scenario '{name}' saved ({n} rows).")
+        except Exception as e: st.error(f"Error: {e}")
+
+    # 已有情景
+    st.divider()
+    scens = budget_scenarios.list_scenarios(year)
+    if scens:
+        st.markdown(f"**Existing scenarios for {year}** (open them in Budget Planning → Version)")
+        st.dataframe(pd.DataFrame(scens)[["name", "source", "created_at"]], hide_index=True, width="stretch")
+        d1, d2 = st.columns([2, 1])
+        with d1: to_delete = st.selectbox("Scenario", [s['name'] for s in scens], key="sc_del")
+        with d2:
+            if st.button("🗑️ Delete Scenario"):
+                budget_scenarios.delete_scenario(to_delete, year)
+                st.rerun()